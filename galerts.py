@@ -287,20 +287,39 @@ class GAlertsManager(galerts2.GoogleAlertsManager):
         new_alerts = super(GAlertsManager, self).alerts
 
         for new_alert in new_alerts:
-            alert = Alert(
-                email   = self.email,
-                s       = new_alert.alert_id,
-                query   = new_alert.query,
-                type    = ALERT_TYPES_REV[new_alert.sources[0]] if new_alert.sources is not None else ALERT_TYPES_REV[Sources.Automatic],
-                freq    = ALERT_FREQS_REV[new_alert.frequency],
-                vol     = ALERT_VOLS_REV[new_alert.volume],
-                deliver = DELIVER_TYPES_REV[new_alert.delivery],
-                feedurl = new_alert.feed_url
-            )
+            yield self._wrap_alert(new_alert)
 
-            alert.new_alert = new_alert
+    def mirrored_alerts(self, **filters):
+        """
+        Like :attr:`alerts`, but reads the alerts from the manager's
+        :class:`galerts_mirror.AlertMirror` instead of asking Google. Keyword
+        arguments are passed on as filters to
+        :meth:`galerts_mirror.AlertMirror.alerts`.
+        """
+        if self.mirror is None:
+            raise ValueError('GAlertsManager has no mirror')
+
+        for new_alert in self.mirror.alerts(**filters):
+            yield self._wrap_alert(new_alert)
+
+    def _wrap_alert(self, new_alert):
+        """
+        Convert a :class:`galerts2.Alert` into an :class:`Alert`.
+        """
+        alert = Alert(
+            email   = self.email,
+            s       = new_alert.alert_id,
+            query   = new_alert.query,
+            type    = ALERT_TYPES_REV[new_alert.sources[0]] if new_alert.sources is not None else ALERT_TYPES_REV[Sources.Automatic],
+            freq    = ALERT_FREQS_REV[new_alert.frequency],
+            vol     = ALERT_VOLS_REV[new_alert.volume],
+            deliver = DELIVER_TYPES_REV[new_alert.delivery],
+            feedurl = new_alert.feed_url
+        )
+
+        alert.new_alert = new_alert
 
-            yield alert
+        return alert
 
     def create(self, query, type, feed=True, freq=FREQ_ONCE_A_DAY,
             vol=VOL_ONLY_BEST):
@@ -317,7 +336,7 @@ class GAlertsManager(galerts2.GoogleAlertsManager):
             to be delivered. Defaults to :attr:`VOL_ONLY_BEST`.
         """
 
-        super(GAlertsManager, self).create(
+        return super(GAlertsManager, self).create(
             query    = query,
             sources  = [ ALERT_TYPES[type] ] if ALERT_TYPES[type] != Sources.Automatic else None,
             delivery = DeliveryTypes.Feed if feed else DeliveryTypes.Email,
@@ -24,13 +24,20 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import re
+import copy
+import time
+import codecs
 import json
+import socket
+import hashlib
 import urllib2
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
-from BeautifulSoup import BeautifulSoup
 from getpass import getpass
 from urllib import urlencode
-from json.decoder import JSONDecoder
 
 class AlertParameter:
     """
@@ -126,20 +133,82 @@ class ParseFailureError(Exception):
     Raised when a Google Alerts feature is used that is not supported in this code.
     """
 
-class Account:
+class BulkOperationError(Exception):
+    """
+    Raised at the end of a bulk operation if some of its requests failed.
+
+    :attr:`failures` is a list of (item, exception) pairs.
+    """
+    def __init__(self, failures):
+        Exception.__init__(self, '{} of the requests failed, first error: {!r}'.format(
+            len(failures), failures[0][1]))
+        self.failures = failures
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when a request to Google runs out of time.
+
+    :attr:`operation` names the request (``'login page'``, ``'sign in'``,
+    ``'alerts page'``, ``'create'``, ``'modify'`` or ``'delete'``) and
+    :attr:`phase` how far it got: ``'start'`` if there was no time left to
+    make it, ``'connect'`` while connecting and waiting for the response and
+    ``'read'`` while reading the response body.
+    """
+    def __init__(self, operation, phase):
+        Exception.__init__(self, '{} timed out ({})'.format(operation, phase))
+        self.operation = operation
+        self.phase     = phase
+
+class CancelledError(Exception):
+    """
+    Raised when an operation is stopped through :meth:`Deadline.cancel`.
+    """
+
+class Account(object):
     """
     Account related information in window.STATE
     """
+    FIELDS = ('email', 'delivery_data', 'language', 'account_id')
+
     def __init__(self, account_data):
         self.email         = account_data[2]
         self.delivery_data = account_data[3]
         self.language      = account_data[5]
         self.account_id    = account_data[14]
 
-class Alert:
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuild an account from the output of :meth:`as_dict`.
+        """
+        account = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(account, field, d[field])
+        return account
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, field, value)
+
+def feed_url(account_id, feed_id):
+    """
+    Return the URL of the feed *feed_id* of the account *account_id*.
+    """
+    return 'https://www.' + _GOOGLE_DOMAIN + '/alerts/feeds/' + account_id + '/' + feed_id
+
+class Alert(object):
     """
     Represents the state of an alert in WindowState
     """
+    FIELDS = ('alert_id', 'account_id', 'query', 'language', 'region', 'sources',
+              'volume', 'frequency', 'delivery', 'email', 'feed_id', 'feed_url',
+              'delivery_hour', 'delivery_weekday')
 
     def __init__(self, alert_state):
         self.alert_id   = alert_state[1]
@@ -168,16 +237,48 @@ class Alert:
         self.feed_id    = None
         self.feed_url   = None
 
+        # hour (UTC) and weekday (Sunday is 0) at which digests are sent. Not
+        # set for as-it-happens alerts, and the weekday only for weekly ones
+        delivery_block        = delivery_info[3] or []
+        self.delivery_hour    = delivery_block[2] if len(delivery_block) > 2 else None
+        self.delivery_weekday = delivery_block[3] if len(delivery_block) > 3 else None
+
         if self.delivery == DeliveryTypes.Feed:
             self.feed_id = delivery_info[11]
-            self.feed_url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts/feeds/' + self.account_id + '/' + self.feed_id
+            self.feed_url = feed_url(self.account_id, self.feed_id)
+
+    def as_dict(self):
+        """
+        Return the alert's attributes as a dict of plain values.
+        """
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuild an alert from the output of :meth:`as_dict`.
+        """
+        alert = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(alert, field, d[field])
+        return alert
+
+    # alerts are pickled as a plain tuple of their fields, which is a lot more
+    # compact than their attribute dict when sending a whole WindowState
+    # between processes
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, field, value)
 
     def __str__(self):
         return '<Alert id: {}, query: {}, volume: {}, frequency: {}, delivery: {}, email: {}, feed: {}>'.format(
             self.alert_id, self.query, Volumes.getName(self.volume), Frequencies.getName(self.frequency),
             DeliveryTypes.getName(self.delivery), self.email, self.feed_url)
 
-class WindowState:
+class WindowState(object):
     """
     Represents the window.STATE variable in the Google Alerts page.
     
@@ -185,14 +286,20 @@ class WindowState:
     every alert, information about the logged in user account and some other 
     information as well.
     """
-    def __init__(self, window_state):
+    def __init__(self, window_state, alerts=None):
+        """
+        :param window_state: the decoded value of window.STATE
+        :param alerts: the already decoded alerts of *window_state*, if any
+        """
         # 'x' is a parameter that needs to be sent with every request. Every time
         # the window state is refreshed, a new 'x' will be received.
         self.x = window_state[3]
 
         alerts_data = window_state[1]
 
-        if alerts_data is not None:
+        if alerts is not None:
+            self.alerts = alerts
+        elif alerts_data is not None:
             # There is atleast one alert
             alerts = alerts_data[1]
             self.alerts = [ Alert(alert_data) for alert_data in alerts ]
@@ -208,6 +315,368 @@ class WindowState:
             account = Account(account_data)
             self.accounts[account.email] = account
 
+        self._fingerprints = None
+
+    @classmethod
+    def from_alerts(cls, alerts, accounts, x=None):
+        """
+        Build a window state from :class:`Alert` and :class:`Account`
+        objects, e.g. ones rebuilt from stored data. *x* is only needed to
+        make requests with it.
+        """
+        window_state = cls.__new__(cls)
+        window_state.x = x
+        window_state.alerts = list(alerts)
+        window_state.accounts = dict((account.email, account) for account in accounts)
+        window_state._fingerprints = None
+        return window_state
+
+    @property
+    def fingerprints(self):
+        """
+        A :class:`FingerprintSet` of the alerts, built the first time it is
+        used.
+        """
+        if self._fingerprints is None:
+            self._fingerprints = FingerprintSet(self.alerts)
+        return self._fingerprints
+
+    def columns(self):
+        """
+        Return the alerts as a :class:`galerts_columns.AlertColumns`. Needs
+        NumPy.
+        """
+        from galerts_columns import AlertColumns
+        return AlertColumns.from_alerts(self.alerts)
+
+# size of the pieces in which the alerts page is read
+_READ_CHUNK_SIZE = 64 * 1024
+
+_STATE_MARKER_RE = re.compile(r'window\.STATE\s*=\s*')
+# characters that matter when scanning the window.STATE literal outside and
+# inside of strings
+_STATE_TOKEN_RE  = re.compile(r'[\[\]",]')
+_STRING_TOKEN_RE = re.compile(r'["\\]')
+_WHITESPACE_RE   = re.compile(r'[\s,]*')
+
+class _WindowStateReader(object):
+    """
+    Incrementally decodes the window.STATE array literal.
+
+    The alerts are decoded one by one into :class:`Alert` objects as soon as
+    their text has been read, and the text is dropped. Apart from the alerts
+    themselves, only the text of a single alert and the (small) rest of the
+    state are held in memory.
+    """
+    def __init__(self):
+        self.alerts = []
+
+        # text of window.STATE with an empty list in place of the alerts
+        self._skeleton = []
+        # text that has been read but not consumed yet
+        self._text = u''
+        # index of the current element in every open array, outermost first.
+        # The alerts are the elements of window.STATE[1][1].
+        self._path = []
+        self._in_string = False
+        self._escaped   = False
+        self._in_alerts = False
+        self._decoder   = json.JSONDecoder()
+
+    def feed(self, data):
+        """
+        Consume the next piece of the literal. Returns True once the literal is
+        complete.
+        """
+        pos  = len(self._text)
+        text = self._text + data
+        if self._escaped and pos < len(text):
+            # skip the character after a backslash at the end of the last piece
+            pos += 1
+            self._escaped = False
+
+        if self._in_alerts:
+            pos = 0
+
+        path = self._path
+        while True:
+            if self._in_alerts:
+                pos = _WHITESPACE_RE.match(text, pos).end()
+                if pos == len(text):
+                    break
+                if text[pos] != ']':
+                    try:
+                        value, pos_after = self._decoder.raw_decode(text, pos)
+                    except ValueError:
+                        # most likely the alert continues in the next piece
+                        break
+                    self.alerts.append(Alert(value))
+                    pos = pos_after
+                    continue
+                # the end of the alerts; leave the ']' to the scanner
+                self._in_alerts = False
+                text = text[pos:]
+                pos  = 0
+
+            match = (_STRING_TOKEN_RE if self._in_string else _STATE_TOKEN_RE).search(text, pos)
+            if match is None:
+                pos = len(text)
+                break
+            char = match.group()
+            pos  = match.end()
+
+            if self._in_string:
+                if char == '"':
+                    self._in_string = False
+                elif pos < len(text):
+                    pos += 1
+                else:
+                    self._escaped = True
+            elif char == '"':
+                self._in_string = True
+            elif char == ',':
+                if path:
+                    path[-1] += 1
+            elif char == '[':
+                if path == [1, 1]:
+                    self._skeleton.append(text[:pos])
+                    text = text[pos:]
+                    pos  = 0
+                    self._in_alerts = True
+                path.append(0)
+            else:
+                path.pop()
+                if not path:
+                    self._skeleton.append(text[:pos])
+                    self._text = u''
+                    return True
+
+        if self._in_alerts:
+            self._text = text[pos:]
+        else:
+            self._skeleton.append(text[:pos])
+            self._text = text[pos:]
+        return False
+
+    def window_state(self):
+        state_value = json.loads(u''.join(self._skeleton))
+        return WindowState(state_value, alerts=self.alerts)
+
+def _decode_window_state(chunks, encoding='utf-8'):
+    """
+    Decode window.STATE from the pieces of the alerts page produced by the
+    iterable *chunks*, and return it as a :class:`WindowState`. Stops
+    consuming *chunks* at the end of the literal.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    chunks = iter(chunks)
+
+    # find the start of the literal. Only a short tail of what has been read is
+    # kept, in case the marker is split between two pieces
+    data = u''
+    for chunk in chunks:
+        data += decoder.decode(chunk)
+        match = _STATE_MARKER_RE.search(data)
+        if match is not None and match.end() < len(data):
+            data = data[match.end():]
+            break
+        if match is None:
+            data = data[-64:]
+    else:
+        raise ParseFailureError("Couldn't find the definition of window.STATE in the Google Alerts page")
+
+    if not data.startswith('['):
+        raise ParseFailureError('window.STATE in the Google Alerts page is not an array')
+
+    reader = _WindowStateReader()
+    if reader.feed(data):
+        return reader.window_state()
+    for chunk in chunks:
+        if reader.feed(decoder.decode(chunk)):
+            return reader.window_state()
+
+    raise ParseFailureError('The Google Alerts page ended inside of window.STATE')
+
+def _read_window_state(response, chunk_size=_READ_CHUNK_SIZE):
+    """
+    Read the alerts page from *response* up to the end of the window.STATE
+    literal and return it as a :class:`WindowState`.
+    """
+    encoding = response.info().getparam('charset') or 'utf-8'
+    return _decode_window_state(iter(lambda: response.read(chunk_size), ''), encoding)
+
+def parse_window_state(page, encoding='utf-8'):
+    """
+    Parse the alerts page *page* (a byte string) into a :class:`WindowState`.
+
+    This is the CPU-bound part of a refresh. It is a module level function so
+    it can be run in a :class:`multiprocessing.Pool`; see the *parse_pool*
+    argument of :class:`GoogleAlertsManager`.
+    """
+    return _decode_window_state(
+        (page[i:i+_READ_CHUNK_SIZE] for i in xrange(0, len(page), _READ_CHUNK_SIZE)), encoding)
+
+def refresh_all(managers, threads=8, timeout=None):
+    """
+    Refresh the window state of every manager in *managers*, fetching up to
+    *threads* alerts pages concurrently.
+
+    Managers created with a *parse_pool* parse their pages in that pool, so
+    parsing runs on as many cores as the pool has processes while the threads
+    wait for the network.
+
+    :param timeout: seconds or a :class:`Deadline` by which all refreshes
+        have to be done
+    """
+    managers = list(managers)
+    deadline = timeout if isinstance(timeout, Deadline) else Deadline(timeout)
+
+    def refresh(manager):
+        with manager.deadline(deadline):
+            manager.refresh()
+
+    pool = ThreadPool(min(threads, len(managers)) or 1)
+    try:
+        pool.map(refresh, managers)
+    finally:
+        pool.close()
+        pool.join()
+
+class Deadline(object):
+    """
+    The time by which an operation has to be done, and a switch to cancel it
+    before that.
+
+    See :meth:`GoogleAlertsManager.deadline`. A deadline can be shared by
+    several managers and threads, e.g. to bound a whole job.
+    """
+    def __init__(self, timeout=None, parent=None):
+        """
+        :param timeout: seconds from now, or ``None`` for no time limit
+        :param parent: an enclosing :class:`Deadline`; this one expires and is
+            cancelled with it
+        """
+        self.expires_at = time.time() + timeout if timeout is not None else None
+        self.parent     = parent
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """
+        Stop the operation: requests that haven't been made yet raise
+        :exc:`CancelledError`. Requests already sent are not interrupted, as
+        Google may have carried them out anyway, but they still end at the
+        deadline.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def remaining(self):
+        """
+        Return the seconds left, or ``None`` if there is no time limit.
+        """
+        remaining = self.expires_at - time.time() if self.expires_at is not None else None
+        if self.parent is not None:
+            outer = self.parent.remaining()
+            if outer is not None and (remaining is None or outer < remaining):
+                remaining = outer
+        return remaining
+
+    def check(self, operation, phase='start'):
+        """
+        :raises CancelledError: if the deadline was cancelled
+        :raises DeadlineExceededError: if no time is left
+        """
+        if self.cancelled:
+            raise CancelledError(operation + ' was cancelled')
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededError(operation, phase)
+
+    def timeout(self, limit=None):
+        """
+        Return the timeout for a blocking call: *limit*, but no more than the
+        time left. ``None`` if there is neither.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        # a timeout of 0 would make sockets non-blocking
+        remaining = max(remaining, 0.001)
+        return min(limit, remaining) if limit is not None else remaining
+
+def _is_timeout(error):
+    """
+    Whether *error* is a socket running out of time.
+    """
+    if isinstance(error, socket.timeout):
+        return True
+    if isinstance(error, urllib2.URLError) and isinstance(error.reason, socket.timeout):
+        return True
+    # the ssl module raises SSLError('The read operation timed out')
+    return isinstance(error, socket.error) and 'timed out' in str(error)
+
+def _set_socket_timeout(response, timeout):
+    """
+    Set the timeout of the socket that *response* is read from, if it has one.
+    """
+    # responses of urllib2 wrap an httplib response, which reads from a file
+    # object made from the socket. Other openers' responses are left alone.
+    try:
+        sock = response.fp._sock.fp._sock
+    except AttributeError:
+        return
+    try:
+        sock.settimeout(timeout)
+    except socket.error:
+        pass
+
+class _TimedResponse(object):
+    """
+    A response whose body is read under the deadline of its request.
+    """
+    def __init__(self, response, deadline, operation, read_timeout):
+        self._response    = response
+        self.deadline     = deadline
+        self.operation    = operation
+        self.read_timeout = read_timeout
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self._read(size)
+        # read in pieces so that the deadline is checked in between
+        chunks = []
+        while True:
+            chunk = self._read(_READ_CHUNK_SIZE)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def _read(self, size):
+        self.deadline.check(self.operation, 'read')
+        _set_socket_timeout(self._response, self.deadline.timeout(self.read_timeout))
+        try:
+            return self._response.read(size)
+        except Exception as e:
+            if _is_timeout(e):
+                raise DeadlineExceededError(self.operation, 'read')
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+class _ManagerState(object):
+    """
+    The window state of a manager and its account, swapped in together.
+    """
+    __slots__ = ('window_state', 'account')
+
+    def __init__(self, window_state, account):
+        self.window_state = window_state
+        self.account      = account
+
 class GoogleAlertsManager(object):
     """
     Manages creation, modification, and deletion of Google Alerts for the
@@ -222,30 +691,161 @@ class GoogleAlertsManager(object):
     for now, :class:`GoogleAlertsManager` always uses the email address it's
     instantiated with when creating new email alerts or changing feed alerts
     to email alerts.
+
+    A manager can be shared by threads. Every refresh builds a new
+    :class:`WindowState` and swaps it in together with the account in one
+    step, so readers of :attr:`window_state` and :attr:`account` never wait
+    and never see half of a refresh. They must treat what they read as
+    read-only.
     """
 
-    def __init__(self, email, password):
+    def __init__(self, email, password, write_behind=False, max_pending=50, max_delay=5.0, mirror=None,
+                 slot_allocator=None, parse_pool=None, opener=None, concurrency=None, timeout=None,
+                 connect_timeout=None, read_timeout=None, history=None):
         """
         :param email: sign in using this email address. If there is no @
             symbol in the value, "@gmail.com" will be appended.
         :param password: plaintext password, used only to get a session
             cookie. Sent over a secure connection and then discarded.
+        :param write_behind: queue :meth:`create`, :meth:`update` and
+            :meth:`delete` in a :class:`WriteBehindQueue` instead of sending
+            them right away. Call :meth:`flush` to send them explicitly.
+        :param max_pending: with write-behind, flush once this many alerts
+            have pending changes
+        :param max_delay: with write-behind, flush this many seconds after the
+            first change was queued
+        :param mirror: a :class:`galerts_mirror.AlertMirror` that is synced
+            with the alerts every time they are fetched from Google
+        :param slot_allocator: a :class:`DeliverySlotAllocator` choosing the
+            delivery hour and weekday of digest alerts. Without one, digests
+            are delivered at the hour they were created or last updated.
+        :param parse_pool: a :class:`multiprocessing.Pool` in which alerts pages
+            are parsed. Useful when many managers are refreshed from threads
+            of one process, see :func:`refresh_all`.
+        :param opener: the :class:`urllib2.OpenerDirector` (or an object with
+            the same ``open`` method) through which all requests are made,
+            e.g. a :class:`galerts_cassette.ReplayOpener`. By default a new
+            opener with a cookie jar is built and installed.
+        :param concurrency: an :class:`AdaptiveConcurrency` controller. With
+            one, :meth:`create_many`, :meth:`update_many` and
+            :meth:`delete_many` run their requests concurrently.
+        :param timeout: seconds after which a single request to Google is
+            given up, including reading its response. Operations can be given
+            a deadline of their own with :meth:`deadline`.
+        :param connect_timeout: seconds to wait while connecting and for the
+            response to start, at most the time left of the request
+        :param read_timeout: seconds to wait for more of the response body,
+            at most the time left of the request
+        :param history: a :class:`galerts_history.WindowStateHistory` that
+            every fetched window state is recorded in, under :attr:`email`
 
         :raises SignInError: if Google responds with "403 Forbidden" to
             our request to sign in
         :raises UnexpectedResponseError: if the status code of Google's
               response is unrecognized (neither 403 nor 200)
+        :raises DeadlineExceededError: if a request takes longer than allowed
         :raises socket.error: e.g. if there is no network connection
         """
         if '@' not in email:
             email += '@gmail.com'
         self.email = email
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
-
-        urllib2.install_opener(self.opener)
+        if opener is None:
+            opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
+            urllib2.install_opener(opener)
+        self.opener = opener
+
+        self.write_behind = WriteBehindQueue(self, max_pending, max_delay) if write_behind else None
+        self.mirror = mirror
+        self.history = history
+        self.slot_allocator = slot_allocator
+        self.parse_pool = parse_pool
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        # the deadline of the operation running in each thread, see deadline()
+        self._local = threading.local()
+
+        # guards window_state.fingerprints while creates run concurrently
+        self._fingerprints_lock = threading.Lock()
+
+        # the window state and account, replaced as a whole by every refresh
+        self._state = None
+
+        # refreshes started and finished so far, and the error of the last
+        # one, see refresh()
+        self._refresh_condition = threading.Condition()
+        self._refreshing        = False
+        self._refreshes_started = 0
+        self._refreshes_done    = 0
+        self._refresh_error     = None
 
         self._signin(password)
-        self._refresh_window_state()
+        self.refresh()
+
+    @property
+    def window_state(self):
+        """
+        The :class:`WindowState` of the last refresh.
+        """
+        return self._state.window_state
+
+    @property
+    def account(self):
+        """
+        The :class:`Account` of this manager in :attr:`window_state`.
+        """
+        return self._state.account
+
+    @contextmanager
+    def deadline(self, timeout=None):
+        """
+        Bound all requests made by this thread within the ``with`` block by a
+        :class:`Deadline`, which is returned::
+
+            with gam.deadline(60) as deadline:
+                gam.create_many(specs)
+
+        Calling ``deadline.cancel()`` from another thread stops the bulk
+        operation after the requests in flight. Blocks can be nested; an inner
+        deadline given in seconds expires no later than the outer one.
+
+        :param timeout: seconds, or a :class:`Deadline` to use
+        """
+        outer = getattr(self._local, 'deadline', None)
+        if isinstance(timeout, Deadline):
+            deadline = timeout
+        else:
+            deadline = Deadline(timeout, parent=outer)
+        self._local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self._local.deadline = outer
+
+    def _open(self, operation, url, data=None):
+        """
+        Make a request through the opener under the per-request timeout and
+        the deadline of the current operation. *operation* names the request
+        in errors.
+
+        :raises DeadlineExceededError: if it runs out of time
+        :raises CancelledError: if the operation was cancelled
+        """
+        deadline = Deadline(self.timeout, parent=getattr(self._local, 'deadline', None))
+        deadline.check(operation)
+        timeout = deadline.timeout(self.connect_timeout)
+        try:
+            if timeout is None:
+                response = self.opener.open(url, data)
+            else:
+                response = self.opener.open(url, data, timeout)
+        except Exception as e:
+            if _is_timeout(e):
+                raise DeadlineExceededError(operation, 'connect')
+            raise
+        return _TimedResponse(response, deadline, operation, self.read_timeout)
 
     def _signin(self, password):
         """
@@ -255,7 +855,7 @@ class GoogleAlertsManager(object):
         authenticate_url = 'https://accounts.' + _GOOGLE_DOMAIN + '/ServiceLoginAuth'
 
         # Load login page
-        login_page_contents = self.opener.open(login_page_url).read()
+        login_page_contents = self._open('login page', login_page_url).read()
 
         # Find GALX value
         galx_match_obj = re.search(
@@ -273,7 +873,7 @@ class GoogleAlertsManager(object):
             'continue': 'https://www.' + _GOOGLE_DOMAIN + '/alerts?hl=en&gl=us',
             'GALX': galx_value,
             })
-        response = self.opener.open(authenticate_url, params)
+        response = self._open('sign in', authenticate_url, params)
         resp_code = response.getcode()
         final_url = response.geturl()
         body = response.read()
@@ -295,42 +895,88 @@ class GoogleAlertsManager(object):
         The alerts and other required data for managing alerts are stored as a
         Javascript array in window.STATE.
 
-        Returns: The parsed value of window.STATE
+        Returns: The parsed value of window.STATE, which is also swapped in
+        as the manager's state
         """
 
         alerts_url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts?hl=en&gl=us'
-        response = self.opener.open(alerts_url)
+        response = self._open('alerts page', alerts_url)
         resp_code = response.getcode()
-        body = response.read()
    
         if resp_code != 200:
-            raise UnexpectedResponseError(resp_code, [], body)
-
-        soup = BeautifulSoup(body, convertEntities=BeautifulSoup.HTML_ENTITIES)
-
-        # the alerts data is stored in window.STATE defined in one of the
-        # <script> tags 
-        script = soup.find('script', text=re.compile(r'window\.STATE\s*='))
-        state_value_match = re.search(r'window\.STATE\s*=\s*(.*)', script.string)
-
-        if state_value_match is None:
-            raise ParseFailureError("Couldn't find the definition of window.STATE in the Google Alerts page")
-
-        state_value_string = state_value_match.group(1)
+            raise UnexpectedResponseError(resp_code, [], response.read())
+
+        try:
+            if self.parse_pool is not None:
+                # only the I/O happens in this thread; the page is parsed by a
+                # worker process, which sends back the resulting WindowState
+                encoding = response.info().getparam('charset') or 'utf-8'
+                page = response.read()
+                window_state = self.parse_pool.apply(parse_window_state, (page, encoding))
+            else:
+                # the page is read only up to the end of window.STATE, and
+                # parsed while it is being read
+                window_state = _read_window_state(response)
+        finally:
+            response.close()
+
+        # a single assignment, so readers see either the old or the new
+        # state as a whole
+        self._state = _ManagerState(window_state, window_state.accounts[self.email])
+
+        if self.mirror is not None:
+            self.mirror.sync(window_state)
+        if self.history is not None:
+            self.history.record(self.email, window_state)
+        if self.slot_allocator is not None:
+            self.slot_allocator.reset(window_state.alerts)
+        return window_state
+
+    def refresh(self):
+        """
+        Fetch the alerts page again and update :attr:`window_state`. Returns
+        the new window state.
 
-        state_value = JSONDecoder().raw_decode(state_value_string)[0]
-        self.window_state = WindowState(state_value)
-        self.account = self.window_state.accounts[self.email]
+        Refreshes requested at the same time from several threads are
+        collapsed: while one is running, callers wait for it, and those that
+        asked during it share a single follow-up refresh, so every caller
+        gets a state fetched after its call started.
+        """
+        condition = self._refresh_condition
+        with condition:
+            needed = self._refreshes_started + 1
+            while True:
+                if self._refreshes_done >= needed:
+                    if self._refresh_error is not None:
+                        raise self._refresh_error
+                    return self.window_state
+                if not self._refreshing:
+                    break
+                condition.wait()
+            self._refreshing = True
+            self._refreshes_started += 1
+
+        error = None
+        try:
+            return self._refresh_window_state()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with condition:
+                self._refreshing = False
+                self._refreshes_done = self._refreshes_started
+                self._refresh_error = error
+                condition.notify_all()
 
     @property
     def alerts(self):
         """
         Return a list of :class:`ArrayState` objects which contain information about all the alerts.
         """
-        self._refresh_window_state()
-        return self.window_state.alerts[:]
+        return self.refresh().alerts[:]
 
-    def _create_alert_data(self, query, sources, delivery, freq, vol, lang='en', region=None):
+    def _create_alert_data(self, query, sources, delivery, freq, vol, lang='en', region=None, delivery_block=None):
         """
         Create data for a single alert which is used for API calls
         """
@@ -338,8 +984,9 @@ class GoogleAlertsManager(object):
             if Sources.Automatic in sources:
                 raise ValueError('List of sources cannot contain Sources.Automatic')
 
-        delivery_block = None
-        if freq != Frequencies.AsItHappens:
+        if freq == Frequencies.AsItHappens:
+            delivery_block = None
+        elif delivery_block is None:
             utcnow = datetime.utcnow()
 
             delivery_block = [ None, None, utcnow.hour ]
@@ -382,6 +1029,24 @@ class GoogleAlertsManager(object):
 
         return alert_data
 
+    def _post(self, action, params):
+        """
+        POST *params* to the /alerts/<action> endpoint and check the response.
+        """
+        url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts/' + action + '?x=' + self.window_state.x
+
+        post_params = urlencode({ 'params': json.dumps(params) })
+
+        response = self._open(action, url, post_params)
+        resp_code = response.getcode()
+        if resp_code != 200:
+            raise UnexpectedResponseError(
+                resp_code,
+                response.info().headers,
+                response.read(),
+                )
+        return response
+
     def create(self, query, sources=None, delivery=DeliveryTypes.Feed, freq=None, vol=Volumes.BestResults, lang='en', region=None):
         #TODO fix doc
         """
@@ -395,50 +1060,189 @@ class GoogleAlertsManager(object):
             updated in real time). Defaults to :attr:`FREQ_ONCE_A_DAY`.
         :param vol: a value in :attr:`ALERT_VOLS` indicating volume of results
             to be delivered. Defaults to :attr:`VOL_ONLY_BEST`.
+
+        Nothing is sent if the account already has an alert with the same
+        settings (see :func:`alert_fingerprint`); ``True`` is returned if the
+        alert was created and ``False`` if it already existed.
+
+        With write-behind enabled, the alert is only queued and its
+        :class:`AlertSpec` is returned, which can be passed to :meth:`update`
+        and :meth:`delete` until the queue is flushed. Whether it already
+        exists is checked when it is flushed.
         """
+        return self._create(AlertSpec(query, sources, delivery, freq, vol, lang, region))
 
-        url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts/create?x=' + self.window_state.x
+    def _create(self, spec):
+        if self.write_behind is not None:
+            return self.write_behind.create(spec)
 
-        if delivery == DeliveryTypes.Feed:
-            if freq is None:
-                freq = Frequencies.AsItHappens
+        return self._send_create(spec)
 
-            if freq != Frequencies.AsItHappens:
-                raise ValueError('Frequency for a feed can can only be Frequencies.AsItHappens, but was set to ' + str(freq)) 
-        else:
-            if freq is None:
-                freq = Frequencies.OnceADay
+    def create_many(self, specs):
+        """
+        Creates an alert for every :class:`AlertSpec` in the iterable *specs*,
+        e.g. an :class:`AlertTemplate`. Specs whose alert already exists, or
+        which repeat an earlier spec, are skipped.
 
-        params = [
-            None,
-            self._create_alert_data(
-                query    = query,
-                sources  = sources,
-                delivery = delivery,
-                freq     = freq,
-                vol      = vol,
-                lang     = lang,
-                region   = region
-            )
-        ]
+        :raises BulkOperationError: if some of the alerts couldn't be created
+            (only when the manager has a *concurrency* controller; otherwise
+            the first error is raised right away)
+        """
+        self._run_bulk(self._create, specs)
 
-        post_params = urlencode({ 'params': json.dumps(params) })
+    def update_many(self, alerts):
+        """
+        Updates every alert in the iterable *alerts*.
+        """
+        self._run_bulk(self.update, alerts)
 
-        response = self.opener.open(url, post_params)
-        resp_code = response.getcode()
+    def delete_many(self, alerts):
+        """
+        Deletes every alert in the iterable *alerts*.
+        """
+        self._run_bulk(self.delete, alerts)
 
-        if resp_code != 200:
-            raise UnexpectedResponseError(resp_code,
-                response.info().headers,
-                response.read(),
+    def _run_bulk(self, func, items):
+        """
+        Call func(item) for every item. Without a concurrency controller, or
+        when mutations are queued by write-behind anyway, this is a plain
+        loop. Otherwise requests are made from as many threads as the
+        controller allows, and throttled requests are retried.
+
+        Under a :meth:`deadline`, no further items are started once it has
+        expired or was cancelled, and its error is raised after the requests
+        in flight are done.
+        """
+        if self.concurrency is None or self.write_behind is not None:
+            for item in items:
+                func(item)
+            return
+
+        controller = self.concurrency
+        deadline   = getattr(self._local, 'deadline', None)
+        items      = iter(items)
+        items_lock = threading.Lock()
+        failures   = []
+        stopped    = []
+
+        def worker():
+            # the worker's requests run under the caller's deadline
+            self._local.deadline = deadline
+            while True:
+                with items_lock:
+                    if stopped:
+                        return
+                    try:
+                        if deadline is not None:
+                            deadline.check('bulk operation')
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    except (DeadlineExceededError, CancelledError) as e:
+                        stopped.append(e)
+                        return
+
+                attempt = 0
+                while True:
+                    controller.acquire()
+                    started = time.time()
+                    try:
+                        func(item)
+                    except Exception as e:
+                        throttled = _is_throttled(e)
+                        controller.release(time.time() - started, ok=False, throttled=throttled)
+                        if throttled and attempt < controller.max_retries:
+                            attempt += 1
+                            time.sleep(controller.retry_delay(attempt))
+                            continue
+                        failures.append((item, e))
+                    else:
+                        controller.release(time.time() - started, ok=True)
+                    break
+
+        threads = [ threading.Thread(target=worker) for _ in range(controller.maximum) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if stopped:
+            raise stopped[0]
+        if failures:
+            raise BulkOperationError(failures)
+
+    def _delivery_block(self, alert, keep_slot):
+        """
+        Pick the delivery_block for *alert*, or return None to deliver at the
+        current hour. With *keep_slot*, an alert which already has a slot
+        suitable for its frequency keeps it.
+        """
+        if self.slot_allocator is None or alert.frequency == Frequencies.AsItHappens:
+            return None
+
+        hour    = getattr(alert, 'delivery_hour', None)
+        weekday = getattr(alert, 'delivery_weekday', None)
+        if keep_slot and hour is not None:
+            if alert.frequency == Frequencies.OnceADay:
+                return [ None, None, hour ]
+            if weekday is not None:
+                return [ None, None, hour, weekday ]
+
+        return self.slot_allocator.allocate(alert.frequency)
+
+    def _send_create(self, alert):
+        """
+        Create *alert* unless an alert with the same fingerprint exists.
+        Returns whether a request was sent.
+        """
+        # the fingerprint is reserved before the request is made so that
+        # concurrent creates of the same alert send only one of them
+        fingerprint = alert_fingerprint(alert)
+        with self._fingerprints_lock:
+            fingerprints = self.window_state.fingerprints
+            if fingerprint in fingerprints:
+                return False
+            fingerprints.add(alert, fingerprint)
+
+        delivery_block = None
+        try:
+            delivery_block = self._delivery_block(alert, keep_slot=False)
+            params = [
+                None,
+                self._create_alert_data(
+                    query    = alert.query,
+                    sources  = alert.sources,
+                    delivery = alert.delivery,
+                    freq     = alert.frequency,
+                    vol      = alert.volume,
+                    lang     = alert.language,
+                    region   = alert.region,
+                    delivery_block = delivery_block
                 )
+            ]
+            self._post('create', params)
+        except Exception:
+            with self._fingerprints_lock:
+                fingerprints.discard(alert)
+            if delivery_block is not None:
+                self.slot_allocator.release(alert.frequency, delivery_block)
+            raise
+        return True
 
     def update(self, alert):
         """
         Updates an existing alert which has been modified.
         """
-        url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts/modify?x=' + self.window_state.x
+        if self.write_behind is not None:
+            return self.write_behind.update(alert)
 
+        self._send_update(alert)
+
+    def _send_update(self, alert):
+        # computed before the request, so that nothing can fail after Google
+        # has applied the change
+        fingerprint = alert_fingerprint(alert)
         params = [
             None,
             alert.alert_id,
@@ -449,40 +1253,661 @@ class GoogleAlertsManager(object):
                 freq     = alert.frequency,
                 vol      = alert.volume,
                 lang     = alert.language,
-                region   = alert.region
+                region   = alert.region,
+                delivery_block = self._delivery_block(alert, keep_slot=True)
             )
         ]
 
-        post_params = urlencode({ 'params': json.dumps(params) })
+        self._post('modify', params)
 
-        response = self.opener.open(url, post_params)
-        resp_code = response.getcode()
-        if resp_code != 200:
-            raise UnexpectedResponseError(
-                resp_code,
-                response.info().headers,
-                response.read(),
-                )
+        with self._fingerprints_lock:
+            fingerprints = self.window_state.fingerprints
+            fingerprints.discard(alert)
+            fingerprints.add(alert, fingerprint)
 
     def delete(self, alert):
         """
         Delete an existing alert.
         """
-        url = 'https://www.' + _GOOGLE_DOMAIN + '/alerts/delete?x=' + self.window_state.x
+        if self.write_behind is not None:
+            return self.write_behind.delete(alert)
+
+        self._send_delete(alert)
 
+    def _send_delete(self, alert):
         params = [
             None,
             alert.alert_id
         ]
 
-        post_params = urlencode({ 'params': json.dumps(params) })
+        self._post('delete', params)
 
-        response = self.opener.open(url, data=post_params)
-        resp_code = response.getcode()
-        if resp_code != 200:
-            raise UnexpectedResponseError(
-                resp_code,
-                response.info().headers,
-                response.read(),
-                )
+        with self._fingerprints_lock:
+            self.window_state.fingerprints.discard(alert)
+
+    def flush(self):
+        """
+        Send all mutations queued by write-behind to Google. Does nothing if
+        write-behind is not enabled.
+        """
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+class AlertSpec(object):
+    """
+    The settings of an alert that doesn't exist yet, as accepted by
+    :meth:`GoogleAlertsManager.create` and
+    :meth:`GoogleAlertsManager.create_many`.
+
+    It has the same settable attributes as :class:`Alert`. This is also what
+    is returned for creates queued by write-behind, so they can be modified
+    with :meth:`GoogleAlertsManager.update` or cancelled with
+    :meth:`GoogleAlertsManager.delete` before they are flushed.
+    """
+    def __init__(self, query, sources=None, delivery=DeliveryTypes.Feed, freq=None, vol=Volumes.BestResults, lang='en', region=None):
+        if delivery == DeliveryTypes.Feed:
+            if freq is None:
+                freq = Frequencies.AsItHappens
+
+            if freq != Frequencies.AsItHappens:
+                raise ValueError('Frequency for a feed can can only be Frequencies.AsItHappens, but was set to ' + str(freq)) 
+        else:
+            if freq is None:
+                freq = Frequencies.OnceADay
 
+        self.alert_id  = None
+        self.query     = query
+        self.sources   = sources
+        self.delivery  = delivery
+        self.frequency = freq
+        self.volume    = vol
+        self.language  = lang
+        self.region    = region
+
+    @classmethod
+    def from_alert(cls, alert):
+        """
+        Return a spec with the settings of an existing alert.
+        """
+        return cls(alert.query, alert.sources, alert.delivery, alert.frequency,
+                   alert.volume, alert.language, alert.region)
+
+    def as_dict(self):
+        return {
+            'query':    self.query,
+            'sources':  self.sources,
+            'delivery': self.delivery,
+            'freq':     self.frequency,
+            'vol':      self.volume,
+            'lang':     self.language,
+            'region':   self.region,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuild a spec from the output of :meth:`as_dict`.
+        """
+        return cls(**dict((str(k), v) for (k, v) in d.items()))
+
+    def __str__(self):
+        return '<AlertSpec query: {}, volume: {}, frequency: {}, delivery: {}>'.format(
+            self.query, Volumes.getName(self.volume), Frequencies.getName(self.frequency),
+            DeliveryTypes.getName(self.delivery))
+
+# shapes of language and region codes as used by Google Alerts, e.g. 'en',
+# 'zh-TW' and 'US'
+_LANGUAGE_RE = re.compile(r'^[a-z]{2,3}(-[A-Za-z]{2,4})?$')
+_REGION_CODE_RE = re.compile(r'^[A-Z]{2}$')
+
+class AlertTemplate(object):
+    """
+    Describes many alerts at once: every combination of its queries,
+    languages and regions and sources lists, all with the same delivery,
+    frequency and volume::
+
+        >>> template = AlertTemplate(['Corner Confectionery', '"sour cherry" pie'],
+        ...                          locales=[('en', 'US'), ('en', 'GB'), ('de', 'DE')],
+        ...                          sources=[None, [Sources.News, Sources.Blogs]])
+        >>> len(template)
+        12
+        >>> gam.create_many(template)
+
+    Either *locales* lists (language, region) pairs, or *languages* and
+    *regions* are combined with each other. A region of ``None`` means any
+    region.
+
+    All values are checked when the template is made, so a template that
+    can be constructed expands into valid :class:`AlertSpec` objects only.
+    The specs are produced lazily while iterating over the template.
+    """
+    def __init__(self, queries, languages=('en',), regions=(None,), locales=None, sources=(None,),
+                 delivery=DeliveryTypes.Feed, freq=None, vol=Volumes.BestResults):
+        """
+        :param queries: the queries
+        :param languages: language codes, combined with every region
+        :param regions: region codes, or ``None`` for any region
+        :param locales: (language, region) pairs to use instead of
+            *languages* and *regions*
+        :param sources: lists of :attr:`Sources`, or ``None`` for automatic
+            sources
+        :raises ValueError: if any value or the delivery, frequency and volume
+            together are invalid
+        """
+        if locales is None:
+            locales = [ (lang, region) for lang in languages for region in regions ]
+
+        self.queries  = list(queries)
+        self.locales  = list(locales)
+        self.sources  = [ list(s) if s is not None else None for s in sources ]
+        self.delivery = delivery
+        self.volume   = vol
+
+        # AlertSpec fills in the default frequency and rejects frequencies
+        # that don't go with the delivery
+        self.frequency = AlertSpec(u'-', delivery=delivery, freq=freq, vol=vol).frequency
+
+        self._validate()
+
+    def _validate(self):
+        errors = []
+        for query in self.queries:
+            if not query or not query.strip():
+                errors.append('empty query')
+        for lang, region in self.locales:
+            if not lang or not _LANGUAGE_RE.match(lang):
+                errors.append('invalid language code {!r}'.format(lang))
+            if region is not None and not _REGION_CODE_RE.match(region):
+                errors.append('invalid region code {!r}'.format(region))
+        for sources in self.sources:
+            if sources is not None:
+                if not sources:
+                    errors.append('empty list of sources; use None for automatic sources')
+                elif Sources.Automatic in sources:
+                    errors.append('list of sources contains Sources.Automatic')
+
+        # combinations are distinct alerts as long as the values of every
+        # dimension are, which is cheaper to check than the whole product
+        dimensions = [
+            ('query',   [ _normalize_query(query) for query in self.queries ]),
+            ('locale',  self.locales),
+            ('sources', [ tuple(sorted(s)) if s is not None else None for s in self.sources ]),
+        ]
+        for name, values in dimensions:
+            if not values:
+                errors.append('no {} given'.format(name))
+            elif len(set(values)) != len(values):
+                errors.append('repeated {}'.format(name))
+
+        if errors:
+            raise ValueError('Invalid alert template: ' + '; '.join(sorted(set(errors))))
+
+    def __len__(self):
+        return len(self.queries) * len(self.locales) * len(self.sources)
+
+    def __iter__(self):
+        for query in self.queries:
+            for lang, region in self.locales:
+                for sources in self.sources:
+                    yield AlertSpec(query, sources[:] if sources is not None else None, self.delivery,
+                                    self.frequency, self.volume, lang, region)
+
+def _normalize_query(query):
+    """
+    Return *query* lowercased with runs of whitespace collapsed. Byte
+    strings are taken to be UTF-8, like the queries sent to Google.
+    """
+    if query is None:
+        return u''
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    return u' '.join(query.lower().split())
+
+def alert_key(alert):
+    """
+    Return the settings that identify an alert, or the alert an
+    :class:`AlertSpec` would create: two alerts with the same key deliver the
+    same results the same way.
+    """
+    return (
+        _normalize_query(alert.query),
+        tuple(sorted(alert.sources)) if alert.sources is not None else None,
+        alert.delivery,
+        alert.frequency,
+        alert.volume,
+        alert.language,
+        alert.region if alert.region is not None else _REGION,
+    )
+
+def alert_fingerprint(alert):
+    """
+    Return a short string identifying the settings of *alert* (or of the
+    alert an :class:`AlertSpec` would create) that end up in the payload of
+    :meth:`GoogleAlertsManager._create_alert_data`: the query, sources,
+    volume, delivery, frequency, language and region, normalized as by
+    :func:`alert_key`. The delivery hour and weekday are not part of it.
+    """
+    key = json.dumps(alert_key(alert), separators=(',', ':'))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class FingerprintSet(object):
+    """
+    The fingerprints of the alerts of an account, used to skip creating
+    alerts that already exist.
+
+    Fingerprints are remembered per alert (by alert_id, or by the object
+    itself for an :class:`AlertSpec` whose alert was just created), so that
+    updating or deleting an alert forgets its old fingerprint even if the
+    alert object has been changed since, and a fingerprint shared by
+    duplicate alerts stays known until all of them are gone.
+    """
+    def __init__(self, alerts=()):
+        self._by_alert = {}
+        self._counts   = {}
+        for alert in alerts:
+            self.add(alert)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _key(self, alert):
+        return alert.alert_id if alert.alert_id is not None else alert
+
+    def add(self, alert, fingerprint=None):
+        """
+        Remember the fingerprint of *alert*, computing it unless given.
+        """
+        if fingerprint is None:
+            fingerprint = alert_fingerprint(alert)
+        self.discard(alert)
+        self._by_alert[self._key(alert)] = fingerprint
+        self._counts[fingerprint] = self._counts.get(fingerprint, 0) + 1
+
+    def discard(self, alert):
+        """
+        Forget the fingerprint remembered for *alert*, if any.
+        """
+        fingerprint = self._by_alert.pop(self._key(alert), None)
+        if fingerprint is None:
+            return
+        if self._counts[fingerprint] == 1:
+            del self._counts[fingerprint]
+        else:
+            self._counts[fingerprint] -= 1
+
+def _is_throttled(error):
+    """
+    Whether *error* means Google wants us to slow down.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in (429, 503)
+    if isinstance(error, UnexpectedResponseError):
+        return error.resp_status in (429, 503)
+    return False
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of concurrent requests made by the bulk operations of a
+    :class:`GoogleAlertsManager`, adapting the limit with additive increase
+    and multiplicative decrease (AIMD).
+
+    Every successful request raises the limit by *increase* / limit, i.e. by
+    *increase* for every limit's worth of successes. A throttled or failed
+    request, or one slower than *latency_target*, multiplies the limit by
+    *decrease*; further failures of requests that were already in flight at
+    that time don't reduce it again.
+
+    :attr:`limit`, :attr:`in_flight` and :meth:`throughput` report the current
+    state, and :meth:`stats` all of it at once.
+    """
+    def __init__(self, initial=2, minimum=1, maximum=32, increase=1.0, decrease=0.5,
+                 latency_target=None, max_retries=5, window=10.0):
+        """
+        :param latency_target: seconds; slower requests count as congestion.
+            ``None`` only reacts to throttling and errors.
+        :param max_retries: how many times a throttled request is retried
+        :param window: seconds over which :meth:`throughput` is measured
+        """
+        if not minimum <= initial <= maximum:
+            raise ValueError('Need minimum <= initial <= maximum')
+
+        self.minimum        = minimum
+        self.maximum        = maximum
+        self.increase       = increase
+        self.decrease       = decrease
+        self.latency_target = latency_target
+        self.max_retries    = max_retries
+        self.window         = window
+
+        self._limit     = float(initial)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        # requests started before this time don't cause another decrease
+        self._decreased_at = 0.0
+        self._completed    = deque()
+
+        self.succeeded = 0
+        self.throttled = 0
+        self.failed    = 0
+        self.latency   = None
+
+    @property
+    def limit(self):
+        """
+        The number of requests currently allowed in flight.
+        """
+        return max(self.minimum, min(self.maximum, int(self._limit)))
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        """
+        Wait until another request may be started.
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency, ok, throttled=False):
+        """
+        Record the outcome of a request that took *latency* seconds.
+        """
+        now = time.time()
+        with self._condition:
+            self._in_flight -= 1
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+            congested = not ok or (self.latency_target is not None and latency > self.latency_target)
+            if ok:
+                self.succeeded += 1
+                self._completed.append(now)
+            elif throttled:
+                self.throttled += 1
+            else:
+                self.failed += 1
+
+            if congested:
+                if now - latency >= self._decreased_at:
+                    self._limit = max(float(self.minimum), self._limit * self.decrease)
+                    self._decreased_at = now
+            else:
+                self._limit = min(float(self.maximum), self._limit + self.increase / self._limit)
+
+            self._condition.notify_all()
+
+    def retry_delay(self, attempt):
+        """
+        Seconds to wait before retrying a throttled request for the
+        *attempt*-th time.
+        """
+        return min(30.0, 0.5 * 2 ** (attempt - 1))
+
+    def throughput(self):
+        """
+        Successful requests per second over the last *window* seconds.
+        """
+        now = time.time()
+        with self._condition:
+            while self._completed and self._completed[0] < now - self.window:
+                self._completed.popleft()
+            return len(self._completed) / self.window
+
+    def stats(self):
+        return {
+            'limit':      self.limit,
+            'in_flight':  self.in_flight,
+            'throughput': self.throughput(),
+            'latency':    self.latency,
+            'succeeded':  self.succeeded,
+            'throttled':  self.throttled,
+            'failed':     self.failed,
+        }
+
+class DeliverySlotAllocator(object):
+    """
+    Spreads the delivery times of digest (daily and weekly) alerts over the
+    hours of the day and the days of the week.
+
+    Google sends digests at the hour (and, for weekly alerts, the weekday)
+    stored with each alert. Creating many alerts at once would otherwise give
+    them all the same slot. Each new alert gets the slot with the lowest load
+    relative to its weight, where a daily alert counts towards its hour on
+    every day of the week.
+
+    Pass the allocator to :class:`GoogleAlertsManager` as *slot_allocator*; it
+    is reset from the account's alerts on every refresh.
+    """
+    def __init__(self, hour_weights=None, weekday_weights=None):
+        """
+        :param hour_weights: 24 relative capacities of the hours 0-23 (UTC).
+            An hour with weight 0 is never used. Defaults to equal weights.
+        :param weekday_weights: 7 relative capacities of the weekdays, Sunday
+            first. Defaults to equal weights.
+        """
+        self.hour_weights    = list(hour_weights) if hour_weights is not None else [1] * 24
+        self.weekday_weights = list(weekday_weights) if weekday_weights is not None else [1] * 7
+
+        if len(self.hour_weights) != 24 or len(self.weekday_weights) != 7:
+            raise ValueError('Need 24 hour weights and 7 weekday weights')
+        if not any(self.hour_weights) or not any(self.weekday_weights):
+            raise ValueError('At least one hour and one weekday must have a positive weight')
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, alerts=()):
+        """
+        Forget all allocations and count the slots used by *alerts* instead.
+        """
+        with self._lock:
+            self._daily  = [0] * 24
+            self._weekly = [ [0] * 24 for _ in range(7) ]
+        for alert in alerts:
+            self.add(alert.frequency, alert.delivery_hour, alert.delivery_weekday)
+
+    def add(self, freq, hour, weekday=None):
+        """
+        Count an alert which is delivered at *hour* (and *weekday*).
+        """
+        if hour is None:
+            return
+        with self._lock:
+            if freq == Frequencies.OnceADay:
+                self._daily[hour] += 1
+            elif freq == Frequencies.OnceAWeek and weekday is not None:
+                self._weekly[weekday][hour] += 1
+
+    def _load(self, weekday, hour):
+        return self._daily[hour] + self._weekly[weekday][hour]
+
+    def allocate(self, freq):
+        """
+        Reserve the least loaded slot for an alert with frequency *freq*.
+
+        Returns the delivery_block to send to Google, or None for
+        as-it-happens alerts.
+        """
+        if freq == Frequencies.AsItHappens:
+            return None
+
+        with self._lock:
+            hours = [ h for h in range(24) if self.hour_weights[h] > 0 ]
+
+            if freq == Frequencies.OnceAWeek:
+                weekdays = [ d for d in range(7) if self.weekday_weights[d] > 0 ]
+                # between equally loaded slots, prefer the least busy weekday
+                weekday_loads = dict((d, sum(self._weekly[d]) / float(self.weekday_weights[d])) for d in weekdays)
+                weekday, hour = min(
+                    ((d, h) for d in weekdays for h in hours),
+                    key=lambda (d, h): ((self._load(d, h) + 1.0) / (self.hour_weights[h] * self.weekday_weights[d]),
+                                        weekday_loads[d]))
+                self._weekly[weekday][hour] += 1
+                return [ None, None, hour, weekday ]
+
+            hour = min(hours, key=lambda h: (sum(self._load(d, h) for d in range(7)) + 7.0) / self.hour_weights[h])
+            self._daily[hour] += 1
+            return [ None, None, hour ]
+
+    def release(self, freq, block):
+        """
+        Give back a slot returned by :meth:`allocate`, e.g. when creating the
+        alert failed.
+        """
+        if block is None:
+            return
+        with self._lock:
+            hour = block[2]
+            if freq == Frequencies.OnceADay and self._daily[hour]:
+                self._daily[hour] -= 1
+            elif freq == Frequencies.OnceAWeek and len(block) > 3 and self._weekly[block[3]][hour]:
+                self._weekly[block[3]][hour] -= 1
+
+    def histogram(self):
+        """
+        Return the number of digests delivered in each slot as a list of 7
+        lists (Sunday first) of 24 counts.
+        """
+        with self._lock:
+            return [ [ self._load(d, h) for h in range(24) ] for d in range(7) ]
+
+    def report(self):
+        """
+        Return the slot histogram as a printable table with one row per hour
+        and one column per weekday.
+        """
+        histogram = self.histogram()
+        lines = [ 'Hour ' + ''.join(day.rjust(6) for day in ('Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat')) ]
+        for hour in range(24):
+            lines.append('%02d:00' % hour + ''.join(str(histogram[d][hour]).rjust(6) for d in range(7)))
+        return '\n'.join(lines)
+
+class WriteBehindQueue(object):
+    """
+    Queues alert mutations and sends them to Google in batches.
+
+    Pending changes are coalesced per alert: several updates of the same alert
+    result in a single request with its latest values, a delete supersedes
+    queued updates, and a create that is deleted before being flushed is never
+    sent at all.
+
+    The queue is flushed when it holds *max_pending* alerts, *max_delay*
+    seconds after the first change was queued, or explicitly by :meth:`flush`.
+    When a flush by the timer fails, it is retried after twice the delay, up
+    to *max_retry_delay* seconds, and the error is kept in
+    :attr:`last_error` until a flush succeeds.
+    """
+    def __init__(self, manager, max_pending=50, max_delay=5.0, max_retry_delay=300.0):
+        self.manager         = manager
+        self.max_pending     = max_pending
+        self.max_delay       = max_delay
+        self.max_retry_delay = max_retry_delay
+        self.last_error      = None
+
+        # key -> (operation, alert) in the order the keys were first queued.
+        # The key is the alert_id for existing alerts and the AlertSpec
+        # object itself for queued creates.
+        self._pending = OrderedDict()
+        self._lock    = threading.RLock()
+        self._timer   = None
+        # the delay of the next timer flush after one failed
+        self._retry_delay = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _key(self, alert):
+        return alert if isinstance(alert, AlertSpec) else alert.alert_id
+
+    def _enqueue(self, key, op, alert):
+        with self._lock:
+            self._pending[key] = (op, alert)
+
+            if self.max_pending is not None and len(self._pending) >= self.max_pending:
+                self.flush()
+            elif self.max_delay is not None and self._timer is None:
+                self._start_timer(self.max_delay)
+
+    def _start_timer(self, delay):
+        self._timer = threading.Timer(delay, self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def create(self, spec):
+        self._enqueue(spec, 'create', spec)
+        return spec
+
+    def update(self, alert):
+        with self._lock:
+            key = self._key(alert)
+            op = self._pending[key][0] if key in self._pending else None
+
+            if op == 'delete':
+                raise ValueError('Alert {} is queued for deletion'.format(alert.alert_id))
+
+            if isinstance(alert, AlertSpec):
+                if op != 'create':
+                    raise ValueError('Alert has already been created or deleted')
+                # creates are sent with the values the AlertSpec has at
+                # flush time, so there's nothing more to do
+                return
+
+            # snapshot the alert so later changes by the caller don't leak
+            # into the queued update
+            self._enqueue(key, 'update', copy.copy(alert))
+
+    def delete(self, alert):
+        with self._lock:
+            key = self._key(alert)
+            if key in self._pending and self._pending[key][0] == 'create':
+                del self._pending[key]
+                return
+            if isinstance(alert, AlertSpec):
+                raise ValueError('Alert has already been created or deleted')
+            self._enqueue(key, 'delete', alert)
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+            try:
+                self.flush()
+            except Exception:
+                # the failed changes stay queued and are retried with backoff;
+                # flush recorded the error in last_error
+                delay = self._retry_delay if self._retry_delay is not None else self.max_delay
+                self._retry_delay = min(delay * 2, self.max_retry_delay)
+                if self._timer is None:
+                    self._start_timer(delay)
+
+    def flush(self):
+        """
+        Send all queued changes in the order they were first queued.
+
+        If a request fails, the change that failed and every change after it
+        stay queued, the error is kept in :attr:`last_error` and raised.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            senders = {
+                'create': self.manager._send_create,
+                'update': self.manager._send_update,
+                'delete': self.manager._send_delete,
+            }
+            while self._pending:
+                key, (op, alert) = next(iter(self._pending.items()))
+                try:
+                    senders[op](alert)
+                except Exception as e:
+                    self.last_error = e
+                    raise
+                del self._pending[key]
+            self.last_error   = None
+            self._retry_delay = None
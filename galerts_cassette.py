@@ -0,0 +1,221 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Recording and replaying the HTTP traffic of a manager.
+
+A :class:`RecordingOpener` passes requests on to Google and writes every
+request and response to a cassette file. A :class:`ReplayOpener` serves the
+responses from a cassette instead, so tests and benchmarks of signing in,
+refreshing and mutating alerts can run offline and repeatably::
+
+    >>> with Cassette('signin.json') as cassette:
+    ...     gam = GoogleAlertsManager(email, password, opener=RecordingOpener(cassette))
+    ...     gam.create('Corner Confectionery')
+
+    >>> cassette = Cassette('signin.json')
+    >>> gam = GoogleAlertsManager(email, 'unused', opener=ReplayOpener(cassette, latency='recorded'))
+
+Passwords in sign in requests and cookies in responses are not written to
+cassettes.
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import base64
+import urllib2
+import mimetools
+import threading
+from StringIO import StringIO
+
+_PASSWORD_RE = re.compile(r'(^|&)(Passwd=)[^&]*')
+
+class CassetteError(Exception):
+    """
+    Raised when a request is replayed that the cassette has no (more)
+    responses for.
+    """
+
+class Cassette(object):
+    """
+    The list of recorded interactions, stored as JSON in the file *path*.
+
+    Use it as a context manager to save it when recording is done, or call
+    :meth:`save`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.interactions = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.interactions = json.load(f)['interactions']
+        self._lock = threading.Lock()
+
+    def append(self, interaction):
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({ 'interactions': self.interactions }, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+class CassetteResponse(object):
+    """
+    A response read from or replayed into a cassette. It has the methods of
+    the responses returned by :func:`urllib2.urlopen` that galerts uses.
+    """
+    def __init__(self, url, status, headers, body):
+        self.url     = url
+        self.code    = status
+        self.headers = mimetools.Message(StringIO(''.join(headers)))
+        self.fp      = StringIO(body)
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def close(self):
+        self.fp.close()
+
+def _encode_body(body):
+    try:
+        return { 'text': body.decode('utf-8') }
+    except UnicodeDecodeError:
+        return { 'base64': base64.b64encode(body) }
+
+def _decode_body(encoded):
+    if 'text' in encoded:
+        return encoded['text'].encode('utf-8')
+    return base64.b64decode(encoded['base64'])
+
+def _scrub_headers(headers):
+    return [ re.sub(r'^(Set-Cookie:\s*[^=]*=)[^;\r\n]*', r'\1REDACTED', header, flags=re.I)
+             for header in headers ]
+
+class RecordingOpener(object):
+    """
+    Makes requests through a real opener and records them into a cassette.
+    """
+    def __init__(self, cassette, opener=None):
+        """
+        :param opener: the opener that actually makes the requests. Defaults
+            to a new opener with a cookie jar.
+        """
+        self.cassette = cassette
+        self.opener   = opener if opener is not None else urllib2.build_opener(urllib2.HTTPCookieProcessor())
+
+    def open(self, url, data=None, timeout=None):
+        started = time.time()
+        kwargs = { 'timeout': timeout } if timeout is not None else {}
+        try:
+            response = self.opener.open(url, data, **kwargs)
+            error = None
+        except urllib2.HTTPError as e:
+            # an HTTPError is also a response
+            response = error = e
+        body = response.read()
+        elapsed = time.time() - started
+
+        headers = list(response.info().headers)
+        self.cassette.append({
+            'method':    'POST' if data is not None else 'GET',
+            'url':       url,
+            'request':   _encode_body(_PASSWORD_RE.sub(r'\1\2********', data)) if data is not None else None,
+            'status':    response.getcode(),
+            'final_url': response.geturl(),
+            'headers':   _scrub_headers(headers),
+            'response':  _encode_body(body),
+            'elapsed':   elapsed,
+        })
+
+        if error is not None:
+            raise urllib2.HTTPError(url, error.code, error.msg, error.hdrs, StringIO(body))
+        return CassetteResponse(response.geturl(), response.getcode(), headers, body)
+
+class ReplayOpener(object):
+    """
+    Serves the responses of a cassette.
+
+    Requests are matched by method and URL, and repeated requests get the
+    recorded responses in order. Request bodies are not compared by default
+    since they can legitimately differ between runs (e.g. delivery hours).
+    """
+    def __init__(self, cassette, latency=None, match_body=False):
+        """
+        :param latency: ``None`` to respond immediately, ``'recorded'`` to
+            wait as long as the original request took, a number of seconds to
+            wait for every request, or a function returning the seconds to
+            wait for a given interaction dict. Requests whose timeout is
+            shorter than their latency raise :exc:`socket.timeout`.
+        :param match_body: also require the request bodies to match
+        """
+        self.match_body = match_body
+        self.latency    = latency
+        self._lock      = threading.Lock()
+        self._queues    = {}
+        for interaction in cassette.interactions:
+            self._queues.setdefault(self._key(interaction['method'], interaction['url'], interaction['request']),
+                                    []).append(interaction)
+
+    def _key(self, method, url, request):
+        if self.match_body:
+            return (method, url, json.dumps(request, sort_keys=True))
+        return (method, url)
+
+    def _delay(self, interaction):
+        if self.latency is None:
+            return 0
+        if self.latency == 'recorded':
+            return interaction['elapsed']
+        if callable(self.latency):
+            return self.latency(interaction)
+        return self.latency
+
+    def open(self, url, data=None, timeout=None):
+        method = 'POST' if data is not None else 'GET'
+        request = _encode_body(_PASSWORD_RE.sub(r'\1\2********', data)) if data is not None else None
+        with self._lock:
+            queue = self._queues.get(self._key(method, url, request))
+            if not queue:
+                raise CassetteError('No recorded response for {} {}'.format(method, url))
+            interaction = queue.pop(0)
+
+        delay = self._delay(interaction)
+        if timeout is not None and delay > timeout:
+            # like a server that doesn't answer in time
+            time.sleep(timeout)
+            raise socket.timeout('timed out')
+        if delay:
+            time.sleep(delay)
+
+        body = _decode_body(interaction['response'])
+        if interaction['status'] >= 400:
+            headers = mimetools.Message(StringIO(''.join(interaction['headers'])))
+            raise urllib2.HTTPError(url, interaction['status'], '', headers, StringIO(body))
+        return CassetteResponse(interaction['final_url'], interaction['status'], interaction['headers'], body)
+
+    def remaining(self):
+        """
+        Return the number of recorded interactions that have not been replayed.
+        """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
@@ -0,0 +1,322 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A columnar view of an alert inventory for analytics, built on NumPy.
+
+Reports over many alerts (counts by language, volume or source, coverage of
+queries across accounts, ...) are much faster on one integer array per
+attribute than on lists of :class:`galerts2.Alert` objects. Strings such as
+queries and ids are stored once in a :class:`StringTable` and represented by
+their codes::
+
+    >>> columns = gam.window_state.columns()
+    >>> columns.count_by('language', delivery=DeliveryTypes.Feed)
+    {u'en': 120, u'de': 12}
+    >>> everything = AlertColumns.from_window_states(m.window_state for m in managers)
+    >>> everything.count_by('account_id', 'volume')
+    {(u'0123', 3): 981, (u'0123', 2): 19, ...}
+
+This module needs NumPy (``pip install galerts[analytics]``).
+"""
+
+import numpy as np
+from galerts2 import Alert, Sources
+
+# columns holding strings, stored as codes into the string table
+_STRING_COLUMNS = ('alert_id', 'account_id', 'query', 'language', 'region', 'email', 'feed_id', 'feed_url')
+
+# columns holding small integers; None is stored as -1
+_INTEGER_COLUMNS = ('volume', 'frequency', 'delivery', 'delivery_hour', 'delivery_weekday')
+
+# the code of None in string columns and its value in integer columns
+_MISSING = -1
+
+class StringTable(object):
+    """
+    Maps strings to consecutive integer codes and back.
+    """
+    def __init__(self):
+        self.strings = []
+        self._codes  = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def code(self, value):
+        """
+        Return the code of *value*, adding it to the table if necessary.
+        """
+        if value is None:
+            return _MISSING
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def find(self, value):
+        """
+        Return the code of *value*, or ``None`` if it isn't in the table.
+        """
+        if value is None:
+            return _MISSING
+        return self._codes.get(value)
+
+    def decode(self, code):
+        return self.strings[code] if code != _MISSING else None
+
+    def translation(self, other):
+        """
+        Return an array mapping the codes of the table *other* to codes of
+        this table, adding its strings to this table.
+        """
+        return np.array([ self.code(value) for value in other.strings ] or [ 0 ], dtype=np.int32)
+
+def _unique_rows(keys):
+    """
+    Return (unique, inverse, counts) for the rows of the integer array
+    *keys*, like ``np.unique(keys, axis=0, ...)``. When the values fit, the
+    columns are packed into a single int64 per row first, which is much
+    faster to sort.
+    """
+    low = keys.min(axis=0)
+    spans = keys.max(axis=0) - low + 1
+    if np.prod(spans.astype(float)) >= 2 ** 62:
+        return np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+
+    packed = np.zeros(len(keys), dtype=np.int64)
+    for i in range(keys.shape[1]):
+        packed = packed * spans[i] + (keys[:, i] - low[i])
+    packed_unique, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+
+    unique = np.empty((len(packed_unique), keys.shape[1]), dtype=np.int64)
+    for i in reversed(range(keys.shape[1])):
+        unique[:, i] = packed_unique % spans[i] + low[i]
+        packed_unique = packed_unique // spans[i]
+    return unique, inverse, counts
+
+def _sources_mask(sources):
+    """
+    Return the sources of an alert as a bit mask with bit *v* set for the
+    source value *v*. Automatic sources (``None``) are 0.
+    """
+    mask = 0
+    for source in sources or ():
+        mask |= 1 << source
+    return mask
+
+class AlertColumns(object):
+    """
+    The alerts of one or more accounts as one NumPy array per attribute.
+
+    String attributes are int32 codes into :attr:`table`, integer attributes
+    are int16 arrays and ``sources`` is an int64 bit mask per alert, with bit
+    *v* set for the source value *v* and 0 for automatic sources.
+    """
+    def __init__(self, table, columns):
+        self.table   = table
+        self.columns = columns
+
+    @classmethod
+    def from_alerts(cls, alerts, table=None):
+        """
+        Build the columns of the :class:`galerts2.Alert` objects *alerts*.
+        """
+        table = table if table is not None else StringTable()
+        values = dict((name, []) for name in _STRING_COLUMNS + _INTEGER_COLUMNS + ('sources',))
+        for alert in alerts:
+            for name in _STRING_COLUMNS:
+                values[name].append(table.code(getattr(alert, name)))
+            for name in _INTEGER_COLUMNS:
+                value = getattr(alert, name)
+                values[name].append(value if value is not None else _MISSING)
+            values['sources'].append(_sources_mask(alert.sources))
+
+        columns = {}
+        for name in _STRING_COLUMNS:
+            columns[name] = np.array(values[name], dtype=np.int32)
+        for name in _INTEGER_COLUMNS:
+            columns[name] = np.array(values[name], dtype=np.int16)
+        columns['sources'] = np.array(values['sources'], dtype=np.int64)
+        return cls(table, columns)
+
+    @classmethod
+    def from_window_states(cls, window_states):
+        """
+        Build the columns of the alerts of several accounts, sharing one
+        string table.
+        """
+        table = StringTable()
+        return cls.concat([ cls.from_alerts(state.alerts, table) for state in window_states ])
+
+    @classmethod
+    def concat(cls, views):
+        """
+        Return the rows of all *views* in one :class:`AlertColumns`. Views
+        with different string tables are recoded into a new table.
+        """
+        views = list(views)
+        if not views:
+            return cls.from_alerts([])
+
+        table = views[0].table
+        parts = dict((name, []) for name in views[0].columns)
+        for view in views:
+            translation = None
+            if view.table is not table:
+                translation = table.translation(view.table)
+            for name, column in view.columns.items():
+                if translation is not None and name in _STRING_COLUMNS:
+                    column = np.where(column == _MISSING, _MISSING, translation[np.maximum(column, 0)])
+                parts[name].append(column)
+        return cls(table, dict((name, np.concatenate(arrays).astype(views[0].columns[name].dtype))
+                               for (name, arrays) in parts.items()))
+
+    def __len__(self):
+        return len(self.columns['alert_id'])
+
+    def _codes(self, name, value):
+        """
+        Return the stored representation of *value* in column *name*, or
+        ``None`` if no row can have it.
+        """
+        if name in _STRING_COLUMNS:
+            return self.table.find(value)
+        return value if value is not None else _MISSING
+
+    def mask(self, **filters):
+        """
+        Return a boolean array selecting the rows matching all *filters*.
+
+        Filters name a column and give a value or a list of values. The
+        filter *source* selects alerts with that source among their sources
+        (not automatic ones), and *sources* compares whole lists.
+        """
+        selected = np.ones(len(self), dtype=bool)
+        for name, value in filters.items():
+            if name == 'source':
+                selected &= (self.columns['sources'] & np.int64(1 << value)) != 0
+                continue
+            if name == 'sources':
+                selected &= self.columns['sources'] == _sources_mask(value)
+                continue
+            if name not in self.columns:
+                raise ValueError('Unknown column: ' + name)
+
+            values = value if isinstance(value, (list, tuple, set, frozenset)) else [ value ]
+            codes = [ code for code in (self._codes(name, v) for v in values) if code is not None ]
+            selected &= np.in1d(self.columns[name], codes)
+        return selected
+
+    def take(self, indices):
+        """
+        Return the rows at *indices* (an integer or boolean array) as a new
+        :class:`AlertColumns` sharing this one's string table.
+        """
+        return type(self)(self.table, dict((name, column[indices]) for (name, column) in self.columns.items()))
+
+    def filter(self, **filters):
+        """
+        Return the rows matching *filters* (see :meth:`mask`).
+        """
+        return self.take(self.mask(**filters))
+
+    def decode(self, name, codes):
+        """
+        Turn stored values of column *name* back into attribute values.
+        """
+        if name in _STRING_COLUMNS:
+            return [ self.table.decode(code) for code in codes ]
+        if name == 'sources':
+            return [ [ bit for bit in range(63) if mask & (1 << bit) ] or None for mask in codes ]
+        return [ int(value) if value != _MISSING else None for value in codes ]
+
+    def count_by(self, *names, **filters):
+        """
+        Count the rows matching *filters* grouped by the columns *names*.
+
+        Returns a dict mapping values (tuples of values for more than one
+        column) to counts. Grouping by ``'source'`` counts every source of
+        an alert, with automatic sources counted as :attr:`Sources.Automatic`.
+        """
+        view = self.filter(**filters) if filters else self
+        if names == ('source',):
+            masks = view.columns['sources']
+            counts = { Sources.Automatic: int(np.count_nonzero(masks == 0)) }
+            for bit in range(63):
+                count = int(np.count_nonzero(masks & np.int64(1 << bit)))
+                if count:
+                    counts[bit] = count
+            return dict((value, count) for (value, count) in counts.items() if count)
+        if not names or 'source' in names:
+            raise ValueError("count_by needs columns to group by; 'source' can only be used alone")
+
+        keys = np.stack([ view.columns[name].astype(np.int64) for name in names ], axis=1)
+        if not len(keys):
+            return {}
+        unique, _, counts = _unique_rows(keys)
+        decoded = [ view.decode(name, unique[:, i]) for (i, name) in enumerate(names) ]
+        if len(names) == 1:
+            return dict(zip(decoded[0], counts.tolist()))
+        return dict(zip(zip(*decoded), counts.tolist()))
+
+    def _keys(self, names, table):
+        """
+        Return the values of columns *names* as an (n, len(names)) array,
+        with strings coded by *table*.
+        """
+        translation = table.translation(self.table) if table is not self.table else None
+        columns = []
+        for name in names:
+            column = self.columns[name].astype(np.int64)
+            if translation is not None and name in _STRING_COLUMNS:
+                column = np.where(column == _MISSING, _MISSING, translation[np.maximum(column, 0)])
+            columns.append(column)
+        return np.stack(columns, axis=1) if columns else np.zeros((len(self), 0), dtype=np.int64)
+
+    def join(self, other, on=('query', 'language', 'region')):
+        """
+        Pair the rows of this view and *other* that have the same values in
+        the columns *on*, e.g. the same alert in two accounts.
+
+        Returns two index arrays (left, right) such that row left[i] of this
+        view matches row right[i] of *other*; rows matching several rows give
+        a pair for each.
+        """
+        on = list(on)
+        left = self._keys(on, self.table)
+        right = other._keys(on, self.table)
+        if not len(left) or not len(right):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        # one integer per distinct key, then a sort-merge of the two sides
+        _, inverse, _ = _unique_rows(np.concatenate([ left, right ]))
+        left_keys, right_keys = inverse[:len(left)], inverse[len(left):]
+
+        order = np.argsort(right_keys, kind='mergesort')
+        sorted_right = right_keys[order]
+        starts = np.searchsorted(sorted_right, left_keys, side='left')
+        ends = np.searchsorted(sorted_right, left_keys, side='right')
+        counts = ends - starts
+
+        left_indices = np.repeat(np.arange(len(left)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        right_indices = order[np.repeat(starts, counts) + offsets]
+        return left_indices, right_indices
+
+    def rows(self):
+        """
+        Return the rows as dicts of attribute values, like
+        :meth:`galerts2.Alert.as_dict`.
+        """
+        decoded = dict((name, self.decode(name, column)) for (name, column) in self.columns.items())
+        return [ dict((name, decoded[name][i]) for name in decoded) for i in range(len(self)) ]
+
+    def alerts(self):
+        """
+        Return the rows as :class:`galerts2.Alert` objects, e.g. to pass a
+        filtered selection to :meth:`galerts2.GoogleAlertsManager.delete_many`.
+        """
+        return [ Alert.from_dict(row) for row in self.rows() ]
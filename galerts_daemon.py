@@ -0,0 +1,305 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A long-running process that keeps signed-in managers and their alerts in
+memory and serves them to local clients over a small HTTP/JSON API.
+
+Many scripts can then share a single warm session per account instead of each
+signing in and scraping the alerts page itself. The API is::
+
+    GET    /accounts                              emails of the accounts
+    GET    /accounts/<email>/alerts               all alerts (?refresh=1 to
+                                                  skip the cache)
+    GET    /accounts/<email>/alerts/<alert_id>    a single alert
+    POST   /accounts/<email>/alerts               create an alert from the
+                                                  JSON body
+    PUT    /accounts/<email>/alerts/<alert_id>    update the fields of the
+                                                  alert given in the JSON body
+    DELETE /accounts/<email>/alerts/<alert_id>    delete an alert
+
+Alerts are returned as the objects produced by :meth:`galerts2.Alert.as_dict`.
+POST and PUT take the same names for the fields that can be set: query,
+sources, delivery, frequency, volume, language and region.
+
+Errors are returned as ``{"error": ...}`` objects with status 400 for bad
+requests, 404 for unknown accounts and alerts, 409 when creating an alert the
+account already has, 502 if Google answered with an
+error or couldn't be reached, 504 if it didn't answer in time and 500 for
+anything else.
+
+The daemon listens on a TCP address or on a Unix socket::
+
+    $ python galerts_daemon.py --credentials accounts.json --socket /tmp/galerts.sock
+
+where accounts.json holds a list of {"email": ..., "password": ...} objects.
+"""
+
+import re
+import json
+import time
+import Queue
+import socket
+import urllib2
+import urlparse
+import threading
+from galerts2 import (GoogleAlertsManager, AlertSpec, UnexpectedResponseError, BulkOperationError,
+                     DeadlineExceededError, CancelledError)
+from galerts_server import RequestHandler, add_address_arguments, address_from_args, serve
+from galerts_server import make_server as _make_server
+
+_ALERTS_PATH_RE = re.compile(r'^/accounts/([^/]+)/alerts(?:/([^/]+))?/?$')
+
+# fields of an alert that can be set with POST and PUT
+_ALERT_FIELDS = ('query', 'sources', 'delivery', 'frequency', 'volume', 'language', 'region')
+
+# the arguments of galerts2.AlertSpec the fields other than the query go to
+_SPEC_ARGUMENTS = {
+    'sources':   'sources',
+    'delivery':  'delivery',
+    'frequency': 'freq',
+    'volume':    'vol',
+    'language':  'lang',
+    'region':    'region',
+}
+
+class NotFoundError(Exception):
+    """
+    Raised for an account or alert the daemon doesn't serve.
+    """
+
+def _check_fields(params):
+    unknown = set(params) - set(_ALERT_FIELDS)
+    if unknown:
+        raise ValueError('Unknown fields: ' + ', '.join(sorted(unknown)))
+
+class _Account(object):
+    """
+    A signed-in manager, the time its window state was last fetched, and the
+    worker thread that runs its mutations one at a time.
+    """
+    def __init__(self, manager, max_age):
+        self.manager    = manager
+        self.max_age    = max_age
+        self.lock       = threading.RLock()
+        self.fetched_at = time.time()
+        self.stale      = False
+        self.mutations  = Queue.Queue()
+
+        worker = threading.Thread(target=self._run_mutations)
+        worker.daemon = True
+        worker.start()
+
+    def window_state(self, refresh=False):
+        """
+        Return the cached window state, fetching it again if it is older than
+        *max_age*, has been invalidated by a mutation or *refresh* is set.
+        """
+        with self.lock:
+            if refresh or self.stale or time.time() - self.fetched_at > self.max_age:
+                self.manager.refresh()
+                self.fetched_at = time.time()
+                self.stale = False
+            return self.manager.window_state
+
+    def mutate(self, func, *args):
+        """
+        Run func(*args) on the mutation worker and wait for it. Returns the
+        result or raises what func raised.
+        """
+        done = threading.Event()
+        outcome = {}
+        self.mutations.put((func, args, done, outcome))
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('result')
+
+    def _run_mutations(self):
+        while True:
+            func, args, done, outcome = self.mutations.get()
+            try:
+                with self.lock:
+                    outcome['result'] = func(*args)
+                    self.stale = True
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+class AlertsDaemon(object):
+    """
+    Holds the signed-in accounts served by the daemon.
+    """
+    def __init__(self, managers=(), max_age=60):
+        """
+        :param managers: :class:`galerts2.GoogleAlertsManager` objects to serve
+        :param max_age: seconds for which a fetched window state is served from
+            memory before it is fetched again
+        """
+        self.max_age = max_age
+        self.accounts = {}
+        for manager in managers:
+            self.add(manager)
+
+    def add(self, manager):
+        self.accounts[manager.email] = _Account(manager, self.max_age)
+
+    def sign_in(self, email, password):
+        """
+        Sign in to another account and serve it.
+        """
+        self.add(GoogleAlertsManager(email, password))
+
+    def _account(self, email):
+        if '@' not in email:
+            email += '@gmail.com'
+        account = self.accounts.get(email)
+        if account is None:
+            raise NotFoundError('Unknown account: ' + email)
+        return account
+
+    def list_alerts(self, email, refresh=False):
+        return self._account(email).window_state(refresh).alerts
+
+    def get_alert(self, email, alert_id):
+        for alert in self.list_alerts(email):
+            if alert.alert_id == alert_id:
+                return alert
+        raise NotFoundError('Unknown alert: ' + alert_id)
+
+    def create(self, email, params):
+        """
+        Create an alert from the fields *params*. Returns whether it was
+        created, ``False`` if the account already has an alert with these
+        settings.
+        """
+        _check_fields(params)
+        if 'query' not in params:
+            raise ValueError('An alert needs a query')
+        # AlertSpec fills in the defaults and checks the combination
+        spec = AlertSpec(params['query'], **dict((_SPEC_ARGUMENTS[field], value)
+                                                 for (field, value) in params.items() if field != 'query'))
+        account = self._account(email)
+        created = account.mutate(account.manager.create, spec.query, spec.sources, spec.delivery, spec.frequency,
+                                 spec.volume, spec.language, spec.region)
+        return created is not False
+
+    def update(self, email, alert_id, params):
+        _check_fields(params)
+        alert = self.get_alert(email, alert_id)
+        alert = type(alert).from_dict(alert.as_dict())
+        for field, value in params.items():
+            setattr(alert, field, value)
+        account = self._account(email)
+        account.mutate(account.manager.update, alert)
+
+    def delete(self, email, alert_id):
+        alert = self.get_alert(email, alert_id)
+        account = self._account(email)
+        account.mutate(account.manager.delete, alert)
+
+class _RequestHandler(RequestHandler):
+
+    def _send_json(self, status, value=None):
+        body = json.dumps(value) if value is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _dispatch(self, method):
+        daemon = self.server.alerts_daemon
+        url = urlparse.urlparse(self.path)
+        try:
+            if url.path.rstrip('/') == '/accounts' and method == 'GET':
+                return self._send_json(200, sorted(daemon.accounts))
+
+            match = _ALERTS_PATH_RE.match(url.path)
+            if match is None:
+                return self._send_json(404, { 'error': 'Not found' })
+            email, alert_id = urlparse.unquote(match.group(1)), match.group(2)
+
+            if method == 'GET' and alert_id is None:
+                refresh = urlparse.parse_qs(url.query).get('refresh', ['0'])[0] not in ('', '0')
+                return self._send_json(200, [ alert.as_dict() for alert in daemon.list_alerts(email, refresh) ])
+            if method == 'GET':
+                return self._send_json(200, daemon.get_alert(email, alert_id).as_dict())
+            if method == 'POST' and alert_id is None:
+                if not daemon.create(email, self._read_json()):
+                    return self._send_json(409, { 'error': 'The account already has this alert' })
+                return self._send_json(201, {})
+            if method == 'PUT' and alert_id is not None:
+                daemon.update(email, alert_id, self._read_json())
+                return self._send_json(200, {})
+            if method == 'DELETE' and alert_id is not None:
+                daemon.delete(email, alert_id)
+                return self._send_json(200, {})
+            return self._send_json(405, { 'error': 'Method not allowed' })
+        except NotFoundError as e:
+            return self._send_json(404, { 'error': str(e) })
+        except (ValueError, TypeError) as e:
+            return self._send_json(400, { 'error': str(e) })
+        except UnexpectedResponseError as e:
+            return self._send_json(502, { 'error': 'Google responded with ' + str(e.resp_status) })
+        except DeadlineExceededError as e:
+            return self._send_json(504, { 'error': 'Google didn\'t respond in time: ' + str(e) })
+        except CancelledError:
+            return self._send_json(504, { 'error': 'The request to Google was cancelled' })
+        except (urllib2.URLError, socket.error) as e:
+            return self._send_json(502, { 'error': 'Couldn\'t reach Google: ' + str(e) })
+        except BulkOperationError as e:
+            return self._send_json(500, { 'error': str(e) })
+        except Exception as e:
+            # answer anyway, the client would only see the connection drop
+            self.log_error('%s failed: %r', method, e)
+            return self._send_json(500, { 'error': 'Internal error: ' + repr(e) })
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+def make_server(daemon, address):
+    """
+    Create a server for *daemon* listening on *address*, which is either a
+    (host, port) tuple or the path of a Unix socket. Call ``serve_forever()``
+    on the result to start serving.
+    """
+    return _make_server(address, _RequestHandler, alerts_daemon=daemon)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve Google Alerts accounts over a local JSON API.')
+    parser.add_argument('--credentials', required=True,
+                        help='JSON file with a list of {"email": ..., "password": ...} objects')
+    add_address_arguments(parser, '127.0.0.1:8765')
+    parser.add_argument('--max-age', type=float, default=60,
+                        help='seconds to serve alerts from memory before fetching them again')
+    args = parser.parse_args()
+
+    daemon = AlertsDaemon(max_age=args.max_age)
+    with open(args.credentials) as f:
+        for credentials in json.load(f):
+            daemon.sign_in(credentials['email'], credentials['password'])
+
+    server = make_server(daemon, address_from_args(args))
+    serve(server)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A caching proxy for alert feeds, shared by local services that read the same
+feeds.
+
+The proxy serves feeds under the same paths as Google
+(``/alerts/feeds/<account_id>/<feed_id>``) from a :class:`FeedCache`, which
+fetches every feed from Google at most once per interval no matter how many
+clients ask for it. Clients asking for a feed that is being fetched wait for
+that fetch instead of starting their own, and clients sending
+``If-None-Match`` or ``If-Modified-Since`` get a 304 when the feed hasn't
+changed::
+
+    $ python galerts_feedproxy.py --listen 127.0.0.1:8766 --interval 300
+
+    >>> url = proxy_url(alert, 'http://127.0.0.1:8766')
+    >>> items = parse_feed(urllib2.urlopen(url).read(), alert.alert_id)
+
+Like :mod:`galerts_daemon`, the proxy listens on a TCP address or on a Unix
+socket, through :mod:`galerts_server`.
+"""
+
+import re
+import time
+import hashlib
+import urllib2
+import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from galerts2 import UnexpectedResponseError, feed_url
+from galerts_server import RequestHandler, add_address_arguments, address_from_args, serve
+from galerts_server import make_server as _make_server
+
+_FEED_PATH_RE = re.compile(r'^/alerts/feeds/([^/?]+)/([^/?]+)/?$')
+
+class CachedFeed(object):
+    """
+    The cached body of a feed and the validators served with it.
+    """
+    def __init__(self, body, fetched_at):
+        self.body = body
+        # when the body was last confirmed by Google, and when it last changed
+        self.fetched_at  = fetched_at
+        self.modified_at = fetched_at
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+        # validators sent by Google, used for conditional upstream requests
+        self.upstream_etag          = None
+        self.upstream_last_modified = None
+
+    def not_modified(self, if_none_match=None, if_modified_since=None):
+        """
+        Return whether a client that sent the given conditional headers
+        already has this version of the feed. ``If-None-Match`` takes
+        precedence over ``If-Modified-Since``.
+        """
+        if if_none_match is not None:
+            tags = [ tag.strip() for tag in if_none_match.split(',') ]
+            return '*' in tags or self.etag in tags or 'W/' + self.etag in tags
+        if if_modified_since is not None:
+            parsed = parsedate_tz(if_modified_since)
+            return parsed is not None and int(self.modified_at) <= mktime_tz(parsed)
+        return False
+
+class _Slot(object):
+    """
+    The cache entry of one feed: the cached feed, if any, and the fetch in
+    progress that other requests for the feed wait on.
+    """
+    def __init__(self):
+        self.feed       = None
+        self.checked_at = None
+        self.error      = None
+        self.fetching   = None
+
+class FeedCache(object):
+    """
+    Feed bodies keyed by (account_id, feed_id), each fetched from Google at
+    most once per *interval* seconds.
+    """
+    def __init__(self, interval=300.0, opener=None, timeout=30):
+        """
+        :param interval: seconds for which a fetched feed is served before it
+            is fetched again
+        :param opener: the opener used to fetch feeds
+        :param timeout: seconds to wait for Google
+        """
+        self.interval = interval
+        self.opener   = opener if opener is not None else urllib2.build_opener()
+        self.timeout  = timeout
+        self.upstream_requests = 0
+        self._slots = {}
+        self._lock  = threading.Lock()
+
+    def get(self, account_id, feed_id):
+        """
+        Return the :class:`CachedFeed` of the feed, fetching it first if it
+        wasn't fetched in the last *interval* seconds.
+
+        When Google fails and an older copy of the feed is cached, the old
+        copy is returned; the feed is only asked for again after another
+        *interval*.
+
+        :raises UnexpectedResponseError: if Google doesn't answer with the
+            feed and nothing is cached
+        """
+        key = (account_id, feed_id)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+            if slot.checked_at is not None and time.time() - slot.checked_at < self.interval:
+                return self._result(slot)
+            fetching = slot.fetching
+            if fetching is None:
+                fetching = slot.fetching = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if owner:
+            self._refresh(key, slot, fetching)
+        else:
+            fetching.wait()
+        with self._lock:
+            return self._result(slot)
+
+    def _result(self, slot):
+        if slot.feed is None:
+            raise slot.error
+        return slot.feed
+
+    def _refresh(self, key, slot, fetching):
+        """
+        Fetch the feed *key* into *slot* and wake up the requests waiting on
+        *fetching*.
+        """
+        try:
+            feed, error = self._fetch(key, slot.feed), None
+        except Exception as e:
+            feed, error = None, e
+        with self._lock:
+            slot.checked_at = time.time()
+            if feed is not None:
+                slot.feed = feed
+            slot.error = error
+            slot.fetching = None
+        fetching.set()
+
+    def _fetch(self, key, cached):
+        """
+        Fetch the feed *key* from Google, conditionally if a copy is cached.
+        Returns the new or revalidated :class:`CachedFeed`.
+        """
+        request = urllib2.Request(feed_url(*key))
+        if cached is not None:
+            if cached.upstream_etag is not None:
+                request.add_header('If-None-Match', cached.upstream_etag)
+            if cached.upstream_last_modified is not None:
+                request.add_header('If-Modified-Since', cached.upstream_last_modified)
+
+        with self._lock:
+            self.upstream_requests += 1
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                cached.fetched_at = time.time()
+                return cached
+            raise UnexpectedResponseError(e.code, e.info().headers, e.read())
+        try:
+            resp_code = response.getcode()
+            body = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        if resp_code != 200:
+            raise UnexpectedResponseError(resp_code, headers.headers, body)
+
+        feed = CachedFeed(body, time.time())
+        if cached is not None and cached.etag == feed.etag:
+            # same content: keep the time it last changed for If-Modified-Since
+            feed.modified_at = cached.modified_at
+        feed.upstream_etag          = headers.getheader('ETag')
+        feed.upstream_last_modified = headers.getheader('Last-Modified')
+        return feed
+
+    def invalidate(self, account_id=None, feed_id=None):
+        """
+        Fetch the feed again on its next request, or all feeds of the
+        account, or all feeds if no account is given.
+        """
+        with self._lock:
+            for key, slot in self._slots.items():
+                if account_id is not None and key[0] != account_id:
+                    continue
+                if feed_id is not None and key[1] != feed_id:
+                    continue
+                slot.checked_at = None
+
+    def discard(self, keep):
+        """
+        Drop the cached feeds whose (account_id, feed_id) isn't in *keep*,
+        e.g. the feeds of alerts that were deleted.
+        """
+        keep = set(keep)
+        with self._lock:
+            for key in [ key for key in self._slots if key not in keep ]:
+                if self._slots[key].fetching is None:
+                    del self._slots[key]
+
+def proxy_url(alert, base_url):
+    """
+    Return the URL under which the proxy at *base_url* serves the feed of
+    *alert*, or ``None`` for alerts which are not delivered to a feed.
+    """
+    if alert.feed_id is None:
+        return None
+    return base_url.rstrip('/') + '/alerts/feeds/' + alert.account_id + '/' + alert.feed_id
+
+class _RequestHandler(RequestHandler):
+
+    def _send(self, status, body='', headers=(), content_type='text/plain'):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD' and status != 304:
+            self.wfile.write(body)
+
+    def _serve_feed(self):
+        match = _FEED_PATH_RE.match(self.path)
+        if match is None:
+            return self._send(404, 'Not found\n')
+        cache = self.server.feed_cache
+        try:
+            feed = cache.get(match.group(1), match.group(2))
+        except UnexpectedResponseError as e:
+            status = 404 if e.resp_status == 404 else 502
+            return self._send(status, 'Google responded with {}\n'.format(e.resp_status))
+        except (urllib2.URLError, IOError) as e:
+            return self._send(502, 'Couldn\'t reach Google: {}\n'.format(e))
+        except Exception as e:
+            # e.g. httplib.BadStatusLine; answer anyway, the client would only
+            # see the connection drop
+            self.log_error('Fetching %s failed: %r', self.path, e)
+            return self._send(502, 'Fetching the feed failed: {!r}\n'.format(e))
+
+        remaining = max(0, int(feed.fetched_at + cache.interval - time.time()))
+        headers = [
+            ('ETag', feed.etag),
+            ('Last-Modified', formatdate(feed.modified_at, usegmt=True)),
+            ('Cache-Control', 'max-age={}'.format(remaining)),
+        ]
+        if feed.not_modified(self.headers.getheader('If-None-Match'), self.headers.getheader('If-Modified-Since')):
+            return self._send(304, headers=headers)
+        return self._send(200, feed.body, headers, 'application/atom+xml; charset=utf-8')
+
+    def do_GET(self):
+        self._serve_feed()
+
+    def do_HEAD(self):
+        self._serve_feed()
+
+def make_server(cache, address):
+    """
+    Create a server for the :class:`FeedCache` *cache* listening on
+    *address*, which is either a (host, port) tuple or the path of a Unix
+    socket. Call ``serve_forever()`` on the result to start serving.
+    """
+    return _make_server(address, _RequestHandler, feed_cache=cache)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve Google Alerts feeds from a shared cache.')
+    add_address_arguments(parser, '127.0.0.1:8766')
+    parser.add_argument('--interval', type=float, default=300,
+                        help='seconds to serve a feed from the cache before fetching it again')
+    args = parser.parse_args()
+
+    server = make_server(FeedCache(args.interval), address_from_args(args))
+    serve(server)
+
+if __name__ == '__main__':
+    main()
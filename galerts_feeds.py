@@ -0,0 +1,188 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Fetching and parsing of the Atom feeds that Google Alerts delivers to.
+
+Feed alerts expose their results at :attr:`galerts2.Alert.feed_url`. This
+module turns those feeds into :class:`FeedItem` objects that the rest of the
+library (indexing, matching, storage) works with.
+"""
+
+import re
+import calendar
+import hashlib
+import urllib2
+from datetime import datetime
+from HTMLParser import HTMLParser
+from xml.etree import cElementTree as ElementTree
+from galerts2 import ParseFailureError, UnexpectedResponseError
+
+_ATOM = '{http://www.w3.org/2005/Atom}'
+
+_TAG_RE   = re.compile(r'<[^>]*>')
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Google wraps the links in feed entries in a redirect of the form
+# https://www.google.com/url?...&url=<actual url>&...
+_REDIRECT_RE = re.compile(r'[?&]url=([^&]+)')
+
+def tokenize(text):
+    """
+    Split *text* into lowercase word tokens.
+
+    This is the tokenizer shared by everything in galerts that needs to compare
+    alert queries against item text, so that both sides agree on what a word is.
+    """
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+def strip_html(text):
+    """
+    Remove tags from *text* and decode HTML entities.
+    """
+    if not text:
+        return u''
+    return HTMLParser().unescape(_TAG_RE.sub('', text))
+
+def _parse_timestamp(value):
+    """
+    Parse an RFC 3339 timestamp as used in Atom feeds into seconds since the
+    epoch (UTC).
+    """
+    if not value:
+        return None
+    value = value.strip()
+    # drop fractional seconds and the timezone designator. Google Alerts
+    # always reports UTC ('Z')
+    value = re.sub(r'(\.\d+)?(Z|[+-]00:00)$', '', value)
+    return calendar.timegm(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').timetuple())
+
+class FeedItem(object):
+    """
+    A single entry of an alert's feed.
+    """
+    def __init__(self, alert_id, item_id, title, link, content, published, updated=None):
+        self.alert_id  = alert_id
+        self.item_id   = item_id
+        self.title     = title
+        self.link      = link
+        self.content   = content
+        # seconds since the epoch, UTC
+        self.published = published
+        self.updated   = updated if updated is not None else published
+
+    @property
+    def text(self):
+        """
+        The searchable text of the item (title followed by content).
+        """
+        return u'\n'.join(part for part in (self.title, self.content) if part)
+
+    @property
+    def fingerprint(self):
+        """
+        A stable identifier of the item's target, used to recognize the same
+        result delivered by different alerts or on different polls.
+        """
+        return hashlib.sha1((self.link or self.item_id or u'').encode('utf-8')).hexdigest()
+
+    def as_dict(self):
+        return {
+            'alert_id':  self.alert_id,
+            'item_id':   self.item_id,
+            'title':     self.title,
+            'link':      self.link,
+            'content':   self.content,
+            'published': self.published,
+            'updated':   self.updated,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['alert_id'], d['item_id'], d['title'], d['link'],
+                   d['content'], d['published'], d.get('updated'))
+
+    def __str__(self):
+        return '<FeedItem alert: {}, id: {}, link: {}>'.format(self.alert_id, self.item_id, self.link)
+
+def _unwrap_link(href):
+    if href is None:
+        return None
+    match = _REDIRECT_RE.search(href)
+    if match is None:
+        return href
+    return urllib2.unquote(match.group(1))
+
+def parse_feed(body, alert_id=None):
+    """
+    Parse the Atom document *body* of an alert feed.
+
+    Returns a list of :class:`FeedItem` objects in feed order.
+
+    :raises ParseFailureError: if *body* is not a valid Atom document
+    """
+    try:
+        root = ElementTree.fromstring(body)
+    except SyntaxError as e:
+        raise ParseFailureError("Couldn't parse alert feed: " + str(e))
+
+    items = []
+    for entry in root.iter(_ATOM + 'entry'):
+        link_elem = entry.find(_ATOM + 'link')
+        items.append(FeedItem(
+            alert_id  = alert_id,
+            item_id   = entry.findtext(_ATOM + 'id'),
+            title     = strip_html(entry.findtext(_ATOM + 'title')),
+            link      = _unwrap_link(link_elem.get('href') if link_elem is not None else None),
+            content   = strip_html(entry.findtext(_ATOM + 'content')),
+            published = _parse_timestamp(entry.findtext(_ATOM + 'published')),
+            updated   = _parse_timestamp(entry.findtext(_ATOM + 'updated')),
+        ))
+    return items
+
+def fetch_feed_body(alert, opener=None, timeout=None):
+    """
+    Download the feed of *alert* without parsing it. Returns ``None`` for
+    alerts which are not delivered to a feed.
+
+    :param timeout: seconds to wait for Google on every socket operation
+    :raises UnexpectedResponseError: if Google doesn't answer with 200
+    """
+    if alert.feed_url is None:
+        return None
+
+    opener = opener if opener is not None else urllib2.build_opener()
+    if timeout is None:
+        response = opener.open(alert.feed_url)
+    else:
+        response = opener.open(alert.feed_url, None, timeout)
+    resp_code = response.getcode()
+    body = response.read()
+
+    if resp_code != 200:
+        raise UnexpectedResponseError(resp_code, response.info().headers, body)
+    return body
+
+def fetch_feed(alert, opener=None, timeout=None):
+    """
+    Download and parse the feed of *alert*.
+
+    Returns an empty list for alerts which are not delivered to a feed.
+
+    :param timeout: seconds to wait for Google on every socket operation
+    :raises UnexpectedResponseError: if Google doesn't answer with 200
+    """
+    body = fetch_feed_body(alert, opener, timeout)
+    if body is None:
+        return []
+    return parse_feed(body, alert.alert_id)
+
+def iter_feed_items(alerts, opener=None):
+    """
+    Yield the items of the feeds of all *alerts*, one feed at a time.
+    """
+    for alert in alerts:
+        for item in fetch_feed(alert, opener):
+            yield item
@@ -0,0 +1,270 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A history of the window states of accounts, to look up what their alerts
+were at any past time.
+
+A :class:`WindowStateHistory` stores successive window states of every
+account in a SQLite database. A window state that is the same as the previous
+one isn't stored again, and one that differs is stored as the fields of the
+alerts and accounts that changed and the positions of those that were added
+or moved. Every *keyframe_interval* versions the full state is stored
+instead, so rebuilding a past state takes a keyframe and at most that many
+deltas::
+
+    >>> history = WindowStateHistory('/var/lib/galerts/history.db')
+    >>> gam = galerts2.GoogleAlertsManager(email, password, history=history)
+    ...
+    >>> state = history.at(gam.email, calendar.timegm((2026, 3, 1, 0, 0, 0)))
+    >>> [alert.query for alert in state.alerts]
+
+States are stored as zlib-compressed JSON. The session parameter ``x`` is not
+part of the history, so rebuilt states can't be used to make requests.
+"""
+
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from galerts2 import Account, Alert, WindowState
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (
+    account  TEXT NOT NULL,
+    version  INTEGER NOT NULL,
+    taken_at REAL NOT NULL,
+    -- 1 if data holds the full state, 0 if it holds the changes to the
+    -- previous version
+    keyframe INTEGER NOT NULL,
+    data     BLOB NOT NULL,
+    PRIMARY KEY (account, version)
+);
+CREATE INDEX IF NOT EXISTS versions_taken_at ON versions (account, taken_at);
+'''
+
+def _records(window_state):
+    """
+    Return the alerts and accounts of *window_state* as two ordered dicts of
+    attribute dicts, keyed by alert_id and email.
+    """
+    alerts = OrderedDict((alert.alert_id, alert.as_dict()) for alert in window_state.alerts)
+    accounts = OrderedDict((email, window_state.accounts[email].as_dict()) for email in sorted(window_state.accounts))
+    return alerts, accounts
+
+def _unmoved(keys, old_positions):
+    """
+    Return the largest set of *keys* whose order is the same as in the old
+    records, whose positions are *old_positions*. The other keys moved.
+    """
+    # longest increasing subsequence of the old positions, by patience
+    # sorting: tails[n] is the index in keys of the smallest last element of
+    # an increasing subsequence of length n + 1
+    tails = []
+    previous = [None] * len(keys)
+    for i, key in enumerate(keys):
+        position = old_positions[key]
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if old_positions[keys[tails[mid]]] < position:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[i] = tails[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+    unmoved = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        unmoved.add(keys[i])
+        i = previous[i]
+    return unmoved
+
+def _diff(old, new):
+    """
+    Return the changes from the ordered dict of records *old* to *new*: the
+    records added, the keys removed, the changed fields of the others and the
+    positions in *new* of the keys that were added or moved. ``None`` if
+    there are none.
+    """
+    added = [ (key, record) for (key, record) in new.items() if key not in old ]
+    removed = [ key for key in old if key not in new ]
+    changed = []
+    for key, record in new.items():
+        previous = old.get(key)
+        if previous is None or previous == record:
+            continue
+        changed.append((key, dict((field, value) for (field, value) in record.items()
+                                  if previous.get(field) != value)))
+
+    old_positions = dict((key, i) for (i, key) in enumerate(old))
+    kept = [ key for key in new if key in old_positions ]
+    unmoved = _unmoved(kept, old_positions)
+    positions = [ (i, key) for (i, key) in enumerate(new) if key not in unmoved ]
+    if not added and not removed and not changed and not positions:
+        return None
+    return { 'added': added, 'removed': removed, 'changed': changed, 'positions': positions }
+
+def _patch(records, delta):
+    """
+    Apply a *delta* from :func:`_diff` to the ordered dict *records* in
+    place, leaving the records in the order of the new state.
+    """
+    for key in delta['removed']:
+        del records[key]
+    for key, fields in delta['changed']:
+        record = dict(records[key])
+        record.update(fields)
+        records[key] = record
+    for key, record in delta['added']:
+        records[key] = record
+
+    # the keys without a position kept their order; the others are put at
+    # their positions, which are in ascending order
+    placed = set(key for (i, key) in delta['positions'])
+    keys = [ key for key in records if key not in placed ]
+    for i, key in delta['positions']:
+        keys.insert(i, key)
+    patched = [ (key, records[key]) for key in keys ]
+    records.clear()
+    records.update(patched)
+
+def _encode(value):
+    return sqlite3.Binary(zlib.compress(json.dumps(value, separators=(',', ':'))))
+
+def _decode(data):
+    return json.loads(zlib.decompress(str(data)))
+
+class WindowStateHistory(object):
+    """
+    Versions of the window states of accounts, kept in a SQLite database.
+    """
+    def __init__(self, path=':memory:', keyframe_interval=32):
+        """
+        :param path: file name of the database, or ``':memory:'``
+        :param keyframe_interval: store the full state every this many
+            versions. Lower values make rebuilding states faster and the
+            database bigger.
+        """
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # the latest version of every account as (version, alerts, accounts),
+        # the base of the next delta
+        self._latest = {}
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def _load(self, account, version):
+        """
+        Return the records (alerts, accounts) of *version* of *account*,
+        starting from the last keyframe before it.
+        """
+        rows = self._conn.execute(
+            'SELECT keyframe, data FROM versions WHERE account = ? AND version <= ? AND version >= '
+            '(SELECT MAX(version) FROM versions WHERE account = ? AND keyframe = 1 AND version <= ?) '
+            'ORDER BY version', (account, version, account, version)).fetchall()
+
+        alerts, accounts = OrderedDict(), OrderedDict()
+        for keyframe, data in rows:
+            value = _decode(data)
+            if keyframe:
+                alerts = OrderedDict(value['alerts'])
+                accounts = OrderedDict(value['accounts'])
+            else:
+                _patch(alerts, value['alerts'])
+                _patch(accounts, value['accounts'])
+        return alerts, accounts
+
+    def _latest_version(self, account):
+        """
+        Return (version, alerts, accounts) of the latest version of
+        *account*, with version 0 and no records if there is none.
+        """
+        latest = self._latest.get(account)
+        if latest is None:
+            row = self._conn.execute('SELECT MAX(version) FROM versions WHERE account = ?', (account,)).fetchone()
+            version = row[0] or 0
+            if version:
+                latest = (version,) + self._load(account, version)
+            else:
+                latest = (0, OrderedDict(), OrderedDict())
+            self._latest[account] = latest
+        return latest
+
+    def record(self, account, window_state, when=None):
+        """
+        Store *window_state* as the state of *account* (e.g. the manager's
+        email) at *when* (seconds since the epoch, default now).
+
+        Returns the new version number, or ``None`` if the state is the same
+        as the latest one and nothing was stored.
+        """
+        when = when if when is not None else time.time()
+        alerts, accounts = _records(window_state)
+        with self._lock:
+            version, old_alerts, old_accounts = self._latest_version(account)
+            alerts_delta = _diff(old_alerts, alerts)
+            accounts_delta = _diff(old_accounts, accounts)
+            if version and alerts_delta is None and accounts_delta is None:
+                return None
+
+            version += 1
+            keyframe = version % self.keyframe_interval == 1 or self.keyframe_interval == 1
+            if keyframe:
+                value = { 'alerts': alerts.items(), 'accounts': accounts.items() }
+            else:
+                empty = { 'added': [], 'removed': [], 'changed': [], 'positions': [] }
+                value = { 'alerts': alerts_delta or empty, 'accounts': accounts_delta or empty }
+
+            with self._conn:
+                self._conn.execute('INSERT INTO versions (account, version, taken_at, keyframe, data) '
+                                   'VALUES (?, ?, ?, ?, ?)', (account, version, when, int(keyframe), _encode(value)))
+            self._latest[account] = (version, alerts, accounts)
+        return version
+
+    def versions(self, account):
+        """
+        Return the stored versions of *account* as a list of (version,
+        taken_at) tuples, oldest first.
+        """
+        with self._lock:
+            return [ tuple(row) for row in self._conn.execute(
+                'SELECT version, taken_at FROM versions WHERE account = ? ORDER BY version', (account,)) ]
+
+    def get(self, account, version):
+        """
+        Return *version* of the window state of *account* as a
+        :class:`galerts2.WindowState`, or ``None`` if there is no such
+        version.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM versions WHERE account = ? AND version = ?',
+                                     (account, version)).fetchone()
+            if row is None:
+                return None
+            alerts, accounts = self._load(account, version)
+        return WindowState.from_alerts([ Alert.from_dict(d) for d in alerts.values() ],
+                                       [ Account.from_dict(d) for d in accounts.values() ])
+
+    def at(self, account, when):
+        """
+        Return the window state *account* had at *when* (seconds since the
+        epoch), i.e. the last one recorded at or before it, or ``None`` if
+        nothing was recorded by then.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT MAX(version) FROM versions WHERE account = ? AND taken_at <= ?',
+                                     (account, when)).fetchone()
+        if row[0] is None:
+            return None
+        return self.get(account, row[0])
@@ -0,0 +1,339 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A local, incremental full-text index over items delivered by alert feeds.
+
+The index lives in a directory of immutable segment files plus a small
+manifest. New items are buffered in memory and written out as a new segment by
+:meth:`InvertedIndex.commit`; :meth:`InvertedIndex.merge` folds segments
+together and drops items that have since been replaced.
+
+Example::
+
+    >>> index = InvertedIndex('/var/lib/galerts/index')
+    >>> index.add_feeds(gam.alerts)
+    >>> index.commit()
+    >>> [hit.link for hit in index.search('"corner confectionery" cake', limit=5)]
+"""
+
+import os
+import re
+import json
+import heapq
+from galerts_feeds import tokenize, iter_feed_items
+
+_MANIFEST = 'manifest.json'
+_PHRASE_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+class Hit(object):
+    """
+    An item matching a query.
+    """
+    def __init__(self, doc_id, alert_id, item_id, timestamp, title, link):
+        self.doc_id    = doc_id
+        self.alert_id  = alert_id
+        self.item_id   = item_id
+        self.timestamp = timestamp
+        self.title     = title
+        self.link      = link
+
+    def __str__(self):
+        return '<Hit alert: {}, id: {}, timestamp: {}, link: {}>'.format(
+            self.alert_id, self.item_id, self.timestamp, self.link)
+
+class _Segment(object):
+    """
+    An immutable set of documents and their postings.
+
+    docs maps a document id to [alert_id, item_id, timestamp, title, link] and
+    postings maps a term to a list of [doc_id, [positions...]] sorted by doc id.
+    """
+    def __init__(self, name, docs, postings):
+        self.name     = name
+        self.docs     = docs
+        self.postings = postings
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        docs = dict((int(doc_id), doc) for (doc_id, doc) in data['docs'].items())
+        return cls(os.path.basename(path), docs, data['postings'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({ 'docs': self.docs, 'postings': self.postings }, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+def _parse_query(query):
+    """
+    Split a query into a list of phrases, each being a list of tokens. Bare
+    words are one-token phrases; "quoted text" makes a multi-token phrase.
+    """
+    phrases = []
+    for match in _PHRASE_RE.finditer(query):
+        tokens = tokenize(match.group(1) if match.group(1) is not None else match.group(2))
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+class InvertedIndex(object):
+    """
+    Full-text index of feed items keyed by (alert_id, item_id).
+
+    Adding an item whose key is already indexed replaces the older version.
+    Queries see committed segments as well as items added since the last
+    :meth:`commit`.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory holding the segment files. It is created if it
+            doesn't exist yet.
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        manifest_path = os.path.join(path, _MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = { 'segments': [], 'next_doc_id': 0, 'next_segment': 0, 'deleted': [] }
+
+        self._next_doc_id  = manifest['next_doc_id']
+        self._next_segment = manifest['next_segment']
+        self._deleted      = set(manifest['deleted'])
+        self._segments     = [ _Segment.load(os.path.join(path, name)) for name in manifest['segments'] ]
+
+        # (alert_id, item_id) -> doc id of the live version
+        self._keys = {}
+        for segment in self._segments:
+            for doc_id, doc in segment.docs.items():
+                if doc_id not in self._deleted:
+                    self._keys[(doc[0], doc[1])] = doc_id
+
+        self._pending_docs     = {}
+        self._pending_postings = {}
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.path, _MANIFEST)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'segments':     [ segment.name for segment in self._segments ],
+                'next_doc_id':  self._next_doc_id,
+                'next_segment': self._next_segment,
+                'deleted':      sorted(self._deleted),
+            }, f)
+        os.rename(tmp_path, manifest_path)
+
+    def add(self, item):
+        """
+        Index a :class:`galerts_feeds.FeedItem`. The item becomes searchable
+        immediately but is only persisted by :meth:`commit`.
+        """
+        key = (item.alert_id, item.item_id)
+        old_doc_id = self._keys.get(key)
+        if old_doc_id is not None:
+            self._remove_doc(old_doc_id)
+
+        doc_id = self._next_doc_id
+        self._next_doc_id += 1
+        self._keys[key] = doc_id
+        self._pending_docs[doc_id] = [ item.alert_id, item.item_id, item.published, item.title, item.link ]
+
+        positions = {}
+        for position, term in enumerate(tokenize(item.text)):
+            positions.setdefault(term, []).append(position)
+        for term, term_positions in positions.items():
+            self._pending_postings.setdefault(term, []).append([ doc_id, term_positions ])
+
+    def add_items(self, items):
+        """
+        Index every item of the iterable *items*. Returns the number of items.
+        """
+        count = 0
+        for item in items:
+            self.add(item)
+            count += 1
+        return count
+
+    def add_feeds(self, alerts, opener=None):
+        """
+        Fetch the feeds of *alerts* and index their items as they stream in.
+        Returns the number of items indexed.
+        """
+        return self.add_items(iter_feed_items(alerts, opener))
+
+    def _remove_doc(self, doc_id):
+        self._deleted.add(doc_id)
+
+    def remove(self, alert_id, item_id):
+        """
+        Remove an item from the index. Returns whether it was indexed.
+        """
+        doc_id = self._keys.pop((alert_id, item_id), None)
+        if doc_id is None:
+            return False
+        self._remove_doc(doc_id)
+        return True
+
+    def commit(self):
+        """
+        Write items added since the last commit to a new segment.
+        """
+        # items replaced before they were ever written don't need to be
+        # remembered as deleted
+        dropped = self._deleted.intersection(self._pending_docs)
+        docs = dict((doc_id, doc) for (doc_id, doc) in self._pending_docs.items() if doc_id not in dropped)
+        if docs:
+            postings = {}
+            for term, term_postings in self._pending_postings.items():
+                live = [ p for p in term_postings if p[0] not in dropped ]
+                if live:
+                    postings[term] = live
+
+            name = 'segment-%06d.json' % self._next_segment
+            self._next_segment += 1
+            segment = _Segment(name, docs, postings)
+            segment.save(os.path.join(self.path, name))
+            self._segments.append(segment)
+        self._deleted -= dropped
+        self._pending_docs     = {}
+        self._pending_postings = {}
+        self._save_manifest()
+
+    def merge(self):
+        """
+        Commit pending items and merge all segments into one, dropping
+        removed and replaced items.
+        """
+        self.commit()
+        if len(self._segments) < 2 and not self._deleted:
+            return
+
+        docs = {}
+        postings = {}
+        for segment in self._segments:
+            for doc_id, doc in segment.docs.items():
+                if doc_id not in self._deleted:
+                    docs[doc_id] = doc
+            for term, term_postings in segment.postings.items():
+                live = [ p for p in term_postings if p[0] not in self._deleted ]
+                if live:
+                    postings.setdefault(term, []).extend(live)
+        for term_postings in postings.values():
+            term_postings.sort()
+
+        old_names = [ segment.name for segment in self._segments ]
+        name = 'segment-%06d.json' % self._next_segment
+        self._next_segment += 1
+        merged = _Segment(name, docs, postings)
+        merged.save(os.path.join(self.path, name))
+
+        self._segments = [ merged ]
+        self._deleted  = set()
+        self._save_manifest()
+
+        # only remove the old segments once the manifest no longer refers to
+        # them
+        for old_name in old_names:
+            os.remove(os.path.join(self.path, old_name))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _term_postings(self, term):
+        """
+        Return {doc_id: positions} for all live documents containing *term*.
+        """
+        result = {}
+        for postings in [ segment.postings.get(term, ()) for segment in self._segments ] + \
+                [ self._pending_postings.get(term, ()) ]:
+            for doc_id, positions in postings:
+                if doc_id not in self._deleted:
+                    result[doc_id] = positions
+        return result
+
+    def _phrase_docs(self, phrase):
+        """
+        Return the set of documents containing the tokens of *phrase*
+        consecutively.
+        """
+        term_postings = [ (offset, self._term_postings(term)) for (offset, term) in enumerate(phrase) ]
+        # intersect starting with the rarest term
+        term_postings.sort(key=lambda t: len(t[1]))
+
+        candidates = None
+        for offset, postings in term_postings:
+            docs = set(postings)
+            candidates = docs if candidates is None else candidates & docs
+            if not candidates:
+                return set()
+
+        if len(phrase) == 1:
+            return candidates
+
+        matches = set()
+        for doc_id in candidates:
+            starts = None
+            for offset, postings in term_postings:
+                shifted = set(position - offset for position in postings[doc_id])
+                starts = shifted if starts is None else starts & shifted
+                if not starts:
+                    break
+            if starts:
+                matches.add(doc_id)
+        return matches
+
+    def _doc(self, doc_id):
+        if doc_id in self._pending_docs:
+            return self._pending_docs[doc_id]
+        for segment in self._segments:
+            if doc_id in segment.docs:
+                return segment.docs[doc_id]
+        return None
+
+    def search(self, query, alert_id=None, since=None, until=None, limit=10):
+        """
+        Find items matching every term and "quoted phrase" of *query*.
+
+        :param alert_id: only return items delivered by this alert
+        :param since: only return items published at or after this time
+            (seconds since the epoch)
+        :param until: only return items published before this time
+        :param limit: return at most this many hits. ``None`` returns all.
+
+        Returns a list of :class:`Hit` objects, most recent first.
+        """
+        phrases = _parse_query(query)
+        if not phrases:
+            return []
+
+        docs = None
+        for phrase in sorted(phrases, key=len, reverse=True):
+            phrase_docs = self._phrase_docs(phrase)
+            docs = phrase_docs if docs is None else docs & phrase_docs
+            if not docs:
+                return []
+
+        hits = []
+        for doc_id in docs:
+            doc = self._doc(doc_id)
+            doc_alert_id, item_id, timestamp = doc[0], doc[1], doc[2]
+            if alert_id is not None and doc_alert_id != alert_id:
+                continue
+            if since is not None and (timestamp is None or timestamp < since):
+                continue
+            if until is not None and (timestamp is None or timestamp >= until):
+                continue
+            hits.append(Hit(doc_id, doc_alert_id, item_id, timestamp, doc[3], doc[4]))
+
+        key = lambda hit: (hit.timestamp or 0, hit.doc_id)
+        if limit is None:
+            return sorted(hits, key=key, reverse=True)
+        return heapq.nlargest(limit, hits, key=key)
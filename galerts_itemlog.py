@@ -0,0 +1,452 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+An append-only log of the items delivered by alert feeds, kept for replay
+and audit.
+
+Items are appended as length-prefixed records to segment files that are
+rotated once they reach a size limit. Every sealed segment gets an index file
+of fixed-size entries sorted by item fingerprint, followed by the positions of
+the entries ordered by alert and time and by time alone. It is memory-mapped
+and binary-searched in place, so opening a large log doesn't load its indexes
+and reading the items of one alert or time range doesn't touch the others. Old
+segments are dropped as a whole by :meth:`ItemLog.compact`::
+
+    >>> log = ItemLog('/var/lib/galerts/items')
+    >>> log.append_many(iter_feed_items(gam.window_state.alerts))
+    >>> log.flush()
+    >>> [item.link for item in log.by_alert(alert.alert_id, since=time.time() - 86400)]
+    >>> log.compact(max_age=90 * 86400)
+
+Records are ``struct`` headers (payload length and CRC-32) followed by the
+item as UTF-8 JSON. :meth:`ItemLog.records` returns the payloads as buffers
+into the memory-mapped segments without copying them.
+"""
+
+import os
+import re
+import json
+import mmap
+import time
+import zlib
+import struct
+import hashlib
+import binascii
+from galerts_feeds import FeedItem
+
+_SEGMENT_RE = re.compile(r'^segment-(\d{8})\.log$')
+
+# payload length and CRC-32 of the payload
+_RECORD_HEADER = struct.Struct('>II')
+
+# magic, version, number of entries, smallest and largest timestamp
+_INDEX_HEADER = struct.Struct('>4sIQqq')
+_INDEX_MAGIC = 'GIDX'
+_INDEX_VERSION = 2
+
+# item fingerprint (SHA-1 digest), first 8 bytes of the SHA-1 digest of the
+# alert_id, timestamp, offset of the record in the segment and payload length
+_INDEX_ENTRY = struct.Struct('>20s8sqQI')
+
+# the position of an entry in the index, in the tables that order the entries
+# by (alert, timestamp, offset) and by (timestamp, offset)
+_POSITION = struct.Struct('>I')
+
+def _alert_key(alert_id):
+    return hashlib.sha1((alert_id or u'').encode('utf-8')).digest()[:8]
+
+class _Segment(object):
+    """
+    A segment file and its index. The index of the segment being written is
+    kept in memory; sealed segments have their index in a file.
+    """
+    def __init__(self, directory, number):
+        self.number   = number
+        self.log_path = os.path.join(directory, 'segment-%08d.log' % number)
+        self.idx_path = os.path.join(directory, 'segment-%08d.idx' % number)
+        self.size     = 0
+        self.min_time = None
+        self.max_time = None
+
+        # the number of records, and their index entries: in a mapped index
+        # file for sealed segments, in a list for the active segment
+        self.count   = 0
+        self.index   = None
+        self.entries = None
+
+        # where the tables of positions start in the mapped index
+        self._by_alert = None
+        self._by_time  = None
+
+        self._log_file = None
+        self._log_map  = None
+        self._map_size = 0
+        self._idx_file = None
+
+    def _track_time(self, timestamp):
+        self.min_time = timestamp if self.min_time is None else min(self.min_time, timestamp)
+        self.max_time = timestamp if self.max_time is None else max(self.max_time, timestamp)
+
+    def scan(self):
+        """
+        Return the index entries of all intact records of the segment file,
+        and the offset at which the intact records end.
+        """
+        entries = []
+        offset = 0
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, crc = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            d = json.loads(payload)
+            item = FeedItem.from_dict(d)
+            entries.append(_entry(item, d.get('logged'), start, length))
+            offset = start + length
+        return entries, offset
+
+    def load_index(self):
+        self._idx_file = open(self.idx_path, 'rb')
+        self.index = mmap.mmap(self._idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.min_time, self.max_time = _INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise ValueError('Not an item log index: ' + self.idx_path)
+        self._by_alert = _INDEX_HEADER.size + self.count * _INDEX_ENTRY.size
+        self._by_time  = self._by_alert + self.count * _POSITION.size
+        self.size = os.path.getsize(self.log_path)
+
+    def index_is_current(self):
+        """
+        Return whether the segment has an index file of the current version.
+        """
+        if not os.path.exists(self.idx_path):
+            return False
+        with open(self.idx_path, 'rb') as f:
+            header = f.read(_INDEX_HEADER.size)
+        if len(header) < _INDEX_HEADER.size:
+            return False
+        magic, version = _INDEX_HEADER.unpack(header)[:2]
+        return magic == _INDEX_MAGIC and version == _INDEX_VERSION
+
+    def write_index(self, entries):
+        """
+        Write *entries* sorted by fingerprint as the segment's index file,
+        followed by their positions ordered by alert and by time.
+        """
+        entries = sorted(entries)
+        times = [ entry[2] for entry in entries ]
+        positions = range(len(entries))
+        by_alert = sorted(positions, key=lambda i: (entries[i][1], entries[i][2], entries[i][3]))
+        by_time  = sorted(positions, key=lambda i: (entries[i][2], entries[i][3]))
+        tmp_path = self.idx_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, len(entries),
+                                       min(times) if times else 0, max(times) if times else 0))
+            for entry in entries:
+                f.write(_INDEX_ENTRY.pack(*entry))
+            for table in (by_alert, by_time):
+                f.write(struct.pack('>%dI' % len(table), *table))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.idx_path)
+
+    def entry(self, i):
+        if self.index is None:
+            return self.entries[i]
+        return _INDEX_ENTRY.unpack_from(self.index, _INDEX_HEADER.size + i * _INDEX_ENTRY.size)
+
+    def find(self, digest):
+        """
+        Return the index entries with the fingerprint *digest*.
+        """
+        if self.index is None:
+            return [ entry for entry in self.entries if entry[0] == digest ]
+
+        # binary search for the first entry with the fingerprint
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count:
+            entry = self.entry(lo)
+            if entry[0] != digest:
+                break
+            found.append(entry)
+            lo += 1
+        return found
+
+    def _ordered(self, table, i):
+        """
+        Return the *i*-th entry of the table of positions at *table*.
+        """
+        return self.entry(_POSITION.unpack_from(self.index, table + i * _POSITION.size)[0])
+
+    def _bisect(self, table, key, value):
+        """
+        Return the first position in *table* whose entry has a *key* not
+        less than *value*.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self._ordered(table, mid)) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def select(self, alert_key=None, since=None, until=None):
+        """
+        Return the index entries of the items delivered by the alert with
+        *alert_key* and published in [since, until), each if given, in the
+        order the items were appended.
+        """
+        if self.index is None:
+            return [ entry for entry in self.entries
+                     if (alert_key is None or entry[1] == alert_key)
+                     and (since is None or entry[2] >= since)
+                     and (until is None or entry[2] < until) ]
+
+        start = since if since is not None else float('-inf')
+        end   = until if until is not None else float('inf')
+        if alert_key is not None:
+            table, key = self._by_alert, lambda entry: (entry[1], entry[2])
+            lo, hi = (alert_key, start), (alert_key, end)
+        else:
+            table, key = self._by_time, lambda entry: entry[2]
+            lo, hi = start, end
+        first = self._bisect(table, key, lo)
+        last  = self._bisect(table, key, hi)
+        entries = [ self._ordered(table, i) for i in range(first, last) ]
+        entries.sort(key=lambda entry: entry[3])
+        return entries
+
+    def log_map(self):
+        """
+        Return a memory map of the segment file covering all records written
+        so far.
+        """
+        if self._log_map is None or self._map_size < self.size:
+            # the old map isn't closed since buffers handed out earlier may
+            # still point into it
+            if self._log_file is None:
+                self._log_file = open(self.log_path, 'rb')
+            self._log_map  = mmap.mmap(self._log_file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._map_size = self.size
+        return self._log_map
+
+    def close(self):
+        for obj in (self._log_map, self.index, self._log_file, self._idx_file):
+            if obj is not None:
+                obj.close()
+        self._log_map = self.index = self._log_file = self._idx_file = None
+
+def _entry(item, timestamp, offset, length):
+    """
+    Return the index entry of *item*, whose payload of *length* bytes starts
+    at *offset*. Items without a publication time are indexed by the time
+    they were logged.
+    """
+    if item.published is not None:
+        timestamp = item.published
+    return (binascii.unhexlify(item.fingerprint), _alert_key(item.alert_id), int(timestamp or 0), offset, length)
+
+class ItemLog(object):
+    """
+    A directory of segment files holding :class:`galerts_feeds.FeedItem`
+    objects in the order they were appended.
+    """
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        """
+        :param path: directory holding the segments. It is created if it
+            doesn't exist yet.
+        :param segment_size: size in bytes after which a new segment is
+            started
+        """
+        self.path = path
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        numbers = sorted(int(match.group(1)) for match in
+                         (_SEGMENT_RE.match(name) for name in os.listdir(path)) if match)
+        self._segments = []
+        for number in numbers[:-1]:
+            segment = _Segment(path, number)
+            if not segment.index_is_current():
+                # the process died while sealing the segment, or the index
+                # was written by an older version
+                entries, end = segment.scan()
+                segment.write_index(entries)
+            segment.load_index()
+            self._segments.append(segment)
+
+        self._open_active(numbers[-1] if numbers else 1)
+
+    def _open_active(self, number):
+        segment = _Segment(self.path, number)
+        entries = []
+        end = 0
+        if os.path.exists(segment.log_path):
+            # drop a record that was only partly written when the process died
+            entries, end = segment.scan()
+        with open(segment.log_path, 'ab') as f:
+            f.truncate(end)
+        segment.entries = entries
+        segment.count   = len(entries)
+        segment.size    = end
+        for entry in entries:
+            segment._track_time(entry[2])
+        self._file = open(segment.log_path, 'ab')
+        self._active = segment
+        self._segments.append(segment)
+
+    def _rotate(self):
+        self._file.close()
+        active = self._active
+        active.write_index(active.entries)
+        # the segment's log stays mapped: buffers handed out by records()
+        # point into it and stay valid until the log is closed or compacted
+        active.entries = None
+        active.load_index()
+        self._open_active(active.number + 1)
+
+    def append(self, item):
+        """
+        Append a :class:`galerts_feeds.FeedItem` to the log. It can be read
+        right away but is only durable after :meth:`flush`.
+        """
+        d = item.as_dict()
+        logged = time.time()
+        d['logged'] = logged
+        payload = json.dumps(d, separators=(',', ':'))
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+
+        if self._active.size and self._active.size + _RECORD_HEADER.size + len(payload) > self.segment_size:
+            self._rotate()
+
+        active = self._active
+        self._file.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+        entry = _entry(item, logged, active.size + _RECORD_HEADER.size, len(payload))
+        active.entries.append(entry)
+        active.count += 1
+        active.size += _RECORD_HEADER.size + len(payload)
+        active._track_time(entry[2])
+
+    def append_many(self, items):
+        """
+        Append every item of the iterable *items*. Returns the number of items.
+        """
+        count = 0
+        for item in items:
+            self.append(item)
+            count += 1
+        return count
+
+    def flush(self):
+        """
+        Write appended items to disk.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+        for segment in self._segments:
+            segment.close()
+
+    def __len__(self):
+        return sum(segment.count for segment in self._segments)
+
+    def _payload(self, segment, entry):
+        if segment is self._active:
+            self._file.flush()
+        return buffer(segment.log_map(), entry[3], entry[4])
+
+    def _item(self, segment, entry):
+        return FeedItem.from_dict(json.loads(str(self._payload(segment, entry))))
+
+    def records(self, since=None, until=None, alert_id=None):
+        """
+        Yield the raw JSON payloads of the items, in the order they were
+        appended, as read-only buffers into the mapped segment files. Only
+        items published in [since, until) and delivered by *alert_id* are
+        included if those are given.
+
+        The buffers are only valid until the log is closed or compacted.
+        """
+        alert_key = _alert_key(alert_id) if alert_id is not None else None
+        for segment in list(self._segments):
+            if not segment.count:
+                continue
+            if since is not None and segment.max_time < since:
+                continue
+            if until is not None and segment.min_time >= until:
+                continue
+
+            for entry in segment.select(alert_key, since, until):
+                yield self._payload(segment, entry)
+
+    def __iter__(self):
+        return self.items()
+
+    def items(self, since=None, until=None, alert_id=None):
+        """
+        Like :meth:`records`, but yield :class:`galerts_feeds.FeedItem`
+        objects.
+        """
+        for record in self.records(since, until, alert_id):
+            item = FeedItem.from_dict(json.loads(str(record)))
+            # alert keys are truncated digests, so check the actual alert_id
+            if alert_id is None or item.alert_id == alert_id:
+                yield item
+
+    def by_alert(self, alert_id, since=None, until=None):
+        """
+        Yield the items delivered by the alert *alert_id*.
+        """
+        return self.items(since, until, alert_id)
+
+    def get(self, fingerprint):
+        """
+        Return all logged copies of the item with *fingerprint* (see
+        :attr:`galerts_feeds.FeedItem.fingerprint`), oldest first.
+        """
+        digest = binascii.unhexlify(fingerprint)
+        found = []
+        for segment in self._segments:
+            for entry in sorted(segment.find(digest), key=lambda entry: entry[3]):
+                found.append(self._item(segment, entry))
+        return found
+
+    def compact(self, max_age=None, before=None):
+        """
+        Delete the sealed segments whose items were all published before
+        *before* (seconds since the epoch), or more than *max_age* seconds
+        ago. Returns the number of segments deleted.
+        """
+        if before is None:
+            if max_age is None:
+                raise ValueError('compact needs max_age or before')
+            before = time.time() - max_age
+
+        expired = [ segment for segment in self._segments
+                    if segment is not self._active and segment.max_time < before ]
+        for segment in expired:
+            self._segments.remove(segment)
+            segment.close()
+            # remove the index first; a segment without index is reindexed
+            # when the log is opened, not silently lost
+            os.remove(segment.idx_path)
+            os.remove(segment.log_path)
+        return len(expired)
@@ -0,0 +1,206 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Durable, resumable bulk operations.
+
+A :class:`BulkJob` writes every operation it plans, starts and completes to
+an append-only journal file before and after sending it. If the process dies
+halfway, running the job again with the same journal resumes it: operations
+that never started are sent, and operations that may or may not have reached
+Google are first checked against the refreshed alerts instead of being sent
+again blindly::
+
+    >>> job = BulkJob(gam, 'provisioning.journal')
+    >>> job.resume()            # finish what a previous run left over
+    >>> job.create_many(specs)
+"""
+
+import os
+import json
+import threading
+from galerts2 import Alert, AlertSpec, alert_key
+
+class BulkJournal(object):
+    """
+    An append-only log of bulk operations, one JSON record per line.
+
+    Records are ``planned`` (with the operation and its alert or spec),
+    ``started``, ``done`` and ``failed``, all referring to an operation by
+    its ``op_id``. Records are flushed to disk before the corresponding
+    requests are made.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def close(self):
+        self._file.close()
+
+    def write(self, *records):
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def records(self):
+        """
+        Return all records in the journal. A truncated last line, as left by a
+        crash while writing it, is ignored.
+        """
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+class _Operation(object):
+    def __init__(self, op_id, op, item):
+        self.op_id = op_id
+        self.op    = op
+        self.item  = item
+        # None (planned), 'started', 'done' or 'failed'
+        self.state = None
+
+class BulkJob(object):
+    """
+    Runs bulk creates, updates and deletes through a manager, journaling
+    every operation in *journal_path*.
+    """
+    def __init__(self, manager, journal_path):
+        self.manager = manager
+        self.journal = BulkJournal(journal_path)
+
+        # the operations of previous runs, in the order they were planned
+        self._operations = {}
+        for record in self.journal.records():
+            kind = record['type']
+            if kind == 'planned':
+                if record['op'] == 'create':
+                    item = AlertSpec.from_dict(record['item'])
+                else:
+                    item = Alert.from_dict(record['item'])
+                self._operations[record['op_id']] = _Operation(record['op_id'], record['op'], item)
+            elif record['op_id'] in self._operations:
+                self._operations[record['op_id']].state = kind
+        self._next_op_id = max(self._operations) + 1 if self._operations else 0
+        self._id_lock = threading.Lock()
+
+    def close(self):
+        self.journal.close()
+
+    def pending(self):
+        """
+        Return the operations that have not completed, as (op, item, state)
+        tuples where state is None if the operation was never started.
+        """
+        return [ (operation.op, operation.item, operation.state)
+                 for (op_id, operation) in sorted(self._operations.items())
+                 if operation.state != 'done' ]
+
+    def _plan(self, op, items):
+        """
+        Journal the operations *op* on *items* as planned, all before any of
+        them is sent, so that a resumed job knows about every one of them.
+        """
+        operations = []
+        with self._id_lock:
+            for item in items:
+                operations.append(_Operation(self._next_op_id, op, item))
+                self._next_op_id += 1
+        self.journal.write(*[ { 'type': 'planned', 'op_id': operation.op_id, 'op': op, 'item': operation.item.as_dict() }
+                              for operation in operations ])
+        for operation in operations:
+            self._operations[operation.op_id] = operation
+        return operations
+
+    def _send(self, operation):
+        self.journal.write({ 'type': 'started', 'op_id': operation.op_id })
+        operation.state = 'started'
+        try:
+            if operation.op == 'create':
+                self.manager._send_create(operation.item)
+            elif operation.op == 'update':
+                self.manager._send_update(operation.item)
+            else:
+                self.manager._send_delete(operation.item)
+        except Exception as e:
+            self.journal.write({ 'type': 'failed', 'op_id': operation.op_id, 'error': repr(e) })
+            operation.state = 'failed'
+            raise
+        self.journal.write({ 'type': 'done', 'op_id': operation.op_id })
+        operation.state = 'done'
+
+    def _complete(self, operation):
+        self.journal.write({ 'type': 'done', 'op_id': operation.op_id })
+        operation.state = 'done'
+
+    def _run(self, operations):
+        self.manager._run_bulk(self._send, operations)
+
+    def create_many(self, specs):
+        """
+        Journal and create an alert for every :class:`galerts2.AlertSpec`.
+        """
+        self._run(self._plan('create', specs))
+
+    def update_many(self, alerts):
+        """
+        Journal and update every alert in *alerts*.
+        """
+        self._run(self._plan('update', alerts))
+
+    def delete_many(self, alerts):
+        """
+        Journal and delete every alert in *alerts*.
+        """
+        self._run(self._plan('delete', alerts))
+
+    def resume(self):
+        """
+        Complete the operations left over by previous runs.
+
+        Operations that were started but not confirmed are checked against the
+        refreshed window state first: a create whose alert exists, an update
+        whose alert already has the new settings and a delete whose alert is
+        gone are recorded as done without sending anything.
+
+        Returns the number of operations that had to be sent.
+
+        :raises galerts2.BulkOperationError: if some operations fail again
+        """
+        unfinished = [ operation for (op_id, operation) in sorted(self._operations.items())
+                       if operation.state != 'done' ]
+        if not unfinished:
+            return 0
+
+        uncertain = [ operation for operation in unfinished if operation.state is not None ]
+        if uncertain:
+            self.manager.refresh()
+            alerts = dict((alert.alert_id, alert) for alert in self.manager.window_state.alerts)
+            keys = set(alert_key(alert) for alert in alerts.values())
+
+        to_send = []
+        for operation in unfinished:
+            if operation.state is not None:
+                if operation.op == 'create':
+                    applied = alert_key(operation.item) in keys
+                elif operation.op == 'update':
+                    current = alerts.get(operation.item.alert_id)
+                    applied = current is not None and alert_key(current) == alert_key(operation.item)
+                else:
+                    applied = operation.item.alert_id not in alerts
+                if applied:
+                    self._complete(operation)
+                    continue
+            to_send.append(operation)
+
+        self._run(to_send)
+        return len(to_send)
@@ -0,0 +1,278 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Routing feed items to the alerts whose queries they match.
+
+A :class:`QueryMatcher` compiles the queries of many alerts into a single
+Aho-Corasick automaton over word tokens, so each item's text is scanned once
+no matter how many alerts there are::
+
+    >>> matcher = QueryMatcher(gam.window_state.alerts)
+    >>> for item, alert_ids in matcher.route(iter_feed_items(shared_alerts)):
+    ...     print item.link, alert_ids
+    >>> gam.refresh()
+    >>> matcher.update(gam.window_state.alerts)
+
+Queries understand the same syntax as Google Alerts for the parts that can be
+checked against an item's text: words and "quoted phrases" that must all
+occur, ``OR`` between alternatives, and ``-word`` or ``-"phrase"``
+exclusions. Operators such as ``site:`` are ignored, so an alert using them
+matches more items than Google would deliver to it.
+"""
+
+import re
+from collections import deque
+from galerts_feeds import tokenize
+
+_TERM_RE = re.compile(r'(-?)(?:"([^"]*)"|([^\s"]+))')
+
+# when more than this fraction of the phrases in the automaton is no longer
+# used by any alert, it is rebuilt from scratch
+_MAX_UNUSED_RATIO = 0.5
+
+def parse_query(query):
+    """
+    Parse an alert query into (clauses, exclusions).
+
+    *clauses* is a list of alternatives that must all match, each a list of
+    phrases of which at least one must occur. *exclusions* is a list of
+    phrases that must not occur. Phrases are tuples of tokens::
+
+        >>> parse_query(u'"corner confectionery" cake OR pie -recipe')
+        ([[(u'corner', u'confectionery')], [(u'cake',), (u'pie',)]], [(u'recipe',)])
+    """
+    clauses = []
+    exclusions = []
+    join_next = False
+    for match in _TERM_RE.finditer(query.replace('(', ' ').replace(')', ' ')):
+        negated, quoted, word = match.groups()
+        if quoted is None:
+            if word in ('OR', '|'):
+                join_next = bool(clauses)
+                continue
+            if ':' in word:
+                # an operator like site: or intitle:
+                join_next = False
+                continue
+        phrase = tuple(tokenize(quoted if quoted is not None else word))
+        if not phrase:
+            continue
+        if negated:
+            exclusions.append(phrase)
+        elif join_next:
+            clauses[-1].append(phrase)
+        else:
+            clauses.append([ phrase ])
+        join_next = False
+    return clauses, exclusions
+
+class _Rule(object):
+    """
+    A compiled alert query, with phrases replaced by phrase ids.
+    """
+    def __init__(self, alert_id, query, clauses, exclusions):
+        self.alert_id   = alert_id
+        self.query      = query
+        self.clauses    = clauses
+        self.exclusions = exclusions
+
+class QueryMatcher(object):
+    """
+    Matches text against the queries of a set of alerts.
+
+    Phrases shared by several queries are stored once. Adding alerts only
+    extends the automaton and removing them only forgets which alerts use a
+    phrase, until so many phrases are unused that the automaton is rebuilt.
+    Failure links are recomputed before the next match after a change.
+    """
+    def __init__(self, alerts=()):
+        self._reset()
+        for alert in alerts:
+            self.add(alert)
+
+    def _reset(self):
+        self._rules = {}
+
+        # phrase -> phrase id, and per phrase id the (alert_id, clause index)
+        # pairs it satisfies and the alert_ids it excludes
+        self._phrase_ids = {}
+        self._positive   = []
+        self._negative   = []
+        self._unused     = set()
+
+        # per node of the automaton: transitions by token, failure link, the
+        # ids of the phrases ending at the node, and those plus the phrases
+        # ending at its suffixes
+        self._goto     = [ {} ]
+        self._fail     = [ 0 ]
+        self._own      = [ () ]
+        self._outputs  = [ () ]
+        self._compiled = True
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __contains__(self, alert_id):
+        return alert_id in self._rules
+
+    def _phrase_id(self, phrase):
+        phrase_id = self._phrase_ids.get(phrase)
+        if phrase_id is not None:
+            self._unused.discard(phrase_id)
+            return phrase_id
+
+        phrase_id = len(self._positive)
+        self._phrase_ids[phrase] = phrase_id
+        self._positive.append([])
+        self._negative.append([])
+
+        node = 0
+        for token in phrase:
+            next_node = self._goto[node].get(token)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][token] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._own.append(())
+                self._outputs.append(())
+            node = next_node
+        self._own[node] += (phrase_id,)
+        self._compiled = False
+        return phrase_id
+
+    def add(self, alert):
+        """
+        Start matching the query of *alert*, replacing the alert's previous
+        query if it was added before.
+        """
+        rule = self._rules.get(alert.alert_id)
+        if rule is not None:
+            if rule.query == alert.query:
+                return
+            self.remove(alert.alert_id)
+
+        clauses, exclusions = parse_query(alert.query)
+        rule = _Rule(alert.alert_id, alert.query,
+                     [ [ self._phrase_id(phrase) for phrase in clause ] for clause in clauses ],
+                     [ self._phrase_id(phrase) for phrase in exclusions ])
+        self._rules[alert.alert_id] = rule
+
+        for index, clause in enumerate(rule.clauses):
+            for phrase_id in clause:
+                self._positive[phrase_id].append((alert.alert_id, index))
+        for phrase_id in rule.exclusions:
+            self._negative[phrase_id].append(alert.alert_id)
+
+    def remove(self, alert_id):
+        """
+        Stop matching the query of the alert *alert_id*. Returns whether it
+        was being matched.
+        """
+        rule = self._rules.pop(alert_id, None)
+        if rule is None:
+            return False
+
+        phrase_ids = set(rule.exclusions)
+        for clause in rule.clauses:
+            phrase_ids.update(clause)
+        for phrase_id in phrase_ids:
+            self._positive[phrase_id] = [ ref for ref in self._positive[phrase_id] if ref[0] != alert_id ]
+            self._negative[phrase_id] = [ ref for ref in self._negative[phrase_id] if ref != alert_id ]
+            if not self._positive[phrase_id] and not self._negative[phrase_id]:
+                self._unused.add(phrase_id)
+
+        if len(self._unused) > _MAX_UNUSED_RATIO * len(self._positive):
+            rules = list(self._rules.values())
+            self._reset()
+            for rule in rules:
+                self.add(rule)
+        return True
+
+    def update(self, alerts):
+        """
+        Bring the matcher in line with *alerts*, e.g. the alerts of a
+        refreshed :class:`galerts2.WindowState`. Only alerts that are new,
+        gone or whose query changed are compiled again.
+
+        Returns a tuple (added, removed) with the number of queries added and
+        dropped.
+        """
+        current = dict((alert.alert_id, alert) for alert in alerts)
+        removed = [ alert_id for alert_id in self._rules if alert_id not in current ]
+        for alert_id in removed:
+            self.remove(alert_id)
+
+        added = 0
+        for alert_id, alert in current.items():
+            rule = self._rules.get(alert_id)
+            if rule is None or rule.query != alert.query:
+                self.add(alert)
+                added += 1
+        return (added, len(removed))
+
+    def _compile(self):
+        """
+        Compute the failure links and outputs of all nodes breadth first.
+        """
+        goto, fail, own, outputs = self._goto, self._fail, self._own, self._outputs
+        queue = deque()
+        for node in goto[0].values():
+            fail[node] = 0
+            outputs[node] = own[node]
+            queue.append(node)
+        while queue:
+            node = queue.popleft()
+            for token, child in goto[node].items():
+                state = fail[node]
+                while state and token not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(token, 0)
+                outputs[child] = own[child] + outputs[fail[child]]
+                queue.append(child)
+        self._compiled = True
+
+    def _phrases_in(self, tokens):
+        """
+        Return the set of ids of the phrases occurring in *tokens*.
+        """
+        if not self._compiled:
+            self._compile()
+
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        found = set()
+        state = 0
+        for token in tokens:
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+    def match(self, text):
+        """
+        Return the set of ids of the alerts whose queries *text* matches.
+        """
+        found = self._phrases_in(tokenize(text))
+        if not found:
+            return set()
+
+        satisfied = {}
+        excluded = set()
+        for phrase_id in found:
+            for alert_id, index in self._positive[phrase_id]:
+                satisfied.setdefault(alert_id, set()).add(index)
+            excluded.update(self._negative[phrase_id])
+
+        return set(alert_id for (alert_id, clauses) in satisfied.items()
+                   if alert_id not in excluded and len(clauses) == len(self._rules[alert_id].clauses))
+
+    def route(self, items):
+        """
+        Yield an (item, alert_ids) tuple for every :class:`galerts_feeds.FeedItem`
+        of *items*, where alert_ids is the set of alerts it matches.
+        """
+        for item in items:
+            yield item, self.match(item.text)
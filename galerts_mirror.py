@@ -0,0 +1,230 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+A local SQLite mirror of the alerts and accounts in a
+:class:`galerts2.WindowState`.
+
+Reporting queries over the alert inventory can run against the mirror instead
+of scraping the Google Alerts page every time::
+
+    >>> mirror = AlertMirror('/var/lib/galerts/alerts.db')
+    >>> gam = galerts2.GoogleAlertsManager(email, password, mirror=mirror)
+    >>> mirror.count_by('language', delivery=galerts2.DeliveryTypes.Feed)
+    {u'en': 120, u'de': 12}
+"""
+
+import json
+import sqlite3
+import threading
+from galerts2 import Account, Alert
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    email         TEXT PRIMARY KEY,
+    account_id    TEXT NOT NULL,
+    language      TEXT,
+    delivery_data TEXT
+);
+CREATE INDEX IF NOT EXISTS accounts_account_id ON accounts (account_id);
+
+CREATE TABLE IF NOT EXISTS alerts (
+    alert_id   TEXT PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    query      TEXT NOT NULL,
+    language   TEXT,
+    region     TEXT,
+    sources    TEXT,
+    volume     INTEGER,
+    frequency  INTEGER,
+    delivery   INTEGER,
+    email      TEXT,
+    feed_id    TEXT,
+    feed_url   TEXT,
+    delivery_hour    INTEGER,
+    delivery_weekday INTEGER
+);
+CREATE INDEX IF NOT EXISTS alerts_account_id ON alerts (account_id);
+CREATE INDEX IF NOT EXISTS alerts_delivery ON alerts (delivery, frequency);
+CREATE INDEX IF NOT EXISTS alerts_language_region ON alerts (language, region);
+CREATE INDEX IF NOT EXISTS alerts_volume ON alerts (volume);
+
+-- one row per source of an alert so alerts can be looked up by source.
+-- Alerts with automatic sources have no rows here.
+CREATE TABLE IF NOT EXISTS alert_sources (
+    alert_id TEXT NOT NULL REFERENCES alerts (alert_id) ON DELETE CASCADE,
+    source   INTEGER NOT NULL,
+    PRIMARY KEY (alert_id, source)
+);
+CREATE INDEX IF NOT EXISTS alert_sources_source ON alert_sources (source);
+'''
+
+# columns of the alerts table in the order of Alert.FIELDS
+_ALERT_COLUMNS = Alert.FIELDS
+_ACCOUNT_COLUMNS = ('email', 'account_id', 'language', 'delivery_data')
+
+# filters accepted by AlertMirror.alerts and AlertMirror.count_by which map
+# directly to a column
+_FILTER_COLUMNS = ('account_id', 'email', 'language', 'region', 'volume', 'frequency', 'delivery')
+
+def _alert_row(alert):
+    row = []
+    for field in _ALERT_COLUMNS:
+        value = getattr(alert, field)
+        if field == 'sources':
+            value = json.dumps(value)
+        row.append(value)
+    return tuple(row)
+
+def _account_row(account):
+    return (account.email, account.account_id, account.language, json.dumps(account.delivery_data))
+
+class AlertMirror(object):
+    """
+    Keeps a SQLite database in sync with the alerts of one or more accounts.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file name of the database, or ``':memory:'``
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA foreign_keys = ON')
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def sync(self, window_state):
+        """
+        Bring the mirror up to date with *window_state*.
+
+        Only alerts and accounts whose values changed are written, and alerts
+        of the window state's accounts which no longer exist are deleted. All
+        changes are applied in a single transaction.
+
+        Returns a tuple (upserted, deleted) with the number of alerts changed.
+        """
+        account_ids = set(account.account_id for account in window_state.accounts.values())
+        account_ids.update(alert.account_id for alert in window_state.alerts)
+
+        with self._lock:
+            with self._conn:
+                cursor = self._conn.cursor()
+
+                existing_accounts = {}
+                for row in cursor.execute('SELECT ' + ', '.join(_ACCOUNT_COLUMNS) + ' FROM accounts'):
+                    existing_accounts[row[0]] = tuple(row)
+                for account in window_state.accounts.values():
+                    row = _account_row(account)
+                    if existing_accounts.get(account.email) != row:
+                        cursor.execute('INSERT OR REPLACE INTO accounts (' + ', '.join(_ACCOUNT_COLUMNS) +
+                                       ') VALUES (?, ?, ?, ?)', row)
+
+                existing = {}
+                placeholders = ', '.join('?' for _ in account_ids)
+                if account_ids:
+                    for row in cursor.execute('SELECT ' + ', '.join(_ALERT_COLUMNS) +
+                                              ' FROM alerts WHERE account_id IN (' + placeholders + ')',
+                                              tuple(account_ids)):
+                        existing[row[0]] = tuple(row)
+
+                upserted = 0
+                for alert in window_state.alerts:
+                    row = _alert_row(alert)
+                    if existing.pop(alert.alert_id, None) == row:
+                        continue
+                    cursor.execute('INSERT OR REPLACE INTO alerts (' + ', '.join(_ALERT_COLUMNS) + ') VALUES (' +
+                                   ', '.join('?' for _ in _ALERT_COLUMNS) + ')', row)
+                    cursor.execute('DELETE FROM alert_sources WHERE alert_id = ?', (alert.alert_id,))
+                    cursor.executemany('INSERT OR IGNORE INTO alert_sources (alert_id, source) VALUES (?, ?)',
+                                       [ (alert.alert_id, source) for source in (alert.sources or ()) ])
+                    upserted += 1
+
+                # whatever is left wasn't in the window state anymore
+                cursor.executemany('DELETE FROM alerts WHERE alert_id = ?', [ (alert_id,) for alert_id in existing ])
+
+        return (upserted, len(existing))
+
+    def _where(self, filters):
+        clauses = []
+        args = []
+        for name, value in sorted(filters.items()):
+            if value is None:
+                continue
+            if name == 'source':
+                clauses.append('alert_id IN (SELECT alert_id FROM alert_sources WHERE source = ?)')
+            elif name in _FILTER_COLUMNS:
+                clauses.append(name + ' = ?')
+            else:
+                raise ValueError('Unknown filter: ' + name)
+            args.append(value)
+        if not clauses:
+            return '', ()
+        return ' WHERE ' + ' AND '.join(clauses), tuple(args)
+
+    def alerts(self, **filters):
+        """
+        Return a list of :class:`galerts2.Alert` objects from the mirror.
+
+        Keyword arguments filter on the alert attributes account_id, email,
+        language, region, volume, frequency and delivery, or on a single
+        *source* contained in the alert's sources.
+        """
+        where, args = self._where(filters)
+        with self._lock:
+            rows = self._conn.execute('SELECT ' + ', '.join(_ALERT_COLUMNS) + ' FROM alerts' + where +
+                                      ' ORDER BY account_id, alert_id', args).fetchall()
+        alerts = []
+        for row in rows:
+            d = dict(zip(_ALERT_COLUMNS, row))
+            d['sources'] = json.loads(d['sources'])
+            alerts.append(Alert.from_dict(d))
+        return alerts
+
+    def alert(self, alert_id):
+        """
+        Return the alert with *alert_id*, or ``None`` if it isn't mirrored.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT ' + ', '.join(_ALERT_COLUMNS) + ' FROM alerts WHERE alert_id = ?',
+                                     (alert_id,)).fetchone()
+        if row is None:
+            return None
+        d = dict(zip(_ALERT_COLUMNS, row))
+        d['sources'] = json.loads(d['sources'])
+        return Alert.from_dict(d)
+
+    def accounts(self):
+        """
+        Return a dict mapping email addresses to :class:`galerts2.Account`
+        objects.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT ' + ', '.join(_ACCOUNT_COLUMNS) + ' FROM accounts').fetchall()
+        accounts = {}
+        for row in rows:
+            d = dict(zip(_ACCOUNT_COLUMNS, row))
+            d['delivery_data'] = json.loads(d['delivery_data'])
+            accounts[d['email']] = Account.from_dict(d)
+        return accounts
+
+    def count_by(self, column, **filters):
+        """
+        Count alerts grouped by *column* (any of the filter names, or
+        ``'source'``), optionally restricted by *filters* as in
+        :meth:`alerts`. Returns a dict mapping values to counts.
+        """
+        where, args = self._where(filters)
+        if column == 'source':
+            sql = ('SELECT source, COUNT(*) FROM alert_sources WHERE alert_id IN (SELECT alert_id FROM alerts' +
+                   where + ') GROUP BY source')
+        elif column in _FILTER_COLUMNS:
+            sql = 'SELECT ' + column + ', COUNT(*) FROM alerts' + where + ' GROUP BY ' + column
+        else:
+            raise ValueError('Unknown column: ' + column)
+        with self._lock:
+            return dict(self._conn.execute(sql, args).fetchall())
@@ -0,0 +1,404 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Streaming the items of alert feeds into a sink.
+
+A :class:`FeedPipeline` fetches the feeds of a set of alerts, parses them,
+drops duplicates and unwanted items, and writes the rest to a sink in
+batches. Every stage runs in its own threads and hands its output to the next
+one through a bounded queue, so when the sink falls behind the queues fill up
+and fetching slows down instead of piling items up in memory::
+
+    >>> pipeline = FeedPipeline(SQLiteSink('items.db'), fetch_threads=8, batch_size=200)
+    >>> stats = pipeline.run(gam.window_state.alerts)
+    >>> print stats
+    <PipelineStats feeds: 412, items: 8120, written: 6311, failures: 2>
+
+Sinks have a ``write(items)`` method taking a list of
+:class:`galerts_feeds.FeedItem` objects and a ``close()`` method. This module
+provides :class:`FileSink`, :class:`SQLiteSink` and :class:`HTTPSink`.
+"""
+
+import json
+import time
+import Queue
+import sqlite3
+import urllib2
+import threading
+from galerts2 import UnexpectedResponseError
+from galerts_feeds import fetch_feed_body, parse_feed
+
+# marks the end of a stage's input
+_DONE = object()
+
+# how often threads blocked on a full or empty queue check whether the
+# pipeline has been aborted
+_POLL_INTERVAL = 0.1
+
+def iter_batches(get, batch_size, batch_delay, done=_DONE):
+    """
+    Yield lists of the values returned by *get* until it returns *done*.
+
+    A batch is yielded once it holds *batch_size* values, once *batch_delay*
+    seconds have passed since its first value arrived, and at the end.
+
+    :param get: called with the seconds to wait for the next value, or
+        ``None`` to wait as long as it takes, like :meth:`Queue.Queue.get`.
+        Raises :class:`Queue.Empty` if no value arrived in time.
+    """
+    batch = []
+    started = None
+    while True:
+        timeout = None
+        if batch:
+            timeout = max(0, started + batch_delay - time.time())
+        try:
+            value = get(timeout)
+        except Queue.Empty:
+            value = None
+
+        if value is done:
+            if batch:
+                yield batch
+            return
+        if value is not None:
+            if not batch:
+                started = time.time()
+            batch.append(value)
+        if batch and (value is None or len(batch) >= batch_size):
+            yield batch
+            batch = []
+
+class FileSink(object):
+    """
+    Appends items to a file, one JSON object per line.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def write(self, items):
+        self._file.write(''.join(json.dumps(item.as_dict(), separators=(',', ':')) + '\n' for item in items))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+_ITEMS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    alert_id    TEXT NOT NULL,
+    item_id     TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    title       TEXT,
+    link        TEXT,
+    content     TEXT,
+    published   INTEGER,
+    updated     INTEGER,
+    PRIMARY KEY (alert_id, item_id)
+);
+CREATE INDEX IF NOT EXISTS items_fingerprint ON items (fingerprint);
+CREATE INDEX IF NOT EXISTS items_published ON items (published);
+'''
+
+class SQLiteSink(object):
+    """
+    Stores items in the ``items`` table of a SQLite database, one transaction
+    per batch. An item delivered again replaces the stored one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_ITEMS_SCHEMA)
+
+    def write(self, items):
+        rows = [ (item.alert_id, item.item_id, item.fingerprint, item.title, item.link, item.content,
+                  item.published, item.updated) for item in items ]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO items (alert_id, item_id, fingerprint, title, link, '
+                                       'content, published, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self._conn.close()
+
+class HTTPSink(object):
+    """
+    POSTs every batch as a JSON array of items to *url*, e.g. a local queue
+    or ingestion service.
+    """
+    def __init__(self, url, opener=None, timeout=30):
+        self.url     = url
+        self.opener  = opener if opener is not None else urllib2.build_opener()
+        self.timeout = timeout
+
+    def write(self, items):
+        request = urllib2.Request(self.url, json.dumps([ item.as_dict() for item in items ]),
+                                  { 'Content-Type': 'application/json' })
+        response = self.opener.open(request, timeout=self.timeout)
+        try:
+            resp_code = response.getcode()
+            if resp_code < 200 or resp_code >= 300:
+                raise UnexpectedResponseError(resp_code, response.info().headers, response.read())
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+class PipelineStats(object):
+    """
+    What a :meth:`FeedPipeline.run` did. :attr:`failures` is a list of
+    (alert, exception) pairs for the feeds that couldn't be fetched or
+    parsed.
+    """
+    def __init__(self):
+        self.feeds    = 0
+        self.items    = 0
+        self.dropped  = 0
+        self.written  = 0
+        self.batches  = 0
+        self.failures = []
+        self.elapsed  = 0.0
+
+    def __str__(self):
+        return '<PipelineStats feeds: {}, items: {}, written: {}, failures: {}>'.format(
+            self.feeds, self.items, self.written, len(self.failures))
+
+class FeedPipeline(object):
+    """
+    Moves feed items from alerts to a sink through the stages fetch, parse
+    (including filtering) and write.
+    """
+    def __init__(self, sink, fetch_threads=4, parse_threads=1, write_threads=1, max_bodies=16,
+                 max_items=1000, batch_size=100, batch_delay=1.0, dedupe=True, filters=(), opener=None,
+                 yield_stats=None, timeout=60):
+        """
+        :param sink: the object the items are written to
+        :param fetch_threads: number of feeds downloaded at the same time
+        :param parse_threads: number of threads parsing and filtering feeds
+        :param write_threads: number of batches written at the same time.
+            Only use more than one if the sink supports it.
+        :param max_bodies: number of downloaded feeds that may wait to be
+            parsed before fetching blocks
+        :param max_items: number of items that may wait to be written before
+            parsing blocks
+        :param batch_size: the maximum number of items per call of the sink's
+            ``write``
+        :param batch_delay: seconds after which a partial batch is written
+            anyway while waiting for more items
+        :param dedupe: drop items whose :attr:`galerts_feeds.FeedItem.fingerprint`
+            was already seen during the run
+        :param filters: functions called with each item; items for which any
+            of them returns a false value are dropped
+        :param opener: the opener used to fetch feeds
+        :param yield_stats: a :class:`galerts_yield.YieldStats` that every
+            fetched feed is recorded in
+        :param timeout: seconds to wait for Google on every socket operation
+            while fetching a feed, so a hung connection can't stall a fetch
+            thread
+        """
+        self.sink          = sink
+        self.fetch_threads = fetch_threads
+        self.parse_threads = parse_threads
+        self.write_threads = write_threads
+        self.max_bodies    = max_bodies
+        self.max_items     = max_items
+        self.batch_size    = batch_size
+        self.batch_delay   = batch_delay
+        self.dedupe        = dedupe
+        self.filters       = list(filters)
+        self.opener        = opener if opener is not None else urllib2.build_opener()
+        self.yield_stats   = yield_stats
+        self.timeout       = timeout
+
+    def run(self, alerts):
+        """
+        Stream the items of the feeds of *alerts* into the sink and return a
+        :class:`PipelineStats`. Alerts without a feed are skipped.
+
+        Feeds that fail to download or parse are recorded in the stats and
+        don't stop the run. An error raised by the sink, a filter or the
+        yield stats aborts the run and is raised once all threads have
+        stopped.
+        """
+        return _Run(self, alerts).run()
+
+class _Run(object):
+    """
+    The threads, queues and counters of a single :meth:`FeedPipeline.run`.
+    """
+    def __init__(self, pipeline, alerts):
+        self.pipeline = pipeline
+        self.alerts   = alerts
+        self.stats    = PipelineStats()
+        self.aborted  = threading.Event()
+        self.error    = None
+        self.lock     = threading.Lock()
+        self.seen     = set()
+
+        self.to_fetch = Queue.Queue(pipeline.fetch_threads * 2)
+        self.to_parse = Queue.Queue(pipeline.max_bodies)
+        self.to_write = Queue.Queue(pipeline.max_items)
+
+    def _put(self, queue, value):
+        while not self.aborted.is_set():
+            try:
+                queue.put(value, timeout=_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get(self, queue, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.aborted.is_set():
+            wait = _POLL_INTERVAL if deadline is None else min(_POLL_INTERVAL, deadline - time.time())
+            if wait <= 0:
+                raise Queue.Empty()
+            try:
+                return queue.get(timeout=wait)
+            except Queue.Empty:
+                pass
+        return _DONE
+
+    def _stage(self, target, count, output, downstream):
+        """
+        Start *count* threads running *target*. Once all of them have
+        finished, *downstream* end markers are put into *output*.
+        """
+        threads = [ threading.Thread(target=target) for _ in range(count) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        def finish():
+            for thread in threads:
+                thread.join()
+            for _ in range(downstream):
+                self._put(output, _DONE)
+
+        closer = threading.Thread(target=finish)
+        closer.daemon = True
+        closer.start()
+        return closer
+
+    def _feed_alerts(self):
+        for alert in self.alerts:
+            if alert.feed_url is not None and not self._put(self.to_fetch, alert):
+                return
+
+    def _fetch(self):
+        while True:
+            alert = self._get(self.to_fetch)
+            if alert is _DONE:
+                return
+            try:
+                body = fetch_feed_body(alert, self.pipeline.opener, self.pipeline.timeout)
+            except Exception as e:
+                with self.lock:
+                    self.stats.failures.append((alert, e))
+                continue
+            if not self._put(self.to_parse, (alert, body)):
+                return
+
+    def _keep(self, item):
+        for func in self.pipeline.filters:
+            if not func(item):
+                return False
+        if self.pipeline.dedupe:
+            fingerprint = item.fingerprint
+            with self.lock:
+                if fingerprint in self.seen:
+                    return False
+                self.seen.add(fingerprint)
+        return True
+
+    def _parse(self):
+        while True:
+            entry = self._get(self.to_parse)
+            if entry is _DONE:
+                return
+            alert, body = entry
+            try:
+                items = parse_feed(body, alert.alert_id)
+            except Exception as e:
+                with self.lock:
+                    self.stats.failures.append((alert, e))
+                continue
+            # errors of the filters and the stats are the user's, not the
+            # feed's, and abort the run like errors of the sink
+            try:
+                if self.pipeline.yield_stats is not None:
+                    self.pipeline.yield_stats.record(alert.alert_id, items, len(body))
+                kept = [ item for item in items if self._keep(item) ]
+            except Exception as e:
+                self._abort(e)
+                return
+            with self.lock:
+                self.stats.feeds   += 1
+                self.stats.items   += len(items)
+                self.stats.dropped += len(items) - len(kept)
+            for item in kept:
+                if not self._put(self.to_write, item):
+                    return
+
+    def _abort(self, error):
+        """
+        Stop the run; *error* is raised by :meth:`run` unless an earlier one
+        was recorded.
+        """
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.aborted.set()
+
+    def _write_batch(self, batch):
+        try:
+            self.pipeline.sink.write(batch)
+        except Exception as e:
+            self._abort(e)
+            return False
+        with self.lock:
+            self.stats.written += len(batch)
+            self.stats.batches += 1
+        return True
+
+    def _write(self):
+        get = lambda timeout: self._get(self.to_write, timeout)
+        for batch in iter_batches(get, self.pipeline.batch_size, self.pipeline.batch_delay):
+            if self.aborted.is_set() or not self._write_batch(batch):
+                return
+
+    def run(self):
+        pipeline = self.pipeline
+        started = time.time()
+
+        feeder = threading.Thread(target=self._feed_alerts)
+        feeder.daemon = True
+        feeder.start()
+
+        def end_of_alerts():
+            feeder.join()
+            for _ in range(pipeline.fetch_threads):
+                self._put(self.to_fetch, _DONE)
+        ender = threading.Thread(target=end_of_alerts)
+        ender.daemon = True
+        ender.start()
+
+        stages = [
+            self._stage(self._fetch, pipeline.fetch_threads, self.to_parse, pipeline.parse_threads),
+            self._stage(self._parse, pipeline.parse_threads, self.to_write, pipeline.write_threads),
+            self._stage(self._write, pipeline.write_threads, None, 0),
+        ]
+        # after an abort the earlier stages only stop once their current feed
+        # is done, so wait for all of them
+        for stage in [ ender ] + stages:
+            stage.join()
+
+        self.stats.elapsed = time.time() - started
+        if self.error is not None:
+            raise self.error
+        return self.stats
@@ -0,0 +1,281 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Polling alert feeds from several worker processes or hosts.
+
+Every worker registers itself in a shared SQLite database and places the
+live workers on a consistent hash ring. Each feed is polled by the worker
+its ``feed_id`` hashes to, so when a worker joins or leaves only the feeds
+on its part of the ring move. Before polling a feed a worker takes a lease on
+it in the database; a feed is only leased when it is due and not leased by
+someone else, so no feed is polled twice even while workers disagree about
+the ring for a moment::
+
+    >>> coordinator = PollCoordinator('/shared/galerts-polling.db', 'worker-3')
+    >>> poller = PartitionedPoller(coordinator, handle_items, interval=300)
+    >>> poller.run(lambda: gam.window_state.alerts)
+
+The database has to live on a file system with working locks (a local disk
+shared by the worker processes, not NFS).
+"""
+
+import time
+import bisect
+import hashlib
+import sqlite3
+import threading
+from galerts_feeds import fetch_feed
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS workers (
+        worker_id TEXT PRIMARY KEY,
+        heartbeat REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS leases (
+        feed_id   TEXT PRIMARY KEY,
+        worker_id TEXT,
+        expires   REAL NOT NULL DEFAULT 0,
+        polled_at REAL
+    )''',
+)
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing(object):
+    """
+    A consistent hash ring placing every node at *replicas* points.
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points  = []
+        self._nodes   = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._nodes.values()))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash(u'{}#{}'.format(node, i))
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            point = _hash(u'{}#{}'.format(node, i))
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def node_for(self, key):
+        """
+        Return the node responsible for *key*, or ``None`` if the ring is
+        empty.
+        """
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+class PollCoordinator(object):
+    """
+    The membership and feed leases of the workers, kept in the SQLite
+    database at *path*.
+    """
+    def __init__(self, path, worker_id, heartbeat_timeout=60.0):
+        """
+        :param worker_id: a name for this worker, unique among all workers
+        :param heartbeat_timeout: seconds after its last heartbeat after
+            which a worker is considered gone
+        """
+        self.path = path
+        self.worker_id = worker_id
+        self.heartbeat_timeout = heartbeat_timeout
+        # transactions are started explicitly, see _transaction
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        # workers starting at the same time would trip over each other's
+        # schema changes outside of a transaction
+        self._transaction([ (statement, ()) for statement in _SCHEMA ])
+
+    def close(self):
+        self._conn.close()
+
+    def _transaction(self, statements):
+        """
+        Run *statements*, a list of (sql, args) tuples, in one transaction
+        that holds the database's write lock from the start. Returns the
+        number of rows changed by the last statement.
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, args in statements:
+                    cursor.execute(sql, args)
+                rowcount = cursor.rowcount
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return rowcount
+
+    def heartbeat(self):
+        """
+        Announce that this worker is alive.
+        """
+        self._transaction([ ('INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)',
+                             (self.worker_id, time.time())) ])
+
+    def leave(self):
+        """
+        Remove this worker and release its leases, so its feeds move to the
+        other workers right away.
+        """
+        self._transaction([
+            ('DELETE FROM workers WHERE worker_id = ?', (self.worker_id,)),
+            ('UPDATE leases SET worker_id = NULL, expires = 0 WHERE worker_id = ?', (self.worker_id,)),
+        ])
+
+    def workers(self):
+        """
+        Return the ids of the live workers.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT worker_id FROM workers WHERE heartbeat >= ? ORDER BY worker_id',
+                                      (time.time() - self.heartbeat_timeout,)).fetchall()
+        return [ row[0] for row in rows ]
+
+    def claim(self, feed_id, interval, lease):
+        """
+        Lease the feed *feed_id* for *lease* seconds if it wasn't polled in
+        the last *interval* seconds and isn't leased by another worker.
+        Returns whether the lease was taken.
+        """
+        now = time.time()
+        changed = self._transaction([
+            ('INSERT OR IGNORE INTO leases (feed_id) VALUES (?)', (feed_id,)),
+            ('UPDATE leases SET worker_id = ?, expires = ? WHERE feed_id = ? '
+             'AND (expires < ? OR worker_id = ?) AND (polled_at IS NULL OR polled_at <= ?)',
+             (self.worker_id, now + lease, feed_id, now, self.worker_id, now - interval)),
+        ])
+        return changed == 1
+
+    def release(self, feed_id, polled=True):
+        """
+        Give up the lease on *feed_id*, recording that it was polled now if
+        *polled* is set.
+        """
+        if polled:
+            sql = 'UPDATE leases SET worker_id = NULL, expires = 0, polled_at = ? WHERE feed_id = ? AND worker_id = ?'
+            args = (time.time(), feed_id, self.worker_id)
+        else:
+            sql = 'UPDATE leases SET worker_id = NULL, expires = 0 WHERE feed_id = ? AND worker_id = ?'
+            args = (feed_id, self.worker_id)
+        self._transaction([ (sql, args) ])
+
+class PartitionedPoller(object):
+    """
+    Polls this worker's share of the alert feeds.
+    """
+    def __init__(self, coordinator, handler, interval=300.0, lease=None, replicas=64, opener=None, timeout=60):
+        """
+        :param coordinator: the :class:`PollCoordinator` of this worker
+        :param handler: called with (alert, items) for every polled feed
+        :param interval: seconds between two polls of the same feed
+        :param lease: seconds a feed stays leased while it is being polled;
+            a worker that dies while polling blocks the feed for this long.
+            Defaults to *interval*.
+        :param replicas: points per worker on the hash ring
+        :param opener: the opener used to fetch feeds
+        :param timeout: seconds to wait for Google on every socket operation.
+            Keep it well below *lease*, or a hanging fetch outlives the lease
+            and another worker polls the feed as well.
+        """
+        self.coordinator = coordinator
+        self.handler     = handler
+        self.interval    = interval
+        self.lease       = lease if lease is not None else interval
+        self.replicas    = replicas
+        self.opener      = opener
+        self.timeout     = timeout
+        self.failures    = []
+
+    def assigned(self, alerts):
+        """
+        Return the feed alerts of *alerts* that hash to this worker on the
+        ring of the currently live workers.
+        """
+        workers = self.coordinator.workers()
+        if self.coordinator.worker_id not in workers:
+            workers.append(self.coordinator.worker_id)
+        ring = HashRing(workers, self.replicas)
+        return [ alert for alert in alerts
+                 if alert.feed_id is not None and ring.node_for(alert.feed_id) == self.coordinator.worker_id ]
+
+    def poll_once(self, alerts):
+        """
+        Poll the feeds assigned to this worker that are due. Returns the
+        number of feeds polled. The polls that failed are kept in
+        :attr:`failures` as (alert, exception) pairs until the next round,
+        which retries them.
+        """
+        self.failures = []
+        self.coordinator.heartbeat()
+        # a round can take longer than the heartbeat timeout, and the other
+        # workers must not take this worker for gone while it runs
+        done = threading.Event()
+        beater = threading.Thread(target=self._beat, args=(done,))
+        beater.daemon = True
+        beater.start()
+        try:
+            polled = 0
+            for alert in self.assigned(alerts):
+                if not self.coordinator.claim(alert.feed_id, self.interval, self.lease):
+                    continue
+                try:
+                    items = fetch_feed(alert, self.opener, self.timeout)
+                    self.handler(alert, items)
+                except Exception as e:
+                    self.coordinator.release(alert.feed_id, polled=False)
+                    self.failures.append((alert, e))
+                    continue
+                self.coordinator.release(alert.feed_id)
+                polled += 1
+            return polled
+        finally:
+            done.set()
+            beater.join()
+
+    def _beat(self, done):
+        """
+        Send a heartbeat every third of the heartbeat timeout until *done* is
+        set.
+        """
+        while not done.wait(self.coordinator.heartbeat_timeout / 3.0):
+            try:
+                self.coordinator.heartbeat()
+            except sqlite3.Error:
+                # the database is busy; the next beat tries again
+                pass
+
+    def run(self, alerts, stop=None, pause=5.0):
+        """
+        Poll in rounds until *stop* (a :class:`threading.Event`) is set, then
+        leave the ring.
+
+        :param alerts: the alerts to poll, or a function returning them so
+            that every round sees the current alerts
+        :param pause: seconds to wait between rounds
+        """
+        stop = stop if stop is not None else threading.Event()
+        try:
+            while not stop.is_set():
+                self.poll_once(alerts() if callable(alerts) else alerts)
+                stop.wait(pause)
+        finally:
+            self.coordinator.leave()
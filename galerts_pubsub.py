@@ -0,0 +1,238 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Pushing new feed items to local subscribers.
+
+A :class:`Publisher` receives the items of polled feeds and delivers the ones
+it hasn't seen before to every subscriber interested in them. A subscriber is
+a function called with a list of items or a URL that batches are POSTed to as
+JSON, and selects items by the ``alert_id``, query or sources of the alert
+that delivered them::
+
+    >>> publisher = Publisher(gam.window_state.alerts)
+    >>> publisher.subscribe('http://localhost:9000/items', queries=['galerts'])
+    >>> publisher.subscribe(handle_items, alert_ids=[alert.alert_id], batch_size=1)
+    >>> FeedPipeline(publisher).run(gam.window_state.alerts)
+
+Every subscriber has its own bounded queue and delivery thread, which sends
+items in batches and retries failed deliveries with backoff, so a slow or
+failing subscriber only delays itself. When its queue is full, new items for
+that subscriber are dropped and counted instead of blocking publishing.
+
+A publisher has the ``write``/``close`` interface of the sinks of
+:mod:`galerts_pipeline`, so it can be used as one.
+"""
+
+import time
+import Queue
+import threading
+from collections import OrderedDict
+from galerts_pipeline import HTTPSink, iter_batches
+
+# marks the end of a subscriber's queue
+_DONE = object()
+
+class Subscription(object):
+    """
+    A subscriber, the items it wants and its delivery counters.
+    """
+    def __init__(self, target, alert_ids=None, queries=None, sources=None, batch_size=50, batch_delay=1.0,
+                 max_queue=10000, retries=3, backoff=1.0, opener=None):
+        """
+        :param target: a function called with a list of
+            :class:`galerts_feeds.FeedItem` objects, or the URL of an endpoint
+            that receives them as a JSON array
+        :param alert_ids: only deliver items of these alerts
+        :param queries: only deliver items of alerts with one of these queries
+        :param sources: only deliver items of alerts with one of these
+            sources
+        :param batch_size: the maximum number of items per delivery
+        :param batch_delay: seconds after which a partial batch is delivered
+            anyway
+        :param max_queue: the number of items that may wait for delivery;
+            further items are dropped
+        :param retries: how often a failed delivery is retried before its
+            items are given up
+        :param backoff: seconds before the first retry, doubled for every
+            further one
+        :param opener: the opener used to POST to a URL target
+        """
+        if isinstance(target, basestring):
+            self.url = target
+            self.deliver = HTTPSink(target, opener).write
+        else:
+            self.url = None
+            self.deliver = target
+        self.alert_ids   = frozenset(alert_ids) if alert_ids is not None else None
+        self.queries     = frozenset(queries) if queries is not None else None
+        self.sources     = frozenset(sources) if sources is not None else None
+        self.batch_size  = batch_size
+        self.batch_delay = batch_delay
+        self.retries     = retries
+        self.backoff     = backoff
+
+        # the counters are updated by publishing threads and the delivery
+        # thread, under _lock
+        self.delivered = 0
+        self.dropped   = 0
+        self.failed    = 0
+        self.errors    = []
+
+        self._queue  = Queue.Queue(max_queue)
+        self._thread = None
+        self._lock   = threading.Lock()
+
+    def wants(self, item, alert):
+        """
+        Return whether the subscriber wants *item*, delivered by *alert*
+        (``None`` if the alert isn't known).
+        """
+        if self.alert_ids is not None and item.alert_id not in self.alert_ids:
+            return False
+        if self.queries is not None and (alert is None or alert.query not in self.queries):
+            return False
+        if self.sources is not None and (alert is None or not self.sources.intersection(alert.sources or ())):
+            return False
+        return True
+
+    def _offer(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop(self):
+        # the end marker has to get in even if the queue is full
+        self._queue.put(_DONE)
+        self._thread.join()
+
+    def _send(self, batch):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                if attempt == self.retries:
+                    with self._lock:
+                        self.failed += len(batch)
+                        # keep the last few errors only
+                        self.errors = (self.errors + [ e ])[-10:]
+                    return
+                time.sleep(delay)
+                delay *= 2
+            else:
+                with self._lock:
+                    self.delivered += len(batch)
+                return
+
+    def _run(self):
+        get = lambda timeout: self._queue.get(timeout=timeout)
+        for batch in iter_batches(get, self.batch_size, self.batch_delay, _DONE):
+            self._send(batch)
+
+    @property
+    def pending(self):
+        """
+        The number of items waiting for delivery.
+        """
+        return self._queue.qsize()
+
+    def __str__(self):
+        with self._lock:
+            counters = (self.delivered, self.dropped, self.failed)
+        return '<Subscription target: {}, delivered: {}, dropped: {}, failed: {}>'.format(
+            self.url or getattr(self.deliver, '__name__', self.deliver), *counters)
+
+class Publisher(object):
+    """
+    Delivers new feed items to the :class:`Subscription` objects interested
+    in them.
+    """
+    def __init__(self, alerts=(), remember=100000):
+        """
+        :param alerts: the alerts whose items are published, used to select
+            items by query and sources. See :meth:`set_alerts`.
+        :param remember: the number of published items remembered to
+            recognize the same item delivered again on the next poll
+        """
+        self.remember = remember
+        self.subscriptions = []
+        self._alerts = {}
+        self._seen   = OrderedDict()
+        self._lock   = threading.Lock()
+        self.set_alerts(alerts)
+
+    def set_alerts(self, alerts):
+        """
+        Select items by the settings of *alerts* from now on, e.g. after the
+        window state was refreshed.
+        """
+        alerts = dict((alert.alert_id, alert) for alert in alerts)
+        with self._lock:
+            self._alerts = alerts
+
+    def subscribe(self, target, **kwargs):
+        """
+        Add a subscriber and start delivering to it. Takes the arguments of
+        :class:`Subscription`. Returns the new subscription.
+        """
+        subscription = Subscription(target, **kwargs)
+        subscription._start()
+        with self._lock:
+            self.subscriptions = self.subscriptions + [ subscription ]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stop delivering to *subscription* once the items already queued for
+        it are delivered.
+        """
+        with self._lock:
+            self.subscriptions = [ s for s in self.subscriptions if s is not subscription ]
+        subscription._stop()
+
+    def _is_new(self, item):
+        key = (item.alert_id, item.item_id)
+        if key in self._seen:
+            return False
+        self._seen[key] = True
+        if len(self._seen) > self.remember:
+            self._seen.popitem(last=False)
+        return True
+
+    def publish(self, items):
+        """
+        Queue the items of *items* that weren't published before for the
+        subscribers that want them. Returns the number of new items.
+
+        This never blocks on subscribers.
+        """
+        with self._lock:
+            items = [ item for item in items if self._is_new(item) ]
+            alerts = self._alerts
+            subscriptions = self.subscriptions
+        for item in items:
+            alert = alerts.get(item.alert_id)
+            for subscription in subscriptions:
+                if subscription.wants(item, alert):
+                    subscription._offer(item)
+        return len(items)
+
+    def write(self, items):
+        self.publish(items)
+
+    def close(self):
+        """
+        Deliver the queued items and stop all subscribers.
+        """
+        with self._lock:
+            subscriptions, self.subscriptions = self.subscriptions, []
+        for subscription in subscriptions:
+            subscription._stop()
@@ -0,0 +1,189 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Ranking feed items by their relevance to alert queries, built on NumPy.
+
+A :class:`RelevanceScorer` keeps TF-IDF statistics over the items it has
+ingested and scores whole batches of items against the queries of the current
+alerts at once: the items and the queries are turned into sparse term
+weight matrices, and the cosine similarity of every item with every alert is
+computed as one product of the two::
+
+    >>> scorer = RelevanceScorer(gam.window_state.alerts)
+    >>> top = scorer.top_k(items, k=5, threshold=0.2)
+    >>> for score, item in top[alert.alert_id]:
+    ...     print '%.2f' % score, item.link
+
+Scoring ranks items; it doesn't apply the exclusions or phrase structure of
+queries. Use :class:`galerts_matching.QueryMatcher` to decide which alerts
+an item belongs to at all.
+
+This module needs NumPy (``pip install galerts[analytics]``).
+"""
+
+import numpy as np
+from galerts_feeds import tokenize
+from galerts_matching import parse_query
+
+class _Batch(object):
+    """
+    The nonzero entries of the term weight matrix of a batch of texts, as
+    parallel arrays sorted by document.
+    """
+    def __init__(self, docs, terms, counts):
+        self.docs   = docs
+        self.terms  = terms
+        self.counts = counts
+
+class RelevanceScorer(object):
+    """
+    TF-IDF relevance of feed items to the queries of a set of alerts.
+    """
+    def __init__(self, alerts=()):
+        # term -> term id, and the number of ingested documents containing
+        # each term by id
+        self._vocabulary = {}
+        self._df         = np.zeros(1024, dtype=np.int64)
+        self._documents  = 0
+
+        self.alert_ids = []
+        self._query = _Batch(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+        self.set_alerts(alerts)
+
+    def _term_ids(self, tokens, add):
+        """
+        Return the ids of *tokens*, adding new ones to the vocabulary if *add*
+        is set or skipping them otherwise.
+        """
+        vocabulary = self._vocabulary
+        if add:
+            # a new token gets the size of the vocabulary before it was added
+            ids = [ vocabulary.setdefault(token, len(vocabulary)) for token in tokens ]
+        else:
+            ids = [ vocabulary[token] for token in tokens if token in vocabulary ]
+        if len(vocabulary) > len(self._df):
+            self._df = np.concatenate([ self._df, np.zeros(max(len(vocabulary), len(self._df)), dtype=np.int64) ])
+        return ids
+
+    def _batch(self, token_lists, add):
+        docs = []
+        terms = []
+        for doc, tokens in enumerate(token_lists):
+            ids = self._term_ids(tokens, add)
+            docs.extend([ doc ] * len(ids))
+            terms.extend(ids)
+        docs = np.array(docs, dtype=np.int64)
+        terms = np.array(terms, dtype=np.int64)
+        if not len(docs):
+            return _Batch(docs, terms, np.zeros(0))
+
+        # count repeated (doc, term) pairs
+        keys, counts = np.unique(docs * len(self._vocabulary) + terms, return_counts=True)
+        return _Batch(keys // len(self._vocabulary), keys % len(self._vocabulary), counts.astype(float))
+
+    def set_alerts(self, alerts):
+        """
+        Score against the queries of *alerts* from now on, e.g. after the
+        window state was refreshed.
+        """
+        alerts = list(alerts)
+        self.alert_ids = [ alert.alert_id for alert in alerts ]
+        token_lists = []
+        for alert in alerts:
+            clauses, _ = parse_query(alert.query)
+            token_lists.append([ token for clause in clauses for phrase in clause for token in phrase ])
+        # query terms are added to the vocabulary so that items can be matched
+        # against them even before any item containing them was ingested
+        query = self._batch(token_lists, add=True)
+
+        order = np.argsort(query.terms, kind='mergesort')
+        self._query = _Batch(query.docs[order], query.terms[order], query.counts[order])
+
+    def ingest(self, items):
+        """
+        Add the :class:`galerts_feeds.FeedItem` objects *items* to the
+        document frequency statistics.
+        """
+        batch = self._batch([ tokenize(item.text) for item in items ], add=True)
+        self._ingest_batch(batch, len(items))
+
+    def _ingest_batch(self, batch, documents):
+        self._df[:len(self._vocabulary)] += np.bincount(batch.terms, minlength=len(self._vocabulary))
+        self._documents += documents
+
+    def _idf(self):
+        df = self._df[:len(self._vocabulary)]
+        return np.log((1.0 + self._documents) / (1.0 + df)) + 1.0
+
+    def _weights(self, batch, idf, rows):
+        """
+        Return the L2-normalized TF-IDF weights of the entries of *batch*.
+        """
+        weights = (1.0 + np.log(batch.counts)) * idf[batch.terms]
+        norms = np.sqrt(np.bincount(batch.docs, weights * weights, minlength=rows))
+        return weights / norms[batch.docs]
+
+    def score(self, items, ingest=True):
+        """
+        Score every item of *items* against every alert.
+
+        Returns three arrays (item_indices, alert_indices, scores) holding the
+        nonzero cosine similarities; indices refer to *items* and to
+        :attr:`alert_ids`.
+
+        :param ingest: add the items to the statistics before scoring them
+        """
+        items = list(items)
+        batch = self._batch([ tokenize(item.text) for item in items ], add=ingest)
+        if ingest:
+            self._ingest_batch(batch, len(items))
+
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+        query = self._query
+        if not len(batch.docs) or not len(query.docs):
+            return empty
+
+        idf = self._idf()
+        item_weights = self._weights(batch, idf, len(items))
+        query_weights = self._weights(query, idf, len(self.alert_ids))
+
+        # the product of the sparse matrices: pair every item entry with
+        # the query entries of the same term
+        starts = np.searchsorted(query.terms, batch.terms, side='left')
+        ends = np.searchsorted(query.terms, batch.terms, side='right')
+        counts = ends - starts
+        if not counts.sum():
+            return empty
+        entry = np.repeat(np.arange(len(batch.docs)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        query_entry = np.repeat(starts, counts) + offsets
+
+        products = item_weights[entry] * query_weights[query_entry]
+        keys = batch.docs[entry] * len(self.alert_ids) + query.docs[query_entry]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, products)
+        return keys // len(self.alert_ids), keys % len(self.alert_ids), scores
+
+    def top_k(self, items, k=10, threshold=0.0, ingest=True):
+        """
+        Return the *k* best scoring items per alert with a score of at least
+        *threshold*, as a dict mapping alert ids to lists of (score, item)
+        tuples, best first. Alerts without such items are left out.
+        """
+        items = list(items)
+        item_indices, alert_indices, scores = self.score(items, ingest)
+
+        keep = scores >= threshold
+        item_indices, alert_indices, scores = item_indices[keep], alert_indices[keep], scores[keep]
+
+        # sort by alert, best score first, and keep the first k per alert
+        order = np.lexsort((-scores, alert_indices))
+        item_indices, alert_indices, scores = item_indices[order], alert_indices[order], scores[order]
+        group_start = np.searchsorted(alert_indices, alert_indices, side='left')
+        keep = np.arange(len(alert_indices)) - group_start < k
+
+        top = {}
+        for item_index, alert_index, score in zip(item_indices[keep], alert_indices[keep], scores[keep]):
+            top.setdefault(self.alert_ids[alert_index], []).append((float(score), items[item_index]))
+        return top
@@ -0,0 +1,90 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+The HTTP server plumbing shared by :mod:`galerts_daemon` and
+:mod:`galerts_feedproxy`.
+
+Both serve local clients either on a TCP address or on a Unix socket, with a
+thread per request. A service subclasses :class:`RequestHandler`, hands it to
+:func:`make_server` with the objects its handler needs, and builds its command
+line from :func:`add_address_arguments` and :func:`address_from_args`::
+
+    >>> parser = argparse.ArgumentParser()
+    >>> add_address_arguments(parser, '127.0.0.1:8765')
+    >>> args = parser.parse_args()
+    >>> server = make_server(address_from_args(args), AlertsHandler, alerts_daemon=daemon)
+    >>> serve(server)
+"""
+
+import os
+import sys
+import SocketServer
+import BaseHTTPServer
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A request handler that logs requests on Unix sockets too.
+    """
+    def log_message(self, format, *args):
+        # client_address is an empty string for Unix sockets
+        client = self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+        sys.stderr.write('%s - - [%s] %s\n' % (client, self.log_date_time_string(), format % args))
+
+class _TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        # BaseHTTPServer expects these to be set by HTTPServer.server_bind
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def make_server(address, handler_class, **attributes):
+    """
+    Create a threading server handling requests with *handler_class* and
+    listening on *address*, which is either a (host, port) tuple or the path
+    of a Unix socket. The keyword arguments are set as attributes of the
+    server, where the handler finds them as ``self.server.<name>``.
+    """
+    if isinstance(address, tuple):
+        server = _TCPServer(address, handler_class)
+    else:
+        server = _UnixServer(address, handler_class)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    return server
+
+def add_address_arguments(parser, default_listen):
+    """
+    Add the ``--listen`` and ``--socket`` options to the argparse *parser*.
+    """
+    parser.add_argument('--listen', default=default_listen, help='host:port to listen on')
+    parser.add_argument('--socket', help='listen on this Unix socket instead')
+
+def address_from_args(args):
+    """
+    Return the address to listen on given by the options of
+    :func:`add_address_arguments`, for :func:`make_server`.
+    """
+    if args.socket:
+        return args.socket
+    host, port = args.listen.rsplit(':', 1)
+    return (host, int(port))
+
+def serve(server):
+    """
+    Serve until interrupted, then close *server*.
+    """
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
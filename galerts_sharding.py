@@ -0,0 +1,178 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Spreading a desired set of alerts over several Google accounts.
+
+Google limits the number of alerts per account, so large sets of alerts have
+to be sharded over many accounts. :func:`plan_shards` compares the desired
+alerts with what the accounts currently hold and works out the fewest
+creates and deletes that make them match without exceeding any account's
+capacity::
+
+    >>> plan = plan_shards(specs, managers, capacity=1000)
+    >>> print plan
+    <ShardPlan keep: 2810, create: 12, delete: 3>
+    >>> plan.execute()
+"""
+
+from collections import OrderedDict
+from galerts2 import alert_key
+
+class CapacityError(Exception):
+    """
+    Raised when the desired alerts don't fit into the accounts.
+    """
+
+class ShardPlan(object):
+    """
+    The changes needed to make a set of accounts hold the desired alerts.
+
+    :attr:`creates` is a list of (manager, spec) pairs and :attr:`deletes` a
+    list of (manager, alert) pairs. :attr:`placement` maps each manager to the
+    number of desired alerts it holds once the plan has been executed.
+    """
+    def __init__(self, creates, deletes, kept, placement):
+        self.creates   = creates
+        self.deletes   = deletes
+        self.kept      = kept
+        self.placement = placement
+
+    def execute(self):
+        """
+        Apply the plan. Deletes run first, so that alerts moving between
+        accounts never push an account over its capacity.
+        """
+        for manager, alerts in self._by_manager(self.deletes):
+            manager.delete_many(alerts)
+        for manager, specs in self._by_manager(self.creates):
+            manager.create_many(specs)
+
+    @staticmethod
+    def _by_manager(pairs):
+        grouped = []
+        index = {}
+        for manager, item in pairs:
+            if id(manager) not in index:
+                index[id(manager)] = len(grouped)
+                grouped.append((manager, []))
+            grouped[index[id(manager)]][1].append(item)
+        return grouped
+
+    def __str__(self):
+        return '<ShardPlan keep: {}, create: {}, delete: {}>'.format(self.kept, len(self.creates), len(self.deletes))
+
+def _keep_copies(copies, capacities):
+    """
+    Choose which existing copy of each desired alert to keep, keeping as many
+    alerts as the capacities allow. *copies* maps the key of each alert to
+    an ordered dict of its copies by account index. Returns a dict mapping
+    the keys of the kept alerts to the index of the account they stay on.
+
+    Alerts are kept in the order they are listed, each on the first account
+    with room among those holding it. When all of them are full, kept alerts
+    are moved to other accounts holding a copy of them to make room, if that
+    is possible (an augmenting path over the accounts); otherwise the alert
+    is not kept and is placed again like a new one.
+    """
+    count = len(capacities)
+    keep = {}
+    load = [0] * count
+    # movable[i][j]: keys kept on account i that also have a copy on j
+    movable = [ [ set() for _ in range(count) ] for _ in range(count) ]
+
+    def assign(key, i):
+        old = keep.get(key)
+        if old is not None:
+            load[old] -= 1
+            for j in copies[key]:
+                movable[old][j].discard(key)
+        keep[key] = i
+        load[i] += 1
+        for j in copies[key]:
+            if j != i:
+                movable[i][j].add(key)
+
+    for key, holders in copies.items():
+        # breadth-first search for an account with room; parents[i] is the
+        # account the key moving into i comes from, and that key
+        parents = OrderedDict((i, (None, key)) for i in holders)
+        queue = list(parents)
+        for i in queue:
+            if load[i] < capacities[i]:
+                while i is not None:
+                    previous, moved = parents[i]
+                    assign(moved, i)
+                    i = previous
+                break
+            for j in range(count):
+                if j not in parents and movable[i][j]:
+                    parents[j] = (i, next(iter(movable[i][j])))
+                    queue.append(j)
+    return keep
+
+def plan_shards(specs, managers, capacity):
+    """
+    Plan how to place the :class:`galerts2.AlertSpec` objects *specs* on the
+    accounts of *managers*.
+
+    Alerts that already exist somewhere stay where they are. Alerts that are
+    not desired anymore, and extra copies of desired ones, are deleted. Of an
+    alert with several copies, the copy on an account with room is kept, so
+    that as few alerts as possible are deleted and created again. New alerts
+    go to the accounts with the most free capacity. An account holding more
+    alerts than its capacity only gives up its surplus.
+
+    The plan is made from each manager's current :attr:`window_state`, so
+    refresh the managers first if they may be out of date.
+
+    :param capacity: the maximum number of alerts per account, either a
+        number or a dict mapping a manager's email to its capacity
+    :raises CapacityError: if the desired alerts don't fit in total
+    """
+    managers = list(managers)
+    capacities = [ capacity.get(manager.email, 0) if isinstance(capacity, dict) else capacity
+                   for manager in managers ]
+
+    desired = OrderedDict()
+    for spec in specs:
+        desired.setdefault(alert_key(spec), spec)
+
+    if len(desired) > sum(capacities):
+        raise CapacityError('{} alerts need to be placed but the accounts only hold {}'.format(
+            len(desired), sum(capacities)))
+
+    # the copies of every desired alert, by the index of their account
+    copies = OrderedDict()
+    for i, manager in enumerate(managers):
+        for alert in manager.window_state.alerts:
+            key = alert_key(alert)
+            if key in desired:
+                copies.setdefault(key, OrderedDict()).setdefault(i, alert)
+
+    keep = _keep_copies(copies, capacities)
+
+    deletes = []
+    kept = [ [] for _ in managers ]
+    for i, manager in enumerate(managers):
+        for alert in manager.window_state.alerts:
+            key = alert_key(alert)
+            if keep.get(key) == i and copies[key][i] is alert:
+                kept[i].append(alert)
+            else:
+                deletes.append((manager, alert))
+    unplaced = [ spec for (key, spec) in desired.items() if key not in keep ]
+
+    load = [ len(alerts) for alerts in kept ]
+    creates = []
+    for spec in unplaced:
+        i = max(range(len(managers)), key=lambda j: (capacities[j] - load[j], -j))
+        creates.append((managers[i], spec))
+        load[i] += 1
+
+    return ShardPlan(
+        creates   = creates,
+        deletes   = deletes,
+        kept      = sum(len(alerts) for alerts in kept),
+        placement = dict((manager, load[i]) for (i, manager) in enumerate(managers)),
+    )
@@ -0,0 +1,216 @@
+# This file is part of galerts and is distributed under the same MIT license;
+# see docs/COPYING.txt for the full text.
+
+"""
+Per-alert yield statistics, to find the alerts that cost more than they
+deliver.
+
+A :class:`YieldStats` database counts, for every alert, how often its feed
+was fetched, the bytes fetched, the items it delivered, how many of those
+were unique (not delivered before by any alert) and when it last delivered a
+unique item. Alerts can then be ranked by what they cost per unique item, and
+the worst ones deleted or downgraded to :attr:`galerts2.Volumes.BestResults`::
+
+    >>> stats = YieldStats('/var/lib/galerts/yield.db')
+    >>> FeedPipeline(sink, yield_stats=stats).run(gam.window_state.alerts)
+    >>> for entry in stats.report(gam.window_state.alerts)[:10]:
+    ...     print entry
+    >>> gam.update_many(downgraded(stats.worst(gam.window_state.alerts, max_cost=50000)))
+"""
+
+import time
+import sqlite3
+import threading
+from galerts2 import Volumes
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS alert_yield (
+    alert_id     TEXT PRIMARY KEY,
+    fetches      INTEGER NOT NULL DEFAULT 0,
+    bytes        INTEGER NOT NULL DEFAULT 0,
+    items        INTEGER NOT NULL DEFAULT 0,
+    unique_items INTEGER NOT NULL DEFAULT 0,
+    first_fetch  REAL,
+    last_fetch   REAL,
+    last_hit     REAL
+);
+
+-- fingerprints of the items seen so far, to tell unique items from repeats
+CREATE TABLE IF NOT EXISTS seen_items (
+    fingerprint TEXT PRIMARY KEY,
+    seen_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS seen_items_seen_at ON seen_items (seen_at);
+'''
+
+_COLUMNS = ('alert_id', 'fetches', 'bytes', 'items', 'unique_items', 'first_fetch', 'last_fetch', 'last_hit')
+
+# what an alert's cost is measured in
+_COSTS = ('bytes', 'fetches', 'items')
+
+class AlertYield(object):
+    """
+    The counters of one alert.
+    """
+    def __init__(self, alert_id, fetches=0, bytes=0, items=0, unique_items=0, first_fetch=None, last_fetch=None,
+                 last_hit=None, cost='bytes'):
+        self.alert_id     = alert_id
+        self.fetches      = fetches
+        self.bytes        = bytes
+        self.items        = items
+        self.unique_items = unique_items
+        self.first_fetch  = first_fetch
+        self.last_fetch   = last_fetch
+        self.last_hit     = last_hit
+        self.cost         = cost
+
+    @property
+    def cost_per_unique(self):
+        """
+        The alert's cost (bytes, fetches or items, see
+        :meth:`YieldStats.report`) per unique item. Infinite for alerts
+        which never delivered a unique item.
+        """
+        cost = getattr(self, self.cost)
+        if not self.unique_items:
+            return float('inf')
+        return float(cost) / self.unique_items
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in _COLUMNS)
+        d['cost_per_unique'] = self.cost_per_unique
+        return d
+
+    def __str__(self):
+        return '<AlertYield id: {}, fetches: {}, bytes: {}, items: {}, unique: {}, cost per unique: {:.1f}>'.format(
+            self.alert_id, self.fetches, self.bytes, self.items, self.unique_items, self.cost_per_unique)
+
+class YieldStats(object):
+    """
+    Yield counters of alerts, kept in a SQLite database.
+    """
+    def __init__(self, path=':memory:'):
+        """
+        :param path: file name of the database, or ``':memory:'``
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def record(self, alert_id, items, bytes=0, when=None):
+        """
+        Count one fetch of the feed of *alert_id* that returned the
+        :class:`galerts_feeds.FeedItem` objects *items* in *bytes* bytes.
+        Returns the number of unique items among them.
+        """
+        when = when if when is not None else time.time()
+        fingerprints = set(item.fingerprint for item in items)
+        with self._lock:
+            with self._conn:
+                cursor = self._conn.cursor()
+                unique = 0
+                for fingerprint in fingerprints:
+                    cursor.execute('INSERT OR IGNORE INTO seen_items (fingerprint, seen_at) VALUES (?, ?)',
+                                   (fingerprint, when))
+                    unique += cursor.rowcount
+                cursor.execute('INSERT OR IGNORE INTO alert_yield (alert_id, first_fetch) VALUES (?, ?)',
+                               (alert_id, when))
+                cursor.execute('UPDATE alert_yield SET fetches = fetches + 1, bytes = bytes + ?, items = items + ?, '
+                               'unique_items = unique_items + ?, last_fetch = ?, '
+                               'last_hit = CASE WHEN ? > 0 THEN ? ELSE last_hit END WHERE alert_id = ?',
+                               (bytes, len(items), unique, when, unique, when, alert_id))
+        return unique
+
+    def get(self, alert_id, cost='bytes'):
+        """
+        Return the :class:`AlertYield` of *alert_id*, or ``None`` if its
+        feed was never recorded.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT ' + ', '.join(_COLUMNS) + ' FROM alert_yield WHERE alert_id = ?',
+                                     (alert_id,)).fetchone()
+        return AlertYield(*row, cost=cost) if row is not None else None
+
+    def report(self, alerts=None, cost='bytes', min_fetches=1):
+        """
+        Return the :class:`AlertYield` of every recorded alert, ranked by
+        cost per unique item, most expensive first. Among alerts without
+        unique items, the most expensive come first as well.
+
+        :param alerts: only report these alerts
+        :param cost: what an alert costs: ``'bytes'`` fetched, ``'fetches'``
+            or delivered ``'items'``
+        :param min_fetches: leave out alerts fetched fewer times than this,
+            whose numbers don't mean much yet
+        """
+        if cost not in _COSTS:
+            raise ValueError('Unknown cost: ' + cost)
+        with self._lock:
+            rows = self._conn.execute('SELECT ' + ', '.join(_COLUMNS) + ' FROM alert_yield WHERE fetches >= ?',
+                                      (min_fetches,)).fetchall()
+        entries = [ AlertYield(*row, cost=cost) for row in rows ]
+        if alerts is not None:
+            alert_ids = set(alert.alert_id for alert in alerts)
+            entries = [ entry for entry in entries if entry.alert_id in alert_ids ]
+        entries.sort(key=lambda entry: (entry.cost_per_unique, getattr(entry, cost), entry.alert_id), reverse=True)
+        return entries
+
+    def worst(self, alerts, limit=None, max_cost=None, cost='bytes', min_fetches=1):
+        """
+        Return the alerts of *alerts* that are worst by :meth:`report`, e.g.
+        to pass them to :meth:`galerts2.GoogleAlertsManager.delete_many` or,
+        through :func:`downgraded`, to
+        :meth:`galerts2.GoogleAlertsManager.update_many`.
+
+        :param limit: return at most this many alerts
+        :param max_cost: only return alerts whose cost per unique item is
+            above this
+        """
+        alerts = dict((alert.alert_id, alert) for alert in alerts)
+        worst = []
+        for entry in self.report(alerts.values(), cost, min_fetches):
+            if limit is not None and len(worst) >= limit:
+                break
+            if max_cost is not None and entry.cost_per_unique <= max_cost:
+                break
+            worst.append(alerts[entry.alert_id])
+        return worst
+
+    def forget(self, alert_ids):
+        """
+        Drop the counters of *alert_ids*, e.g. of deleted or changed alerts.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('DELETE FROM alert_yield WHERE alert_id = ?',
+                                       [ (alert_id,) for alert_id in alert_ids ])
+
+    def forget_items(self, before):
+        """
+        Forget the items first seen before *before* (seconds since the
+        epoch). If they are delivered again, they count as unique. Returns
+        the number of items forgotten.
+        """
+        with self._lock:
+            with self._conn:
+                return self._conn.execute('DELETE FROM seen_items WHERE seen_at < ?', (before,)).rowcount
+
+def downgraded(alerts):
+    """
+    Return copies of those *alerts* that don't already deliver only the
+    best results, with their volume set to
+    :attr:`galerts2.Volumes.BestResults`.
+    """
+    changed = []
+    for alert in alerts:
+        if alert.volume == Volumes.BestResults:
+            continue
+        alert = type(alert).from_dict(alert.as_dict())
+        alert.volume = Volumes.BestResults
+        changed.append(alert)
+    return changed
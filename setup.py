@@ -35,7 +35,28 @@ setup(
     keywords='google, alerts, google alerts, news',
     url='http://packages.python.org/galerts',
     license='MIT',
-    py_modules=['galerts', 'galerts2'],
+    py_modules=[
+        'galerts',
+        'galerts2',
+        'galerts_feeds',
+        'galerts_index',
+        'galerts_mirror',
+        'galerts_sharding',
+        'galerts_daemon',
+        'galerts_server',
+        'galerts_cassette',
+        'galerts_journal',
+        'galerts_matching',
+        'galerts_pipeline',
+        'galerts_itemlog',
+        'galerts_columns',
+        'galerts_scoring',
+        'galerts_polling',
+        'galerts_feedproxy',
+        'galerts_pubsub',
+        'galerts_yield',
+        'galerts_history',
+        ],
     zip_safe=True,
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -46,4 +67,7 @@ setup(
     install_requires=[
         "BeautifulSoup",
         ],
+    extras_require={
+        'analytics': [ "numpy" ],
+        },
     )